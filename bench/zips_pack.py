@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+"""
+Benchmark zip packing on a synthetic media-heavy content set
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+Usage::
+
+    python bench/zips_pack.py [--items N] [--scale MB]
+
+Content directories are generated in a temporary directory. Each contains
+HTML and CSS (compressible), and JPEG, PNG and MP4 files filled with random
+data (incompressible), and a file with random data and no extension, which
+is only detected by sampling. Every item is packed using each of the
+compression policies, and total pack time and zip size are reported.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from broadman import zips  # NOQA
+
+
+POLICIES = [
+    ('deflate all', dict(store=())),
+    ('store media', dict()),
+    ('store media, level 1', dict(level=1)),
+    ('store media, sample', dict(sample=True)),
+    ('store media, 4 threads', dict(jobs=4)),
+]
+
+HTML = (b'<html><head><title>Lorem ipsum</title></head><body><p>Lorem ipsum '
+        b'dolor sit amet, consectetur adipiscing elit.</p></body></html>\n')
+CSS = b'body { margin: 0; padding: 0; font-family: sans-serif; }\n'
+
+
+def write(p, data):
+    with open(p, 'wb') as f:
+        f.write(data)
+
+
+def make_content(root, items, scale):
+    """ Create ``items`` content directories of roughly ``scale`` bytes """
+    dirs = []
+    for i in range(items):
+        cdir = os.path.join(root, 'item{}'.format(i))
+        os.makedirs(os.path.join(cdir, 'static'))
+        write(os.path.join(cdir, 'index.html'), HTML * (scale // 20 // 128))
+        write(os.path.join(cdir, 'static', 'style.css'), CSS * 200)
+        write(os.path.join(cdir, 'static', 'photo.jpg'),
+              os.urandom(scale * 3 // 10))
+        write(os.path.join(cdir, 'static', 'logo.png'),
+              os.urandom(scale // 10))
+        write(os.path.join(cdir, 'static', 'clip.mp4'),
+              os.urandom(scale * 4 // 10))
+        write(os.path.join(cdir, 'static', 'blob'), os.urandom(scale // 10))
+        dirs.append(cdir)
+    return dirs
+
+
+def run(dirs, outdir, kwargs):
+    size = 0
+    start = time.time()
+    for cdir in dirs:
+        zpath = os.path.join(outdir, os.path.basename(cdir) + '.zip')
+        zips.pack(zpath, cdir, **kwargs)
+        size += os.stat(zpath).st_size
+        os.unlink(zpath)
+    return time.time() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark zips.pack')
+    parser.add_argument('--items', type=int, default=10,
+                        help='number of content items (default: %(default)s)')
+    parser.add_argument('--scale', type=int, default=10,
+                        help='approximate size of each item in MB (default: '
+                        '%(default)s)')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dirs = make_content(os.path.join(tmpdir, 'src'), args.items,
+                            args.scale * 1024 * 1024)
+        outdir = os.path.join(tmpdir, 'out')
+        os.makedirs(outdir)
+        print('{:<24} {:>10} {:>14}'.format('policy', 'time (s)',
+                                            'size (bytes)'))
+        for name, kwargs in POLICIES:
+            elapsed, size = run(dirs, outdir, kwargs)
+            print('{:<24} {:>10.2f} {:>14}'.format(name, elapsed, size))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,8 +19,11 @@ VERSION = "%(prog)s {} / Python {} {}".format(
     '.'.join([str(s) for s in sys.version_info[:3]]),
     ' '.join(platform.architecture()))
 
+BATCH_SIZE = 1000
 
-def getparser(desc, usage=None, has_debug=False, has_verbose=False):
+
+def getparser(desc, usage=None, has_debug=False, has_verbose=False,
+              has_batch=False):
     parser = argparse.ArgumentParser(
         description=desc,
         usage=usage,
@@ -32,4 +35,11 @@ def getparser(desc, usage=None, has_debug=False, has_verbose=False):
     if has_debug:
         parser.add_argument('--debug', '-D', action='store_true',
                             help='enable debugging')
+    if has_batch:
+        parser.add_argument('--batch', '-b', action='store_true',
+                            help='record changes in batch commits instead of '
+                            'one commit per item')
+        parser.add_argument('--batch-size', metavar='N', type=int,
+                            default=BATCH_SIZE, help='maximum number of '
+                            'items in a batch commit (default: %(default)s)')
     return parser
@@ -11,8 +11,12 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 from __future__ import print_function
 
 import os
+import fcntl
+import atexit
 import datetime
-import fileinput
+import tempfile
+import contextlib
+from collections import OrderedDict
 
 from . import git
 from . import path
@@ -21,68 +25,394 @@ from . import path
 TSFMT = '%Y-%m-%dT%H:%M:%S%z'
 
 
-def format_backlog(action, cid, server):
-    """ Format the backlog message for given action and content ID """
-    user = git.Git().git.config('user.email').strip()
-    if not user:
-        raise RuntimeError('Git user has no email, cannot modify backlog')
-    return ' '.join([action, cid, server, user,
-                     datetime.datetime.now().strftime(TSFMT)])
+class Backlog:
+    """
+    Backlog entries indexed by content ID and server
+
+    Entries are read from the backlog file once, and kept in memory in the
+    order in which they were added, keyed by (cid, server) pairs, so that
+    looking up and removing entries does not require reading the whole file.
+
+    As long as no entries are removed, new entries are appended to the file
+    when ``write()`` is called. Once an entry is removed, the file is only
+    rewritten when ``save()`` is called, which happens automatically on exit.
+
+    Other processes may change the file at any time. It is only read and
+    written while holding an exclusive lock on it, and before writing, any
+    entries that other processes wrote since it was last read are loaded,
+    and changes that were not written yet are applied on top of them, so
+    that changes made by other processes are never lost.
+    """
+
+    def __init__(self, p=None):
+        self.path = p or path.BACKLOG
+        self.entries = None
+        self.dirty = False
+        # Lines that were added but not yet written to the file, keyed by
+        # cid-server combination
+        self.pending = OrderedDict()
+        # Lines that were removed but not yet removed from the file, keyed by
+        # cid-server combination
+        self.removed = {}
+        # Inode of the file and position up to which it was read or written
+        self.inode = None
+        self.size = 0
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Open the backlog file with an exclusive lock
+
+        If the file is replaced by another process while waiting for the
+        lock, the new file is locked instead.
+        """
+        while True:
+            f = open(self.path, 'a+b')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.path).st_ino
+            except path.FILE_ERRORS:
+                current = None
+            if current == os.fstat(f.fileno()).st_ino:
+                break
+            f.close()
+        try:
+            yield f
+        finally:
+            # Closing the file also releases the lock
+            f.close()
+
+    def put(self, line):
+        key = tuple(line.split(' ')[1:3])
+        # In case of duplicates, the later entry wins
+        self.entries.pop(key, None)
+        self.entries[key] = line
+
+    def refresh(self, f):
+        """ Bring entries up to date with the locked file, and apply changes
+        that were not written yet on top of them """
+        st = os.fstat(f.fileno())
+        if st.st_ino != self.inode or st.st_size < self.size:
+            # File was replaced, so it is read from the start
+            self.entries = OrderedDict()
+            self.inode = st.st_ino
+            self.size = 0
+        f.seek(self.size)
+        data = f.read()
+        self.size = f.tell()
+        for l in data.decode('utf8').splitlines():
+            if l.strip():
+                self.put(l.strip())
+        for key, l in self.removed.items():
+            # Entries that were replaced by other processes are kept
+            if self.entries.get(key) == l:
+                del self.entries[key]
+        for l in self.pending.values():
+            self.put(l)
+
+    def load(self):
+        self.entries = OrderedDict()
+        self.inode = None
+        self.size = 0
+        if not os.path.exists(self.path):
+            return
+        with self.locked() as f:
+            self.refresh(f)
+
+    def _entries(self):
+        if self.entries is None:
+            self.load()
+        return self.entries
+
+    def get(self, cid, server):
+        """ Return entry for cid-server combination split into parts or
+        ``None`` """
+        l = self._entries().get((cid, server))
+        if l is None:
+            return None
+        return l.split(' ')
+
+    def add(self, line):
+        """ Add entry, replacing any existing entry for the same cid-server
+        combination """
+        key = tuple(line.split(' ')[1:3])
+        self.discard(key)
+        self.entries[key] = line
+        self.pending[key] = line
+
+    def discard(self, key):
+        old = self._entries().pop(key, None)
+        if old is None:
+            return
+        if self.pending.get(key) == old:
+            del self.pending[key]
+        else:
+            self.removed[key] = old
+            self.dirty = True
+
+    def remove(self, cid, server):
+        self.discard((cid, server))
+
+    def lines(self):
+        """ Return all entries in the backlog file format """
+        return list(self._entries().values())
+
+    def prune(self, entries):
+        """ Remove given entries (split into parts) and save the file
+
+        The file is read again first, and entries that were replaced in the
+        meantime, by this or other processes, are kept.
+        """
+        self._entries()
+        if os.path.exists(self.path):
+            with self.locked() as f:
+                self.refresh(f)
+        for parts in entries:
+            if self.get(*parts[1:3]) == list(parts):
+                self.remove(*parts[1:3])
+        self.save()
+
+    def clear(self):
+        """ Remove all entries, except those that other processes add to the
+        file after it was read """
+        for key in list(self._entries()):
+            self.discard(key)
+        self.dirty = True
+        self.save()
+
+    def write(self):
+        """ Append pending entries to the file in a single locked write """
+        if self.dirty or not self.pending:
+            # File will be rewritten as a whole by save()
+            return
+        with self.locked() as f:
+            self.refresh(f)
+            f.write(''.join(l + '\n' for l in self.pending.values())
+                    .encode('utf8'))
+            f.flush()
+            self.size = f.tell()
+        self.pending = OrderedDict()
+
+    def save(self):
+        """ Write any pending changes to the backlog file
+
+        The file is rewritten if entries were removed, otherwise pending
+        entries are appended to it.
+        """
+        if not self.dirty:
+            self.write()
+            return
+        with self.locked() as lf:
+            self.refresh(lf)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(
+                os.path.abspath(self.path)))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(''.join(l + '\n' for l in self.entries.values())
+                        .encode('utf8'))
+                self.size = f.tell()
+                self.inode = os.fstat(f.fileno()).st_ino
+            # Temporary files are only readable by the owner
+            os.chmod(tmp, os.fstat(lf.fileno()).st_mode)
+            # Renamed while the lock is held, so that other processes wait
+            # for it and then lock the new file
+            os.rename(tmp, self.path)
+        self.pending = OrderedDict()
+        self.removed = {}
+        self.dirty = False
+
+
+_backlog = None
+
+
+def store():
+    """ Return the backlog store, loading it on first use """
+    global _backlog
+    if _backlog is None or _backlog.path != path.BACKLOG:
+        save()
+        _backlog = Backlog()
+    return _backlog
+
+
+@atexit.register
+def save():
+    """ Write pending backlog changes to disk """
+    if _backlog is not None:
+        _backlog.save()
+
 
+def reload():
+    """ Write pending changes and discard loaded entries, so that changes
+    made by other processes are seen on next use """
+    global _backlog
+    save()
+    _backlog = None
 
-def match_line(cid, server, l):
-    """ Checks a single backlog line if it matches cid-server combination
 
-    Returns the line split into parts.
+class Journal:
     """
-    lsp = l.split(' ')
-    if not lsp:
-        return None
-    if lsp[1] == cid and lsp[2] == server:
-        return lsp
+    Backlog entries that were completed by a sync that is still in progress
+
+    Each completed entry is appended to the journal file and synced to disk
+    before the next entry is started, so that a sync that was interrupted can
+    be resumed without repeating the completed entries. Every ``interval``
+    entries, and when ``checkpoint()`` is called, completed entries are also
+    removed from the backlog. The journal is removed once the whole backlog
+    is processed.
+    """
+
+    # Number of completed entries between backlog rewrites
+    INTERVAL = 100
+
+    def __init__(self, p=None, interval=INTERVAL):
+        self.path = p or path.JOURNAL
+        self.interval = interval
+        self.f = None
+        # Entries that are not yet removed from the backlog
+        self.unsaved = []
+
+    def load(self):
+        """ Return lines of entries completed by previous runs """
+        try:
+            with open(self.path, 'r') as f:
+                return [l.strip() for l in f if l.strip()]
+        except path.FILE_ERRORS:
+            return []
+
+    def mark(self, parts):
+        """ Durably record completion of an entry given as a list of parts """
+        if self.f is None:
+            self.f = open(self.path, 'a')
+        self.f.write(' '.join(parts) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.unsaved.append(parts)
+        if len(self.unsaved) >= self.interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Remove completed entries from the backlog file """
+        if not self.unsaved:
+            return
+        # Entries that were replaced while syncing are left in the backlog
+        store().prune(self.unsaved)
+        self.unsaved = []
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def clear(self):
+        """ Remove the journal after the whole backlog was processed """
+        self.close()
+        self.unsaved = []
+        try:
+            os.unlink(self.path)
+        except path.FILE_ERRORS:
+            pass
+
+
+_user = None
+
+
+def identity():
+    """ Return email of the git user, which is looked up once per process """
+    global _user
+    if _user is None:
+        user = git.session().git.config('user.email').strip()
+        if not user:
+            raise RuntimeError('Git user has no email, cannot modify backlog')
+        _user = user
+    return _user
+
+
+def timestamp():
+    return datetime.datetime.now().strftime(TSFMT)
+
+
+def format_backlog(action, cid, server, ts=None):
+    """ Format the backlog message for given action and content ID """
+    return ' '.join([action, cid, server, identity(), ts or timestamp()])
 
 
 def rem_cid(cid, server):
     """ Remove entries that match the given content ID """
-    if not os.path.exists(path.BACKLOG):
-        return
-    for l in fileinput.input(path.BACKLOG, inplace=True):
-        if l.strip() == '':
-            continue
-        if match_line(cid, server, l):
-            continue
-        print(l, end='')  # Note that with inplace argument, STDOUT is the file
+    store().remove(cid, server)
 
 
 def has_cid(cid, server):
     """ Checks wether cid-server combination is in backlog """
-    with open(path.BACKLOG) as f:
-        for l in f:
-            ret = match_line(cid, server, l)
-            if not ret:
-                continue
-            return ret
+    return store().get(cid, server)
 
 
 def write_backlog(msg):
     """ Write a backglog entry """
-    with open(path.BACKLOG, 'a+') as f:
-        f.write(msg + '\n')
+    store().add(msg)
+
+
+def record(action, cid, server, ts=None):
+    """ Record an action without writing it to the backlog file """
+    if action == 'DEL':
+        ret = has_cid(cid, server)
+        if ret:
+            if ret[0] == 'ADD':
+                # Just revert the add
+                rem_cid(cid, server)
+            # Probably already deleted
+            return
+    write_backlog(format_backlog(action, cid, server, ts))
+
+
+def write_entries(entries):
+    """ Record multiple (action, cid, server) entries at once
+
+    All entries get the same timestamp, and new lines are appended to the
+    backlog file in a single write.
+    """
+    ts = timestamp()
+    for action, cid, server in entries:
+        record(action, cid, server, ts)
+    store().write()
+
+
+def compact(lines):
+    """ Reduce backlog lines to the net operation for each cid-server
+    combination
+
+    Only the last entry for each combination is kept, in the position of its
+    last occurrence. Returns a list of entries split into parts, and a dict
+    with the number of ``entries`` and net ``operations``, and the number of
+    ``packs`` and ``transfers`` that are saved compared to replaying all
+    entries, assuming that content added to more than one server is only
+    packed once.
+    """
+    net = OrderedDict()
+    count = 0
+    adds = 0
+    for l in lines:
+        l = l.strip()
+        if not l:
+            continue
+        parts = l.split(' ')
+        key = tuple(parts[1:3])
+        net.pop(key, None)
+        net[key] = parts
+        count += 1
+        if parts[0] == 'ADD':
+            adds += 1
+    ops = list(net.values())
+    packs = set(p[1] for p in ops if p[0] == 'ADD')
+    stats = {
+        'entries': count,
+        'operations': len(ops),
+        'packs': adds - len(packs),
+        'transfers': count - len(ops),
+    }
+    return ops, stats
 
 
 def cadd(cid, server):
-    msg = format_backlog('ADD', cid, server)
-    rem_cid(cid, server)
-    write_backlog(msg)
+    write_entries([('ADD', cid, server)])
 
 
 def cdel(cid, server):
-    msg = format_backlog('DEL', cid, server)
-    ret = has_cid(cid, server)
-    if not ret:
-        write_backlog(msg)
-        return
-    if ret[0] == 'ADD':
-        # Just rever the add
-        rem_cid(cid, server)
-    # Probably already deleted
+    write_entries([('DEL', cid, server)])
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+"""
+Convert broadcast records between the database and log forms
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+In the default ``db`` broadcast mode, the broadcast database is committed to
+the repository after each sync. Since it is a binary file, each commit adds a
+full copy of it to the repository. In ``log`` mode, broadcast records are
+appended to a log in JSON lines format, which is committed instead, and the
+database is kept in the cache directory, where it is rebuilt from the log as
+needed.
+"""
+
+import os
+import sys
+
+import conz
+
+from . import db
+from . import git
+from . import path
+
+
+cn = conz.Console()
+
+
+def export(dest=None):
+    """ Write records from the pool's broadcast database to ``dest`` file,
+    or to STDOUT """
+    d = db.connect(readonly=True)
+    if dest is None:
+        db.export(d, sys.stdout)
+        return
+    with open(dest, 'w') as f:
+        db.export(d, f)
+
+
+def load(src, dest):
+    """ Build a new broadcast database at ``dest`` from the log ``src`` """
+    if os.path.exists(dest):
+        raise ValueError('{} already exists'.format(dest))
+    if not os.path.exists(src):
+        raise ValueError('{} does not exist'.format(src))
+    db.load(dest, src)
+
+
+def switch(mode):
+    """ Switch the pool to a different broadcast mode and commit it """
+    old = path.broadcastmode()
+    if old == mode:
+        raise ValueError('pool already uses {} broadcast mode'.format(mode))
+    if git.has_changes(path.broadcastrecord()):
+        raise RuntimeError('broadcast records have uncommitted changes')
+    src = path.broadcastrecord()
+    if mode == path.LOGMODE:
+        with cn.progress('Exporting broadcast log'):
+            export(path.BROADCAST_LOG)
+            db.close()
+            os.unlink(path.BROADCAST)
+            # Cache may be left over from when log mode was last used
+            if os.path.exists(path.BROADCAST_CACHE):
+                os.unlink(path.BROADCAST_CACHE)
+    else:
+        with cn.progress('Importing broadcast log'):
+            db.close()
+            load(path.BROADCAST_LOG, path.BROADCAST)
+            os.unlink(path.BROADCAST_LOG)
+    opts = path.read_options()
+    opts['broadcast'] = mode
+    path.write_options(opts)
+    with cn.progress('Committing changes'):
+        git.commit_broadcast_mode(mode, src, path.broadcastrecord())
+    if mode == path.LOGMODE:
+        with cn.progress('Building broadcast database cache'):
+            db.connect()
+            db.close()
+
+
+def main():
+    from . import args
+
+    parser = args.getparser('Convert broadcast records between database '
+                            'and log forms', has_debug=True)
+    sub = parser.add_subparsers(dest='command', metavar='COMMAND')
+    sub.required = True
+    p = sub.add_parser('export', help='write broadcast records in log form')
+    p.add_argument('--output', '-o', metavar='PATH',
+                   help='write records to PATH instead of STDOUT')
+    p = sub.add_parser('import', help='build broadcast database from log')
+    p.add_argument('log', metavar='LOG', help='path to the broadcast log')
+    p.add_argument('dest', metavar='DB', help='path to the new database')
+    sub.add_parser('enable', help='keep broadcast log in the repository '
+                   'instead of the database')
+    sub.add_parser('disable', help='keep broadcast database in the '
+                   'repository instead of the log')
+    args = parser.parse_args()
+
+    cn.debug = args.debug
+
+    try:
+        if args.command == 'export':
+            export(args.output)
+            return
+        if args.command == 'import':
+            load(args.log, args.dest)
+        else:
+            cn.verbose = True
+            switch(path.LOGMODE if args.command == 'enable' else path.DBMODE)
+        cn.pok('broadcast log {}'.format(args.command))
+    except (ValueError, RuntimeError, db.OperationalError) as e:
+        cn.perr(e)
+        cn.png('broadcast log {}'.format(args.command))
+        cn.quit(1)
+    except cn.ProgressAbrt:
+        cn.png('broadcast log {}'.format(args.command))
+        cn.quit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+Functions for working with the metadata catalog
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+The catalog is a SQLite database that mirrors the metadata of all content in
+the master pool. It is stored outside of the repository, in ``path.CATALOG``,
+and is refreshed incrementally so that only content whose files or commits
+have changed since the last refresh is reloaded.
+
+Besides the complete metadata, the values of keys defined by the metadata
+specification are stored in columns of their own, and the commonly filtered
+ones are indexed, so that content can be matched without decoding its
+metadata. Values that do not have the type of their column (e.g., a title that
+is a number) are left out of it, and the row is marked as irregular, so that
+its metadata is decoded when matching.
+"""
+
+import os
+import json
+import sqlite3
+
+from git.exc import GitCommandError
+
+from . import git
+from . import path
+from . import sizes
+from . import index
+from . import jsonf
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+OperationalError = sqlite3.OperationalError
+
+# Metadata keys that have columns of their own
+TEXT_KEYS = ('title', 'url', 'timestamp', 'broadcast', 'license', 'language',
+             'publisher', 'keywords', 'archive', 'index', 'replaces',
+             'thumbnail', 'cover')
+BOOLEAN_KEYS = ('is_partner', 'is_sponsored', 'keep_formatting', 'multipage')
+KEYS = TEXT_KEYS + BOOLEAN_KEYS
+
+# Columns that are indexed
+INDEXED = ('title', 'url', 'timestamp', 'broadcast', 'language', 'publisher',
+           'size')
+
+
+def columns(meta):
+    """ Return a tuple of key column values and irregular flag for metadata """
+    values = []
+    irregular = False
+    for key in KEYS:
+        value = meta.get(key)
+        vtype = bool if key in BOOLEAN_KEYS else basestring
+        if value is not None and not isinstance(value, vtype):
+            value = None
+            irregular = True
+        values.append(value)
+    return values, irregular
+
+
+def rowdata(row):
+    """ Return metadata built from key columns of a catalog row
+
+    The result is only complete for keys in ``KEYS``, and only for rows that
+    are not irregular.
+    """
+    d = {}
+    for key in KEYS:
+        value = row[key]
+        if value is None:
+            continue
+        d[key] = bool(value) if key in BOOLEAN_KEYS else value
+    return d
+
+
+class Catalog:
+    # Increment when stored values need to be reloaded
+    VERSION = 2
+    SCHEMA = """
+    create table if not exists content (
+        content_id text primary key,
+        path text,
+        mtime real,
+        size integer,
+        commit_hash text,
+        metadata text,
+        irregular integer,
+        {columns}
+    );
+    {indexes}
+    create table if not exists state (
+        key text primary key,
+        value text
+    );
+    """.format(
+        columns=',\n        '.join(
+            '"{}" {}'.format(k, 'integer' if k in BOOLEAN_KEYS else 'text')
+            for k in KEYS),
+        indexes='\n    '.join(
+            'create index if not exists content_{0} '
+            'on content ("{0}");'.format(k) for k in INDEXED))
+    INSERT = 'insert or replace into content values ({})'.format(
+        ', '.join('?' * (7 + len(KEYS))))
+
+    def __init__(self, db=path.CATALOG):
+        ddir = os.path.dirname(db)
+        if ddir and not os.path.isdir(ddir):
+            os.makedirs(ddir)
+        self.con = sqlite3.connect(db)
+        self.con.row_factory = sqlite3.Row
+        # SQLite's lower() only handles ASCII (see query.Conditions)
+        self.con.create_function('py_lower', 1, lambda s: s.lower())
+        self.create_table()
+        self.sizes = sizes.Sizes(con=self.con)
+
+    def create_table(self):
+        version = self.con.execute('pragma user_version').fetchone()[0]
+        if version < self.VERSION:
+            # Version 1 stores sizes in bytes rather than du blocks, and
+            # version 2 adds key columns
+            self.con.execute('drop table if exists content')
+            self.con.execute('pragma user_version = {}'.format(self.VERSION))
+        self.con.executescript(self.SCHEMA)
+
+    def get(self, cid):
+        """ Return catalog row for given content ID or ``None`` """
+        cur = self.con.execute(
+            'select * from content where content_id = ?', (cid,))
+        return cur.fetchone()
+
+    def metadata(self, cid):
+        """ Return metadata for given content ID or ``None`` """
+        row = self.get(cid)
+        if row is None:
+            return None
+        return json.loads(row['metadata'])
+
+    def store(self, cid, cdir, mtime, commit):
+        """ Load content metadata from disk and store it in the catalog """
+        meta = jsonf.load(path.infopath(cdir))
+        values, irregular = columns(meta)
+        self.con.execute(self.INSERT, [
+            cid, cdir, mtime, self.sizes.size(cid), commit,
+            json.dumps(meta, sort_keys=True), irregular] + values)
+
+    def select(self, cids):
+        """ Select content IDs that ``selected()`` is limited to """
+        self.con.execute('create temp table if not exists selected '
+                         '(content_id text primary key)')
+        self.con.execute('delete from selected')
+        self.con.executemany('insert or ignore into selected values (?)',
+                             ((cid,) for cid in cids))
+
+    def selected(self, where='1', params=(), columns='content.*'):
+        """ Return selected rows that match SQL condition """
+        return self.con.execute(
+            'select {} from selected join content using (content_id) '
+            'where {}'.format(columns, where), params)
+
+    def committed(self):
+        """ Return latest commit hashes of content committed since last
+        refresh keyed by content ID, and whether they are hashes of all
+        content because stored hashes cannot be used """
+        cur = self.con.execute("select value from state where key = 'head'")
+        row = cur.fetchone()
+        if row is not None:
+            try:
+                return git.latest_hashes(path.serverdir(), row['value']), False
+            except GitCommandError:
+                # Last seen HEAD is gone (e.g., history was rewritten), so we
+                # cannot trust any of the stored commit hashes
+                pass
+        return git.latest_hashes(path.serverdir()), True
+
+    def refresh(self):
+        """ Refresh the catalog and return the number of reloaded items
+
+        Content is reloaded if modification time of the content directory or
+        its metadata file does not match the stored one, or if there were
+        commits affecting the content since last refresh. Content that no
+        longer exists is removed from the catalog.
+        """
+        stored = dict((row[0], tuple(row[1:])) for row in self.con.execute(
+            'select content_id, mtime, commit_hash from content'))
+        hashes, complete = self.committed()
+        pending = []
+        for cdir in index.find_contentdirs([]):
+            cid = os.path.basename(cdir)
+            try:
+                mtime = max(os.stat(cdir).st_mtime,
+                            os.stat(path.infopath(cdir)).st_mtime)
+            except path.FILE_ERRORS:
+                continue
+            old = stored.get(cid)
+            if old and old[0] == mtime and not complete \
+                    and cid not in hashes:
+                del stored[cid]
+                continue
+            if cid in hashes or complete:
+                commit = hashes.get(cid)
+            elif old:
+                # Not committed since last refresh
+                commit = old[1]
+            else:
+                commit = git.latest_hash(cdir)
+            pending.append((cid, cdir, mtime, commit))
+        # Pool may have changed since sizes were last used
+        self.sizes.load(item[0] for item in pending)
+        count = 0
+        for cid, cdir, mtime, commit in pending:
+            try:
+                self.store(cid, cdir, mtime, commit)
+            except jsonf.LoadError:
+                # Leave it in stored so that any stale entry is removed
+                continue
+            stored.pop(cid, None)
+            count += 1
+        self.con.executemany('delete from content where content_id = ?',
+                             ((cid,) for cid in stored))
+        self.con.execute("insert or replace into state values ('head', ?)",
+                         (git.head(),))
+        self.con.commit()
+        return count
+
+    def close(self):
+        self.con.close()
@@ -8,9 +8,16 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
-import subprocess
+import re
 from datetime import datetime
 
+from . import path
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
 DATEFMT = '%Y-%m-%d'
 TSFMT = '%Y-%m-%d %H:%M:%S'
 
@@ -20,6 +27,17 @@ TIMESTAMP = 't'
 NUMERIC = 'n'
 BOOLEAN = 'b'
 
+# Size unit multipliers
+SIZES = {
+    'b': 1,
+    'k': 1024,
+    'm': 1024 * 1024,
+}
+
+# Size with optional decimal part and unit, and optional trailing 'b' (e.g.,
+# '10', '10k', '1.5M' or '10Kb')
+SIZE_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([bkm]?)b?\s*$', re.I)
+
 
 def parse_date(s):
     return datetime.strptime(s, DATEFMT)
@@ -33,7 +51,7 @@ def parse_num(s):
     try:
         return float(s)
     except (TypeError, ValueError):
-        ValueError('not a valid numeric value')
+        raise ValueError('not a valid numeric value')
 
 
 def parse_bool(s):
@@ -69,12 +87,52 @@ def totype(s, vtype=None):
     raise ValueError('{} is not a supported type'.format(vtype))
 
 
+def coerce(x, vtype=None):
+    """ Convert a value found in data to given type
+
+    This function is similar to ``totype()``, but it is meant for values that
+    come from the data rather than user input. Values that are already of
+    correct type are returned as is, and timestamps with trailing timezone
+    (e.g., ``2015-04-25 15:00:21 UTC``) are accepted. If a value cannot be
+    converted, ``None`` is returned.
+    """
+    if x is None or not vtype:
+        return x
+    if not isinstance(x, basestring):
+        if vtype == BOOLEAN:
+            return bool(x)
+        if vtype == NUMERIC and not isinstance(x, bool):
+            return x
+        return None
+    if vtype == DATESTAMP:
+        x = x[:len('YYYY-MM-DD')]
+    elif vtype == TIMESTAMP:
+        x = x[:len('YYYY-MM-DD HH:MM:SS')]
+    try:
+        return totype(x, vtype)
+    except ValueError:
+        return None
+
+
+def parse_size(s):
+    """ Convert size string such as '10k' into number of bytes
+
+    ``ValueError`` is raised if the string is not a valid size.
+    """
+    m = SIZE_RE.match(s)
+    if not m:
+        raise ValueError('not a valid size')
+    num, unit = m.groups()
+    return int(float(num) * SIZES[unit.lower() or 'b'])
+
+
 def getsize(dir):
-    return subprocess.check_output(['du','-s', dir]).split()[0].decode('utf-8')
+    """ Return apparent size of a directory in bytes """
+    return path.dirsize(dir)[0]
 
 
 def sizematch(dir, val, invert=False):
-    size = int(getsize(dir))
+    size = getsize(dir)
     return (size > val) ^ invert
 
 
@@ -101,14 +159,13 @@ def bmatch(x, y, **kwargs):
     return x is y
 
 
-def match(data, key, keyword, vtype=None, invert=False, **kwargs):
-    """ Performs various matches of keyword against value of a key in data
-
-    ``data`` should be a dict. If there is no key in data, ``None`` is used as
-    the value.
+def matcher(key, keyword, vtype=None, invert=False, **kwargs):
+    """ Returns a function that matches keyword against value of a key in data
 
     ``keyword`` is a string that is coerced to appropriate type based on the
-    value of ``vtype`` using the ``totype()`` function.
+    value of ``vtype`` using the ``totype()`` function. The coercion is only
+    performed once, when the matcher is created, so the returned function can
+    be applied to any number of data dicts.
 
     The ``vtype`` value determines the type of match. If no type is passed,
     ``smatch()`` is performed.
@@ -118,15 +175,40 @@ def match(data, key, keyword, vtype=None, invert=False, **kwargs):
 
     For boolean type, ``bmatch()`` is performed.
 
+    For typed matches, the value in data is converted using ``coerce()``. If
+    it cannot be compared to the keyword, it does not match.
+
     Any keyword arguments passed to this function are relayed to selected match
     functions, but functions choose what keywords they will handle.
     """
-    x = data.get(key, None)
     y = totype(keyword, vtype)
     if vtype in [DATESTAMP, TIMESTAMP, NUMERIC]:
-        res =  nmatch(x, y, **kwargs)
-    if vtype == BOOLEAN:
-        res = bmatch(x, y, **kwargs)
+        fn = nmatch
+    elif vtype == BOOLEAN:
+        fn = bmatch
     else:
-        res = smatch(x, y, **kwargs)
-    return invert ^ res
+        fn = smatch
+
+    def match(data):
+        x = coerce(data.get(key, None), vtype)
+        if vtype and x is None:
+            return invert
+        try:
+            res = fn(x, y, **kwargs)
+        except TypeError:
+            res = False
+        return invert ^ res
+
+    return match
+
+
+def match(data, key, keyword, vtype=None, invert=False, **kwargs):
+    """ Performs various matches of keyword against value of a key in data
+
+    ``data`` should be a dict. If there is no key in data, ``None`` is used as
+    the value.
+
+    This function is a shortcut for creating a matcher using ``matcher()``
+    and applying it to ``data``. See ``matcher()`` for more information.
+    """
+    return matcher(key, keyword, vtype, invert, **kwargs)(data)
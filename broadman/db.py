@@ -8,9 +8,17 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import os
+import json
+import atexit
 import sqlite3
 import datetime
 
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
 import sqlize as sql
 
 from . import path
@@ -20,7 +28,67 @@ OperationalError = sqlite3.OperationalError
 ProgrammingError = sqlite3.ProgrammingError
 
 
+def publisher(url):
+    """ Return publisher of content, which is the host name in its URL
+    without the ``www.`` prefix """
+    if not url:
+        return None
+    host = urlparse(url).netloc.lower().split(':')[0]
+    if host.startswith('www.'):
+        host = host[4:]
+    return host or None
+
+
+def logvalue(v):
+    """ Return value in the same form as it is stored by sqlite3 """
+    if isinstance(v, datetime.datetime):
+        return v.isoformat(' ')
+    if isinstance(v, datetime.date):
+        return v.isoformat()
+    return v
+
+
+def parsetime(s):
+    """ Return timestamp stored by sqlite3 as datetime, or ``None`` """
+    if not s:
+        return None
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in s else '%Y-%m-%d %H:%M:%S'
+    return datetime.datetime.strptime(s, fmt)
+
+
+def record(action, **values):
+    """ Return broadcast record for given action (``ADD``, ``DEL`` or
+    ``EXP``) """
+    rec = dict((k, logvalue(v)) for k, v in values.items() if v is not None)
+    rec['action'] = action
+    return rec
+
+
 class DB:
+    """
+    Broadcast database
+
+    The connection uses write-ahead logging, and changes are not committed
+    until ``commit()`` or ``close()`` is called, so that several rows can be
+    written in a single transaction. Since the database file is committed to
+    the repository, ``close()`` must be called before that, which also moves
+    all changes from the write-ahead log into the database file.
+
+    If ``log`` is specified, each change is also recorded in the log file in
+    JSON lines format, which is appended to when changes are committed. The
+    database is brought up to date with the log when it is opened, so in
+    this case the database can be thrown away and rebuilt from the log at
+    any time. Log size is used to detect changes, and if the log is shorter
+    than it was at last commit (e.g., it was reverted), the database is
+    rebuilt from scratch.
+
+    With ``readonly``, the journal mode is left alone, so that a database
+    file in the repository is not changed by tools that only read from it.
+    Unless ``log`` is specified, the database file is also never created or
+    upgraded in this mode: a missing database is replaced by an empty one in
+    memory, and an outdated one is copied into memory and upgraded there.
+    ``migrated`` tells whether the schema was upgraded.
+    """
     TABLE = 'broadcasts'
     SCHEMA = """
     create table if not exists broadcasts (
@@ -37,37 +105,277 @@ class DB:
         expires timestamp
     );
     """
+    # Scripts that upgrade the schema, where the script at index N upgrades
+    # the database from version N to version N + 1
+    MIGRATIONS = [
+        """
+        create index if not exists broadcasts_content_server
+            on broadcasts (content_id, server_id, commit_hash);
+        create index if not exists broadcasts_server
+            on broadcasts (server_id);
+        create index if not exists broadcasts_aired on broadcasts (aired);
+        """,
+        # Indexes used by reports, with publisher taken from content URL
+        """
+        alter table broadcasts add column publisher text;
+        update broadcasts set publisher = url_publisher(url);
+        drop index if exists broadcasts_aired;
+        create index if not exists broadcasts_daily
+            on broadcasts (date(aired), server_id, size);
+        create index if not exists broadcasts_publisher
+            on broadcasts (publisher, aired, size);
+        create index if not exists broadcasts_live
+            on broadcasts (server_id, aired) where removed is null;
+        create index if not exists broadcasts_lag
+            on broadcasts ((julianday(aired) - julianday(collected)));
+        """,
+        # State of the database with respect to the broadcast log
+        """
+        create table if not exists state (
+            key text primary key,
+            value text
+        );
+        """,
+        # Live content that is set to expire, used by the expire tool
+        """
+        create index if not exists broadcasts_expires
+            on broadcasts (expires)
+            where removed is null and expires is not null;
+        """,
+    ]
+    # Expression used by queries that should use the broadcasts_lag index
+    LAG = '(julianday(aired) - julianday(collected))'
+
+    def __init__(self, db=None, log=None, readonly=False):
+        self.path = db or path.BROADCAST
+        self.log = log
+        # Log records of changes that were not committed yet
+        self.pending = []
+        snapshot = readonly and not log
+        if snapshot and not os.path.exists(self.path):
+            self.con = self.connect(':memory:')
+        else:
+            ddir = os.path.dirname(self.path)
+            if ddir and not os.path.isdir(ddir):
+                os.makedirs(ddir)
+            self.con = self.connect(self.path)
+        if snapshot and self.version < len(self.MIGRATIONS):
+            self.con = self.copy()
+        if not readonly:
+            self.con.execute('pragma journal_mode = wal')
+            # With WAL, this only syncs to disk on checkpoints, and the
+            # database is still consistent after a crash
+            self.con.execute('pragma synchronous = normal')
+        self.migrated = self.create_table()
+        if log:
+            self.replay()
+
+    @staticmethod
+    def connect(db):
+        con = sqlite3.connect(db)
+        con.row_factory = sqlite3.Row
+        con.create_function('url_publisher', 1, publisher)
+        return con
+
+    def copy(self):
+        """ Close the connection and return a connection to a copy of the
+        database in memory """
+        version = self.version
+        con = self.connect(':memory:')
+        con.executescript('\n'.join(self.con.iterdump()))
+        con.execute('pragma user_version = {}'.format(version))
+        self.con.close()
+        return con
 
-    def __init__(self, db=path.BROADCAST):
-        self.con = sqlite3.connect(db)
-        self.con.row_factory = sqlite3.Row
-        self.create_table()
+    @property
+    def version(self):
+        return self.con.execute('pragma user_version').fetchone()[0]
 
     def create_table(self):
         self.con.executescript(self.SCHEMA)
+        return self.migrate()
+
+    def migrate(self):
+        """ Apply any migrations that were not applied yet, and return whether
+        there were any """
+        start = self.version
+        for version in range(start, len(self.MIGRATIONS)):
+            self.con.executescript(self.MIGRATIONS[version])
+            self.con.execute('pragma user_version = {}'.format(version + 1))
+            self.con.commit()
+        return start < len(self.MIGRATIONS)
 
     def add_content(self, id, server, commit, title, url, size, collected,
                     packed, aired, expires=None):
-        q = sql.Insert(self.TABLE, cols=(
-            'content_id', 'server_id', 'commit_hash', 'title', 'url', 'size',
-            'collected', 'packed', 'aired', 'expires'))
-        self.con.execute(str(q), {
-            'content_id': id,
-            'server_id': server,
-            'commit_hash': commit,
-            'title': title,
-            'url': url,
-            'size': size,
-            'collected': collected,
-            'packed': packed,
-            'aired': aired,
-            'expires': expires,
-        })
+        self.write(record('ADD', content_id=id, server_id=server,
+                          commit_hash=commit, title=title, url=url, size=size,
+                          collected=collected, packed=packed, aired=aired,
+                          expires=expires, publisher=publisher(url)))
+
+    def remove_content(self, id, server):
+        self.write(record('DEL', content_id=id, server_id=server,
+                          removed=datetime.datetime.today()))
+
+    def set_expiry(self, id, server, expires):
+        """ Set expiry time of content that is on the server """
+        self.write(record('EXP', content_id=id, server_id=server,
+                          expires=expires))
+
+    def write(self, rec):
+        self.apply(rec)
+        if self.log:
+            self.pending.append(rec)
+
+    def apply(self, rec):
+        """ Apply broadcast record to the database """
+        rec = dict(rec)
+        action = rec.pop('action')
+        live = ['content_id=:content_id', 'server_id=:server_id',
+                'removed is null']
+        if action == 'ADD':
+            q = sql.Insert(self.TABLE, cols=sorted(rec))
+        elif action == 'DEL':
+            q = sql.Update(self.TABLE, live, removed=':removed')
+        elif action == 'EXP':
+            q = sql.Update(self.TABLE, live, expires=':expires')
+        else:
+            raise ValueError('unknown broadcast action {}'.format(action))
+        self.con.execute(str(q), rec)
+
+    def getstate(self, key):
+        row = self.con.execute('select value from state where key = ?',
+                               (key,)).fetchone()
+        return None if row is None else row['value']
+
+    def setstate(self, key, value):
+        self.con.execute('insert or replace into state values (?, ?)',
+                         (key, value))
+
+    def replay(self):
+        """ Apply log records that were added since last commit """
+        try:
+            size = os.path.getsize(self.log)
+        except path.FILE_ERRORS:
+            # Create the log so that it can be committed even if empty
+            open(self.log, 'a').close()
+            size = 0
+        stored = self.getstate('log_size')
+        offset = None if stored is None else int(stored)
+        if offset == size:
+            return
+        if offset is None or offset > size:
+            self.con.execute('delete from {}'.format(self.TABLE))
+            offset = 0
+        with open(self.log, 'r') as f:
+            f.seek(offset)
+            for l in f:
+                if l.strip():
+                    self.apply(json.loads(l))
+        self.setstate('log_size', size)
         self.con.commit()
-        self.con.close()
 
-    def remove_content(self, id):
-        q = sql.Update(self.TABLE, 'content_id=:id', removed=':time')
-        self.con.execute(str(q), {'id': id, 'time': datetime.datetime.today()})
+    def is_aired(self, id, server, commit):
+        """ Check whether given commit of the content is on the server """
+        q = sql.Select('1', sets=self.TABLE, where=[
+            'content_id=:id', 'server_id=:server', 'commit_hash=:commit',
+            'removed is null'], limit=1)
+        cur = self.con.execute(str(q), {'id': id, 'server': server,
+                                        'commit': commit})
+        return cur.fetchone() is not None
+
+    def expired(self, now):
+        """ Return (content ID, server) pairs of live content that expired
+        by ``now``, in order of expiry
+
+        Content is not considered expired if it was aired on the server again
+        without an expiry time, or with one that is still in the future.
+        """
+        renewed = ('not exists (select 1 from broadcasts as l '
+                   'where l.content_id = b.content_id '
+                   'and l.server_id = b.server_id and l.removed is null '
+                   'and (l.expires is null or l.expires > :now))')
+        # Without a hint, the planner prefers the index that matches the
+        # grouping, and ends up scanning the whole table
+        q = sql.Select(['content_id', 'server_id', 'min(expires) as first'],
+                       sets=self.TABLE + ' as b indexed by broadcasts_expires',
+                       where=['removed is null', 'expires <= :now', renewed],
+                       group=['content_id', 'server_id'],
+                       order=['first', 'content_id', 'server_id'])
+        cur = self.con.execute(str(q), {'now': logvalue(now)})
+        return [(row['content_id'], row['server_id']) for row in cur]
+
+    def next_expiry(self, now):
+        """ Return expiry time of live content that is the next to expire
+        after ``now``, or ``None`` """
+        q = sql.Select('min(expires) as first', sets=self.TABLE, where=[
+            'removed is null', 'expires > :now'])
+        row = self.con.execute(str(q), {'now': logvalue(now)}).fetchone()
+        return parsetime(row['first'])
+
+    def commit(self):
+        """ Append pending records to the log and commit the transaction
+
+        Records are synced to disk before the transaction is committed, so
+        the log never falls behind the database.
+        """
+        if self.pending:
+            with open(self.log, 'a') as f:
+                f.write(''.join(json.dumps(r, sort_keys=True) + '\n'
+                                for r in self.pending))
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            self.pending = []
+            self.setstate('log_size', size)
         self.con.commit()
+
+    def rollback(self):
+        self.pending = []
+        self.con.rollback()
+
+    def close(self):
+        """ Commit changes and close the connection """
+        self.commit()
         self.con.close()
+
+
+def export(d, f):
+    """ Write all rows of the database to file as log records """
+    for row in d.con.execute('select * from {} order by rowid'.format(
+            d.TABLE)):
+        f.write(json.dumps(record('ADD', **dict(zip(row.keys(), row))),
+                           sort_keys=True) + '\n')
+
+
+def load(dbpath, logpath):
+    """ Build a database at ``dbpath`` from the log at ``logpath`` """
+    d = DB(dbpath, log=logpath)
+    d.close()
+
+
+_db = None
+
+
+def connect(readonly=False):
+    """ Return the broadcast database, opening it on first use
+
+    Tools that only read from the database should pass ``readonly`` (see
+    ``DB``), so that they leave the database in the repository untouched.
+    """
+    global _db
+    dbpath = path.broadcastdb()
+    if _db is None or _db.path != dbpath:
+        close()
+        log = path.BROADCAST_LOG if path.broadcastmode() == path.LOGMODE \
+            else None
+        _db = DB(dbpath, log, readonly)
+    return _db
+
+
+@atexit.register
+def close():
+    """ Commit and close the broadcast database if it is open """
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+Remove expired content from servers
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+Expiry times are set by ``srvsync --ttl`` and stored in the broadcast
+database, where live content that is set to expire is indexed by expiry time,
+so finding expired content and the time of the next expiry does not require
+scanning the whole database. Expired content is removed from servers in the
+same way as ``srvdel`` does it, and the removals are synced to the servers by
+the next ``srvsync``.
+"""
+
+import os
+import time
+import datetime
+from collections import OrderedDict
+
+import conz
+
+from . import db
+from . import git
+from . import path
+from . import index
+from . import backlog
+from . import serverdel
+
+
+# Default maximum number of seconds the daemon sleeps between checks
+MAX_SLEEP = 3600
+
+# Minimum number of seconds the daemon sleeps between checks
+MIN_SLEEP = 1
+
+cn = conz.Console()
+
+
+def expired(servers=None, now=None):
+    """ Return (content ID, server) pairs of content that expired by ``now``
+    and is still on the server
+
+    Content that was already removed from the server, but whose removal was
+    not synced yet, is not included.
+    """
+    now = now or datetime.datetime.utcnow()
+    d = db.connect(readonly=True)
+    return [(cid, srv) for cid, srv in d.expired(now)
+            if (not servers or srv in servers) and
+            os.path.islink(path.contentdir(cid, server=srv))]
+
+
+def remove(pairs, batch_size=None):
+    """ Remove content from servers given a list of (content ID, server)
+    pairs """
+    servers = OrderedDict()
+    for cid, srv in pairs:
+        servers.setdefault(cid, []).append(srv)
+    with git.batch(batch_size):
+        for cid, srvs in servers.items():
+            if serverdel.remove_from_servers(cid, srvs):
+                cn.pstd(cn.color.yellow('{}: WARN'.format(cid)))
+            else:
+                cn.pstd(cn.color.green('{}: OK'.format(cid)))
+
+
+def delay(max_sleep=MAX_SLEEP, now=None):
+    """ Return number of seconds until the next content expires, but no more
+    than ``max_sleep`` """
+    now = now or datetime.datetime.utcnow()
+    nxt = db.connect(readonly=True).next_expiry(now)
+    if nxt is None:
+        return max_sleep
+    secs = (nxt - now).total_seconds()
+    return max(MIN_SLEEP, min(max_sleep, secs))
+
+
+def reload():
+    """ Discard state that other tools may have changed since it was loaded """
+    git.session().reload()
+    backlog.reload()
+    index.reload()
+    db.close()
+
+
+def daemon(servers=None, batch_size=None, max_sleep=MAX_SLEEP):
+    """ Remove content as it expires until interrupted """
+    while True:
+        reload()
+        # Same time is used for both queries, so that content that expires
+        # in between is not missed
+        now = datetime.datetime.utcnow()
+        pairs = expired(servers, now)
+        if pairs:
+            remove(pairs, batch_size)
+            git.flush()
+            backlog.save()
+            index.save()
+        secs = delay(max_sleep, now)
+        cn.pverb('Next check in {:.0f} seconds'.format(secs))
+        time.sleep(secs)
+
+
+def main():
+    from . import args
+
+    parser = args.getparser('Remove expired content from servers',
+                            has_verbose=True, has_batch=True)
+    parser.add_argument('--servers', '-s', metavar='SERVER', nargs='+',
+                        help='only remove content from these servers')
+    parser.add_argument('--apply', '-a', action='store_true',
+                        help='remove expired content instead of listing it')
+    parser.add_argument('--daemon', '-d', action='store_true',
+                        help='keep running and remove content as soon as it '
+                        'expires (implies --apply)')
+    parser.add_argument('--max-sleep', metavar='SECONDS', type=float,
+                        default=MAX_SLEEP, help='maximum time between '
+                        'checks in daemon mode (default: %(default)s)')
+    args = parser.parse_args()
+
+    cn.verbose = args.verbose
+
+    if args.servers:
+        serverdel.validate_servers(args.servers)
+
+    if not os.path.exists(path.broadcastrecord()):
+        cn.perr('Broadcast database not found')
+        cn.quit(1)
+
+    batch_size = args.batch_size if args.batch else None
+
+    try:
+        if args.daemon:
+            daemon(args.servers, batch_size, args.max_sleep)
+        pairs = expired(args.servers)
+        if args.apply:
+            remove(pairs, batch_size)
+        elif args.servers and len(args.servers) == 1:
+            # Can be piped into srvdel
+            for cid, srv in pairs:
+                cn.pstd(cid)
+        else:
+            for cid, srv in pairs:
+                cn.pstd('{} {}'.format(cid, srv))
+    except db.OperationalError as err:
+        cn.pverr('expire', err)
+        cn.quit(1)
+    except KeyboardInterrupt:
+        cn.quit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,70 +11,270 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import os
-import re
+import json
+import itertools
+import multiprocessing
 
 import conz
 
 from . import path
 from . import data
+from . import sizes
+from . import query
 from . import jsonf
+from . import catalog
 
 cn = conz.Console()
 
-SIZES = {
-    'b': 1,
-    'k': 1024,
-    'm': 1024 * 1024,
-}
+CHUNK = 1000  # number of paths read or handed to worker pool at once
 
-def load_file(p):
+# Matcher used by worker processes
+_match = None
+_sizeonly = False
+
+# Size cache, created on first use, or by initworker() in worker processes
+_sizes = None
+
+
+def poolcid(p):
+    """ Return content ID if ``p`` is a content directory or metadata file in
+    the pool, or ``None`` """
+    cdir = os.path.dirname(path.infopath(p))
+    name = os.path.basename(os.path.abspath(cdir))
+    if path.cid(name) != name:
+        return None
+    if os.path.realpath(cdir) != os.path.realpath(path.contentdir(name)):
+        return None
+    return name
+
+
+def getsizes():
+    global _sizes
+    if _sizes is None:
+        _sizes = sizes.Sizes()
+    return _sizes
+
+
+def prefetch(s, paths):
+    """ Look up size cache state of content in the pool in a single pass, and
+    return content IDs of the paths """
+    cids = [poolcid(p) for p in paths]
+    s.load(cid for cid in cids if cid)
+    return cids
+
+
+def contentsize(p):
+    """ Return content size, using the size cache for content in the pool """
+    cid = poolcid(p)
+    if not cid:
+        return data.getsize(os.path.dirname(path.infopath(p)))
+    return getsizes().size(cid)
+
+
+def getmatcher(args):
+    """ Create a match function based on command line arguments
+
+    The returned function takes metadata and a function that returns content
+    size, just like the functions returned by ``query.compile()``. Keywords
+    are converted only once, regardless of the number of paths.
+    """
+    if args.query:
+        return query.compile(args.query, icase=args.i)
+    if args.key == 'size':
+        val = data.parse_size(args.keyword)
+        return lambda d, size: (size() > val) ^ args.exclude
+    match = data.matcher(args.key, args.keyword, args.t, xmatch=args.x,
+                         icase=args.i, gt=args.gt, lt=args.lt,
+                         invert=args.exclude)
+    return lambda d, size: match(d)
+
+
+def issizeonly(args):
+    return args.key == 'size' and not args.query
+
+
+def usessize(args):
+    if args.query:
+        return query.SIZE in query.keys(args.query)
+    return issizeonly(args)
+
+
+def evaluate(p, match, sizeonly=False):
+    """ Return the path that should be printed if ``p`` matches
+
+    If there is no match, ``None`` is returned. ``jsonf.LoadError`` is raised
+    if metadata cannot be loaded.
+    """
+    if sizeonly:
+        # Size-only match does not need the metadata
+        if match(None, lambda: contentsize(p)):
+            return path.infopath(p)
+        return None
+    d = jsonf.load(path.infopath(p))
+    if match(d, lambda: contentsize(p)):
+        return p
+    return None
+
+
+def domatch(p, match, sizeonly=False):
     try:
-        return jsonf.load(p)
+        ret = evaluate(p, match, sizeonly)
     except jsonf.LoadError:
-        cn.pverr(p, 'bad metadata file')
+        cn.pverr(path.infopath(p), 'bad metadata file')
         cn.quit(1)
+    if ret:
+        cn.pstd(ret)
 
 
-def size(p, size, invert=False):
-    if os.path.basename(p) == 'info.json':
-        path = p[:-9]
-    else:
-        p = os.path.join(p, 'info.json')
-        path = p
+def initworker(args):
+    """ Set up a worker process """
+    global _match, _sizeonly
+    _match = getmatcher(args)
+    _sizeonly = issizeonly(args)
+
+
+def check(item):
+    """ Evaluate a single path in a worker process
+
+    The item is a tuple of the path and size cache state of its content (or
+    ``None``), which is looked up by the parent, so that workers do not
+    invoke git. Returns a tuple of the path to print (or ``None``) and path
+    that failed to load (or ``None``).
+    """
+    p, state = item
+    if state is not None:
+        getsizes().update(state)
     try:
-        # Finds the first non-digit, finds the first character of those, and
-        # slices that first character out of size
-        bytesize = size[re.search('\D', size).span()[0]].lower()
-    except AttributeError:
-        bytesize = 'b'
-    val = int(re.search('\d', size).group(0)) * SIZES[bytesize]
-    if data.sizematch(path, val, invert):
-        cn.pstd(p)
+        return evaluate(p, _match, _sizeonly), None
+    except jsonf.LoadError:
+        return None, path.infopath(p)
+
+
+def parmatch(src, args):
+    """ Evaluate paths using a pool of ``args.jobs`` worker processes
+
+    Paths are read from ``src`` in chunks so that memory use does not depend
+    on the number of paths. Results are printed in input order unless
+    ``args.unordered`` is set.
+    """
+    size = usessize(args)
+    pool = multiprocessing.Pool(args.jobs, initworker, (args,))
+    imap = pool.imap_unordered if args.unordered else pool.imap
+    src = (p.strip() for p in src)
+    try:
+        while True:
+            chunk = list(itertools.islice(src, CHUNK))
+            if not chunk:
+                break
+            if size:
+                s = sizes.Sizes()
+                states = [s.state([cid]) if cid else None
+                          for cid in prefetch(s, chunk)]
+            else:
+                states = [None] * len(chunk)
+            chunksize = max(1, len(chunk) // (args.jobs * 4))
+            items = zip(chunk, states)
+            for ret, err in imap(check, items, chunksize):
+                if err:
+                    cn.pverr(err, 'bad metadata file')
+                    pool.terminate()
+                    cn.quit(1)
+                if ret:
+                    cn.pstd(ret)
+    finally:
+        pool.terminate()
+        pool.join()
+
 
+def catconditions(args):
+    """ Return a tuple of SQL condition and parameters that matches the same
+    catalog rows as the matcher, or ``None`` if there is no SQL equivalent """
+    try:
+        if args.query:
+            return query.tosql(args.query, catalog.TEXT_KEYS, args.i)
+        if args.key == 'size':
+            cond = '(size is not null and size > ?)'
+            params = [data.parse_size(args.keyword)]
+        elif args.t:
+            return None
+        else:
+            builder = query.Conditions(catalog.TEXT_KEYS, args.i)
+            cond = builder.string(args.key, '=' if args.x else '~',
+                                  args.keyword)
+            params = builder.params
+    except query.QueryError:
+        return None
+    if args.exclude:
+        cond = '(NOT {})'.format(cond)
+    return cond, params
 
-def domatch(p, args):
-    infopath = path.infopath(p)
-    d = load_file(infopath)
-    if data.match(d, args.key, args.keyword, args.t, xmatch=args.x,
-                  icase=args.i, gt=args.gt, lt=args.lt, invert=args.exclude):
-        cn.pstd(p)
+
+def catmatch(src, args, match, cat):
+    """ Match against data stored in the metadata catalog
+
+    The match is performed in SQL when possible. Otherwise, metadata is built
+    from key columns if the match only uses those, and decoded only when it
+    does not. Matching paths are printed in input order.
+    """
+    paths = [p.strip() for p in src]
+    cids = [path.cid(p) for p in paths]
+    sql = catconditions(args)
+    if sql:
+        # Irregular rows are matched against their metadata below
+        where, params = 'irregular or {}'.format(sql[0]), sql[1]
+    else:
+        where, params = '1', ()
+    keys = query.keys(args.query) if args.query else set([args.key])
+    fromcolumns = keys <= set(catalog.KEYS + (query.SIZE,))
+    cat.select(c for c in cids if c)
+    found = set(r[0] for r in cat.selected(columns='content_id'))
+    matched = set()
+    for row in cat.selected(where, params):
+        cid = row['content_id']
+        if row['irregular']:
+            d = json.loads(row['metadata'])
+        elif sql:
+            matched.add(cid)
+            continue
+        elif fromcolumns:
+            d = catalog.rowdata(row)
+        else:
+            d = json.loads(row['metadata'])
+        if match(d, lambda: row['size']):
+            matched.add(cid)
+    for p, cid in zip(paths, cids):
+        if cid not in found:
+            cn.pverr(p, 'not found in catalog')
+        elif cid in matched:
+            cn.pstd(p)
 
 
 def main():
     from . import args
 
-    OPTS = '[-h] [-V] [-x] [-i] [-gt] [-lt] [-t TYPE] KEY KEYWORD'
+    OPTS = '[-h] [-V] [-x] [-i] [-gt] [-lt] [-t TYPE] [-c]'
+    QOPTS = '[-h] [-V] [-i] [-c] -q QUERY'
     parser = args.getparser(
         'Match within JSON key values',
-        usage='%(prog)s {0} [PATH]\n       PATH | %(prog)s {0}'.format(OPTS))
-    parser.add_argument('key', metavar='KEY', help='key within the JSON data -'
-                        ' also takes "size" which finds anything larger than '
-                        'the keyword which looks like "10Kb"')
-    parser.add_argument('keyword', metavar='KEYWORD', help='search keyword')
+        usage='%(prog)s {0} KEY KEYWORD [PATH]\n'
+        '       PATH | %(prog)s {0} KEY KEYWORD\n'
+        '       %(prog)s {1} [PATH]\n'
+        '       PATH | %(prog)s {1}'.format(OPTS, QOPTS))
+    parser.add_argument('key', metavar='KEY', nargs='?',
+                        help='key within the JSON data - also takes "size" '
+                        'which finds anything larger than the keyword which '
+                        'looks like "10Kb" (omitted when using --query)')
+    parser.add_argument('keyword', metavar='KEYWORD', nargs='?',
+                        help='search keyword (omitted when using --query)')
     parser.add_argument('paths', metavar='PATH', help='JSON file or content '
                         'directory (dfaults to info.json in current '
-                        'directory, ignored when used in a pipe)',
-                        default=['./info.json'], nargs='*')
+                        'directory, ignored when used in a pipe)', nargs='*')
+
+    # Query mode
+    parser.add_argument('-q', '--query', metavar='QUERY',
+                        help='match all metadata against a query expression '
+                        'such as \'title~news AND NOT is_partner:b=yes\' '
+                        'in a single pass (see broadman.query for syntax)')
 
     # Match type
     parser.add_argument('-x', action='store_true',
@@ -94,18 +294,59 @@ def main():
                         'YYYY-MM-DD format, t for timestamp in YYYY-MM-DD '
                         'HH:MM:SS format, n for numeric, b for boolean)',
                         metavar='TYPE', default=None)
+
+    # Data source
+    parser.add_argument('-c', '--catalog', action='store_true',
+                        help='match against data in the metadata catalog '
+                        'instead of reading metadata files (catalog must be '
+                        'refreshed using mrefresh)', default=False)
+
+    # Parallel processing
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='number of worker processes used to load and '
+                        'match metadata (default: %(default)s, ignored with '
+                        '--catalog)')
+    parser.add_argument('-u', '--unordered', action='store_true',
+                        help='with --jobs, print matches as soon as they are '
+                        'found instead of in input order', default=False)
     args = parser.parse_args()
 
+    if args.query:
+        # There is no KEY and KEYWORD in query mode, so those are paths
+        args.paths = [p for p in (args.key, args.keyword) if p] + args.paths
+    elif args.keyword is None:
+        parser.error('KEY and KEYWORD are required')
+
+    try:
+        match = getmatcher(args)
+    except ValueError as err:
+        cn.perr('Invalid query: {}'.format(err))
+        cn.quit(1)
+
     if cn.interm:
-        src = args.paths
+        src = args.paths or ['./info.json']
     else:
         src = cn.readpipe()
 
-    for p in src:
-        if args.key == 'size':
-            size(p.strip(), args.keyword, args.exclude)
-        else:
-            domatch(p.strip(), args)
+    if args.catalog:
+        catmatch(src, args, match, catalog.Catalog())
+        return
+
+    if args.jobs > 1:
+        parmatch(src, args)
+        return
+
+    sizeonly = issizeonly(args)
+    size = usessize(args)
+    src = (p.strip() for p in src)
+    while True:
+        chunk = list(itertools.islice(src, CHUNK))
+        if not chunk:
+            break
+        if size:
+            prefetch(getsizes(), chunk)
+        for p in chunk:
+            domatch(p, match, sizeonly)
 
 
 if __name__ == '__main__':
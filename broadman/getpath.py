@@ -14,16 +14,14 @@ import os
 
 import conz
 
-from . import path
+from . import index
 
 
 cn = conz.Console()
 
-CHUNK = 1000  # process no more than this many paths at once
-
 
 def convert(server, cids, meta_path=False):
-    for p in path.find_contentdirs(cids, server=server):
+    for p in index.find_contentdirs(cids, server=server):
         if meta_path:
             p = os.path.join(p, 'info.json')
         cn.pstd(os.path.abspath(p))
@@ -44,10 +42,18 @@ def main():
     parser.add_argument('--meta', '-m', action='store_true',
                         help='print path to metadata file instead of content '
                         'directory')
+    parser.add_argument('--reindex', action='store_true',
+                        help='rebuild the content ID index for the server '
+                        'before looking up paths')
     args = parser.parse_args()
 
+    if args.reindex:
+        index.rebuild(args.server)
+
     if os.isatty(0):
         convert(args.server, args.cids, args.meta)
     else:
-        for cids in cn.readpipe(CHUNK):
-            convert(args.server, cids, args.meta)
+        # Index lookups are cheap, so there is no need to read the pipe in
+        # chunks
+        for cid in cn.readpipe():
+            convert(args.server, [cid], args.meta)
@@ -9,13 +9,17 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import os
+import atexit
+import bisect
 import shutil
-from os.path import abspath, join
+import contextlib
+from os.path import abspath, join, relpath
 
 from git import Repo, Actor
+from git.exc import (InvalidGitRepositoryError, NoSuchPathError,
+                     GitCommandError)
 
 from . import path
-from . import __version__
 
 
 MSG_MARKER = '[OBM]'
@@ -23,25 +27,172 @@ AUTHOR = Actor("Outernet Broadman", "apps@outernet.is")
 
 
 class Git():
-    def __init__(self):
-        repo = Repo(abspath(path.POOLDIR))
-        index = repo.index
-        self.add = index.add
-        self.git = repo.git
-        self.commit = index.commit
-        self.remove = index.remove
+    """
+    Repository handle that is shared by all git functions in a process
 
+    The repository and its index are opened once and reused. Files are added
+    to the in-memory index, and the index file is only written when a git
+    command needs to see it, or when the process exits, so that committing
+    many items in a row does not read and write the index for each item.
+    """
 
-def init():
+    def __init__(self):
+        self.path = abspath(path.POOLDIR)
+        self.repo = Repo(self.path)
+        self._index = None
+        # Sorted paths of index entries, built on first recursive removal
+        self._paths = None
+        self.dirty = False
+        # Paths and commit subjects of the open batch, or ``None`` outside of
+        # a batch
+        self.batch = None
+        self.batch_size = 0
+        # Latest commit hashes of content directories, keyed by absolute path
+        self.latest = {}
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = self.repo.index
+        return self._index
+
+    @property
+    def git(self):
+        """ Git command wrapper, with pending index changes written out """
+        self.flush()
+        return self.repo.git
+
+    def add(self, items):
+        added = self.index.add(items, write=False)
+        if self._paths is not None:
+            for entry in added:
+                i = bisect.bisect_left(self._paths, entry.path)
+                if i == len(self._paths) or self._paths[i] != entry.path:
+                    self._paths.insert(i, entry.path)
+        self.dirty = True
+
+    def remove(self, items, r=False):
+        """ Remove paths from the index without touching the working tree
+
+        If ``r`` is ``True``, everything under given paths is also removed.
+        Entries are looked up by key, and entries under a path are found in
+        the sorted list of entry paths, so that the cost does not depend on
+        the size of the index.
+        """
+        entries = self.index.entries
+        for p in items:
+            p = relpath(abspath(p), self.path).replace(os.sep, '/')
+            paths = [p] + (self.pop_paths(p + '/') if r else [])
+            for epath in paths:
+                for stage in range(4):
+                    entries.pop((epath, stage), None)
+        self.dirty = True
+
+    def pop_paths(self, prefix):
+        """ Remove paths starting with ``prefix`` from the sorted list of
+        entry paths and return them """
+        if self._paths is None:
+            self._paths = sorted(set(k[0] for k in self.index.entries))
+        i = bisect.bisect_left(self._paths, prefix)
+        j = i
+        while j < len(self._paths) and self._paths[j].startswith(prefix):
+            j += 1
+        found = self._paths[i:j]
+        del self._paths[i:j]
+        return found
+
+    def commit(self, msg, paths=[]):
+        """ Commit the index and note the commit as latest for ``paths`` """
+        c = self.index.commit(msg)
+        for p in paths:
+            if path.cid(os.path.basename(p)):
+                self.latest[p] = c.hexsha
+        return c
+
+    def flush(self):
+        """ Write the index to disk if it has been modified """
+        if self.dirty:
+            self.index.write()
+            self.dirty = False
+
+    def reload(self):
+        """ Discard the in-memory index after a command that modified it """
+        self.flush()
+        self._index = None
+        self._paths = None
+
+
+_session = None
+
+
+def session():
+    """ Return the shared repository handle, opening it on first use """
+    global _session
+    if _session is None or _session.path != abspath(path.POOLDIR):
+        flush()
+        _session = Git()
+    return _session
+
+
+@atexit.register
+def flush():
+    """ Write pending index changes to disk """
+    if _session is not None:
+        _session.flush()
+
+
+def ignored():
+    """ Return .gitignore entries that keep derived data, such as indexes, and
+    the write-ahead log of the broadcast database out of the repository """
+    entries = ['/' + os.path.basename(path.CACHEDIR) + '/']
+    for suffix in ('-wal', '-shm'):
+        entries.append('/' + os.path.basename(path.BROADCAST) + suffix)
+    return entries
+
+
+def ignore_derived():
+    """ Add .gitignore entries that are missing in pools created by older
+    versions, and commit .gitignore alone
+
+    This is called by tools that write to the pool, so that tools that only
+    read from it never commit.
+    """
+    g = session()
+    ifile = join(g.path, '.gitignore')
+    try:
+        with open(ifile, 'r') as f:
+            text = f.read()
+    except path.FILE_ERRORS:
+        text = ''
+    lines = set(l.strip() for l in text.splitlines())
+    missing = [e for e in ignored() if e not in lines]
+    if not missing:
+        return
+    if text and not text.endswith('\n'):
+        missing.insert(0, '')
+    with open(ifile, 'a') as f:
+        f.write('\n'.join(missing) + '\n')
+    cmsg = ' '.join([MSG_MARKER, 'IGN', 'POOL'])
+    g.git.add(ifile)
+    # Committing only the path leaves anything else in the index staged
+    g.git.commit(ifile, m=cmsg + '\n\nIgnore derived data')
+    g.reload()
+
+
+def init(layout=path.FLAT):
     """ Initializes the git repo for the pool """
     p = abspath(path.POOLDIR)
     git = Repo.init(p)
 
-    # Initialize repo with .version file
-    vfile = join(p, '.version')
-    with open(vfile, 'w') as f:
-        f.write(__version__ + '\n')
-    git.index.add([vfile])
+    # Initialize repo with .version file, which also records the layout
+    vfile = abspath(path.VERSION)
+    path.write_options({'layout': layout})
+    # Keep derived data such as indexes, and the write-ahead log of the
+    # broadcast database out of the repository
+    ifile = join(p, '.gitignore')
+    with open(ifile, 'w') as f:
+        f.write(''.join(e + '\n' for e in ignored()))
+    git.index.add([vfile, ifile])
     git.index.commit('Initialized content pool', author=AUTHOR)
 
     # Add master dir and remove placeholder file, leave staged to be committed
@@ -57,33 +208,191 @@ def init():
     git.index.remove([holder])
 
 
-def has_changes(p):
-    g = Git()
-    """ Check whether some path contains changes """
-    return g.git.status(p, s=True)
+def has_changes(*paths):
+    """ Check whether some paths contain changes """
+    g = session()
+    return g.git.status('--', *paths, s=True)
+
 
+def get_history(p, n=None):
+    """ Get hashes of commits that touched a given path, newest first
 
-def get_history(p):
-    g = Git()
-    """ Get all commit hashes for a given path as a list """
-    hashes = g.git.log(pretty='format:%H')
-    return hashes.split('\n')
+    If ``n`` is specified, at most ``n`` hashes are returned.
+    """
+    g = session()
+    kwargs = {'pretty': 'format:%H'}
+    if n:
+        kwargs['n'] = n
+    hashes = g.git.log('--', abspath(p), **kwargs)
+    return [h for h in hashes.split('\n') if h]
 
 
-def commit(p, action, msg=None, extra_data=[], noadd=False):
-    g = Git()
+def latest_hash(p):
+    """ Get hash of the last commit that touched a given path or ``None``
+
+    Hashes of content directories are remembered, and updated when they are
+    committed, so that repeated lookups do not need to query git.
+    """
+    g = session()
+    p = abspath(p)
+    if p in g.latest:
+        return g.latest[p]
+    history = get_history(p, 1)
+    sha = history[0] if history else None
+    if sha and path.cid(os.path.basename(p)):
+        g.latest[p] = sha
+    return sha
+
+
+def previous_hash(p):
+    """ Get hash of the second to last commit that touched a given path or
+    ``None`` """
+    history = get_history(p, 2)
+    if len(history) < 2:
+        return None
+    return history[1]
+
+
+def commit_times(shas):
+    """ Get commit times of given commits as Unix timestamps keyed by hash
+
+    Commits are looked up in as few git invocations as possible.
+    """
+    g = session()
+    shas = sorted(set(shas))
+    times = {}
+    for i in range(0, len(shas), 1000):
+        out = g.git.show(*shas[i:i + 1000], s=True, format='%H %ct')
+        for l in out.splitlines():
+            if l.strip():
+                sha, ts = l.split()
+                times[sha] = int(ts)
+    return times
+
+
+def head():
+    """ Get hash of the current HEAD commit """
+    g = session()
+    return g.git.rev_parse('HEAD')
+
+
+def tree_hash(p):
+    """ Return hash of the tree committed at ``p`` in HEAD, or ``None`` if
+    there is no such tree or no repository """
+    try:
+        g = session()
+        rel = relpath(abspath(p), g.path).replace(os.sep, '/')
+        return g.repo.head.commit.tree[rel].hexsha
+    except (InvalidGitRepositoryError, NoSuchPathError, ValueError, KeyError):
+        return None
+
+
+def tree_changes(old, new):
+    """ Get paths that differ between two trees, relative to the trees, or
+    ``None`` if the trees cannot be compared """
+    try:
+        out = session().git.diff(old, new, name_only=True, no_renames=True)
+    except (InvalidGitRepositoryError, NoSuchPathError, GitCommandError):
+        return None
+    return [l for l in out.split('\n') if l]
+
+
+def list_trees(paths):
+    """ Get committed tree hashes of given paths as (path, hash) pairs
+
+    Paths that are not committed trees are left out.
+    """
+    g = session()
+    out = g.git.ls_tree('HEAD', '--', *[abspath(p) for p in paths],
+                        full_name=True)
+    for l in out.split('\n'):
+        if not l:
+            continue
+        info, tpath = l.split('\t', 1)
+        mode, kind, sha = info.split()
+        if kind == 'tree':
+            yield tpath, sha
+
+
+def latest_hashes(p, rev=None):
+    """ Get hashes of the last commits that touched content under ``p``
+    keyed by content ID
+
+    If ``rev`` is specified, only commits since ``rev`` are considered. All
+    hashes are obtained in a single git invocation.
+    """
+    g = session()
+    span = [rev + '..HEAD'] if rev else []
+    out = g.git.log(*(span + ['--', abspath(p)]), format='commit %H',
+                    name_only=True)
+    hashes = {}
+    sha = None
+    for l in out.split('\n'):
+        if l.startswith('commit '):
+            sha = l.split()[1]
+            continue
+        cid = path.cid(l)
+        if cid and cid not in hashes:
+            hashes[cid] = sha
+    return hashes
+
+
+def commit(p, action, msg=None, extra_data=[], noadd=False, cid=None):
+    g = session()
     p = abspath(p)
     if not noadd:
         g.add([p])
-    cid = path.cid(p)
+    cid = cid or path.cid(p)
     if not cid:
         cid = 'BACKLOG'
     cmsg = [MSG_MARKER, action, cid]
     cmsg.extend(extra_data)
     cmsg = ' '.join(cmsg)
+    if g.batch is not None:
+        g.batch.append((p, cmsg))
+        if len(g.batch) >= g.batch_size:
+            commit_batch()
+        return
     if msg:
         cmsg += '\n\n' + msg
-    g.commit(cmsg)
+    g.commit(cmsg, [p])
+
+
+def commit_batch():
+    """ Commit all changes staged in the current batch """
+    g = session()
+    if not g.batch:
+        return
+    paths, subjects = zip(*g.batch)
+    g.batch = []
+    cmsg = ' '.join([MSG_MARKER, 'BAT', 'BATCH', str(len(subjects))])
+    g.commit(cmsg + '\n\n' + '\n'.join(subjects), paths)
+
+
+@contextlib.contextmanager
+def batch(size):
+    """ Group commits made within the block into batch commits
+
+    Changes are staged as usual, but instead of committing each of them, a
+    single ``BAT`` commit is made for every ``size`` changes, and one more
+    for any changes that remain when the block exits. The body of a batch
+    commit lists the subject lines of the commits it replaces, one per line.
+
+    If ``size`` is 0 or ``None``, commits are not grouped.
+    """
+    g = session()
+    if not size or g.batch is not None:
+        yield
+        return
+    g.batch = []
+    g.batch_size = size
+    try:
+        yield
+    finally:
+        # Whatever was staged has already been changed on disk, so it is
+        # committed even if the block failed
+        commit_batch()
+        g.batch = None
 
 
 def commit_import(p):
@@ -97,16 +406,16 @@ def commit_add_to_server(p, server):
 
 
 def commit_remove_from_server(p, server):
-    g = Git()
-    g.remove([p], cached=True)
+    g = session()
+    g.remove([p])
     cid = path.cid(p)
     msg = 'Removed {} <- {}'.format(cid, server)
     commit(p, action='DEL', msg=msg, extra_data=[server], noadd=True)
 
 
 def commit_update(p):
-    g = Git()
-    has_history = len(get_history(p)) > 0
+    g = session()
+    has_history = latest_hash(p) is not None
     g.add(p)
     changes = has_changes(p)
     if has_history:
@@ -118,37 +427,82 @@ def commit_update(p):
     commit(p, action, msg=msg, noadd=True)
 
 
-def commit_backlog(processed):
+def commit_migrate(servers, layout):
+    """ Commit pool layout change for all servers in a single commit """
+    g = session()
+    for s in servers:
+        g.git.add(abspath(path.serverdir(s)), A=True)
+    g.reload()
+    # All content paths change, so remembered hashes are no longer useful
+    g.latest.clear()
+    msg = 'Migrated content pool to {} layout'.format(layout)
+    commit(path.VERSION, action='MIG', msg=msg, extra_data=[layout],
+           cid='POOL')
+
+
+def unstage(paths):
+    """ Reset staged changes of given paths to HEAD """
+    g = session()
+    g.git.reset('-q', '--', *[abspath(p) for p in paths])
+    g.reload()
+
+
+def commit_broadcast_mode(mode, old, new):
+    """ Commit switch to a different broadcast mode, where ``old`` is the
+    file holding broadcast records that was removed and ``new`` is the file
+    that replaces it """
+    g = session()
+    g.remove([old])
+    g.add([abspath(new), abspath(path.VERSION)])
+    msg = 'Broadcast records moved from {} to {}'.format(
+        os.path.basename(old), os.path.basename(new))
+    commit(path.VERSION, action='BCM', msg=msg, extra_data=[mode],
+           cid='BROADCAST')
+
+
+def commit_backlog(processed, skipped=[]):
     msg = 'Backlog processed:\n\n{}'.format('\n'.join(processed))
-    commit(path.BROADCAST, action='BKL', msg=msg)
+    if skipped:
+        msg += '\n\nSkipped {} already aired:\n\n{}'.format(
+            len(skipped), '\n'.join(skipped))
+    commit(path.broadcastrecord(), action='BKL', msg=msg)
 
 
 def revert(p):
-    """ Revert given path to specified hash """
-    g = Git()
-    history = get_history(p)
-    print(history)
-    print(history[1])
-    if len(history) < 2:
+    """ Revert given path to the state before the last commit """
+    g = session()
+    p = abspath(p)
+    prev = previous_hash(p)
+    if not prev:
         raise ValueError('nothing to do')
-    g.git.checkout(history[1], p=True)
-    msg = 'Reverted {} to previous state'.format(history[1])
+    # Files added by the last commit are not removed by checkout
+    added = g.git.diff(prev, 'HEAD', '--', p, name_only=True,
+                       diff_filter='A')
+    added = [join(g.path, f) for f in added.split('\n') if f]
+    if added:
+        g.remove(added)
+        for f in added:
+            os.remove(f)
+    g.git.checkout(prev, '--', p)
+    g.reload()
+    msg = 'Reverted {} to previous state'.format(prev)
     commit(p, 'REV', msg=msg)
 
 
 def reset(p):
     """ Remove any changes on path """
-    g = Git()
-    history = get_history(p)
-    if len(history) < 1:
+    g = session()
+    p = abspath(p)
+    if not latest_hash(p):
         raise ValueError('nothing to do')
-    g.git.clean(f=True, d=True, p=True)
-    g.git.checkout(history[0], p=True)
+    g.git.clean('--', p, f=True, d=True)
+    g.git.checkout('HEAD', '--', p)
+    g.reload()
 
 
 def remove(p):
     """ Remove directory and all contents """
-    g = Git()
+    g = session()
     g.remove([p], r=True)
     shutil.rmtree(p)
     msg = 'Removed {} from pool'.format(p)
@@ -0,0 +1,208 @@
+"""
+Functions for working with the content ID index
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import atexit
+import bisect
+import tempfile
+
+from . import git
+from . import path
+
+
+class Index:
+    """
+    Sorted list of content IDs found in a single server directory
+
+    The index is stored in ``path.INDEXDIR`` as a plain text file named after
+    the server, with one content ID per line in sorted order. It is loaded
+    into memory on first use, and full or partial content IDs are resolved
+    using binary search.
+
+    Lookups rebuild the index from the server directory if the index file is
+    missing or older than the server directory. Tools that modify the server
+    directory are expected to call ``add()`` and ``remove()`` so that the
+    index does not need to be rebuilt.
+
+    In sharded pools, only the top-level server directory is checked, so
+    changes made by other means inside existing shards are not detected. Use
+    ``rebuild()`` in such cases.
+
+    The first line of the file records the pool layout and the hash of the
+    server directory tree in HEAD at the time the index was saved. When the
+    tree no longer matches, even when loaded without the modification time
+    check, the content IDs that changed between the two trees are updated, so
+    that committed changes (e.g., the tool's own commit, pull or reset) are
+    picked up without scanning the whole server directory. The index is
+    rebuilt if the layout changed or the trees cannot be compared.
+    """
+
+    def __init__(self, server=path.DEFAULT_SERVER):
+        self.server = server
+        self.path = os.path.join(path.INDEXDIR, server)
+        self.cids = None
+        self.dirty = False
+
+    def is_stale(self):
+        """ Check whether server directory was modified after the index """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except path.FILE_ERRORS:
+            return True
+        try:
+            return os.stat(path.serverdir(self.server)).st_mtime > mtime
+        except path.FILE_ERRORS:
+            return False
+
+    def load(self, check=True):
+        """ Load the index from disk, rebuilding it if necessary
+
+        When ``check`` is ``False``, index file is loaded even if it is older
+        than the server directory. This is used when the caller is about to
+        update the index to match a change it has just made to the directory.
+        """
+        if not os.path.exists(self.path) or (check and self.is_stale()):
+            self.rebuild()
+            return
+        with open(self.path, 'r') as f:
+            header = f.readline().strip()
+            cids = [l.strip() for l in f if l.strip()]
+        current = self.header()
+        if header == current:
+            self.cids = cids
+            return
+        old = header.split()
+        new = current.split()
+        if len(old) != 3 or old[:2] != new[:2] or '-' in (old[2], new[2]):
+            self.rebuild()
+            return
+        changes = git.tree_changes(old[2], new[2])
+        if changes is None:
+            self.rebuild()
+            return
+        self.cids = cids
+        self.update(changes)
+
+    def update(self, changes):
+        """ Update content IDs found in given paths relative to the server
+        directory to match the directory """
+        depth = path.SHARDDEPTH if path.poollayout() == path.SHARDED else 0
+        for name in changes:
+            parts = name.split('/')
+            if len(parts) <= depth or not path.cid(parts[depth]):
+                continue
+            cid = parts[depth]
+            if os.path.lexists(path.contentdir(cid, self.server)):
+                self.add(cid)
+            else:
+                self.remove(cid)
+        # Header is rewritten even when no content ID changed
+        self.dirty = True
+
+    def header(self):
+        """ Return the header line identifying what the index matches """
+        tree = git.tree_hash(path.serverdir(self.server))
+        return '# {} {}'.format(path.poollayout(), tree or '-')
+
+    def rebuild(self):
+        """ Scan the server directory and recreate the index """
+        dirs = path.find_contentdirs([], server=self.server)
+        self.cids = sorted(os.path.basename(d) for d in dirs)
+        self.dirty = True
+        self.save()
+
+    def save(self):
+        """ Write the index to disk if it has been modified """
+        if not self.dirty:
+            return
+        if not os.path.isdir(path.INDEXDIR):
+            os.makedirs(path.INDEXDIR)
+        fd, tmp = tempfile.mkstemp(dir=path.INDEXDIR)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.header() + '\n')
+            for cid in self.cids:
+                f.write(cid + '\n')
+        os.rename(tmp, self.path)
+        self.dirty = False
+
+    def find(self, prefix=''):
+        """ Return iterator over content IDs that start with ``prefix`` """
+        if self.cids is None:
+            self.load()
+        i = bisect.bisect_left(self.cids, prefix)
+        while i < len(self.cids) and self.cids[i].startswith(prefix):
+            yield self.cids[i]
+            i += 1
+
+    def add(self, cid):
+        if self.cids is None:
+            self.load(check=False)
+        i = bisect.bisect_left(self.cids, cid)
+        if i < len(self.cids) and self.cids[i] == cid:
+            return
+        self.cids.insert(i, cid)
+        self.dirty = True
+
+    def remove(self, cid):
+        if self.cids is None:
+            self.load(check=False)
+        i = bisect.bisect_left(self.cids, cid)
+        if i == len(self.cids) or self.cids[i] != cid:
+            return
+        del self.cids[i]
+        self.dirty = True
+
+
+_indexes = {}
+
+
+def get(server=path.DEFAULT_SERVER):
+    """ Return the index for given server, creating it on first use """
+    if server not in _indexes:
+        _indexes[server] = Index(server)
+    return _indexes[server]
+
+
+def find_contentdirs(cids, server=path.DEFAULT_SERVER):
+    """ Return iterator over content directories matching full or partial
+    content IDs
+
+    If ``cids`` is empty, all content directories on the server are returned.
+    """
+    idx = get(server)
+    for prefix in cids or ['']:
+        for cid in idx.find(prefix.strip()):
+            yield path.contentdir(cid, server)
+
+
+def add(cid, server=path.DEFAULT_SERVER):
+    get(server).add(cid)
+
+
+def remove(cid, server=path.DEFAULT_SERVER):
+    get(server).remove(cid)
+
+
+def rebuild(server=path.DEFAULT_SERVER):
+    get(server).rebuild()
+
+
+@atexit.register
+def save():
+    """ Write all modified indexes to disk """
+    for idx in _indexes.values():
+        idx.save()
+
+
+def reload():
+    """ Write modified indexes and discard loaded ones, so that changes made
+    by other processes are seen on next use """
+    save()
+    _indexes.clear()
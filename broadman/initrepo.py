@@ -21,7 +21,7 @@ from . import path
 cn = conz.Console()
 
 
-def create_pool():
+def create_pool(layout=path.FLAT):
     pooldir = os.path.abspath(path.POOLDIR)
     if not os.path.exists(pooldir):
         try:
@@ -33,15 +33,20 @@ def create_pool():
     if not os.path.isdir(pooldir):
         cn.pverr(pooldir, 'Path exists but is not a directory')
         cn.quit(1)
-    git.init()
+    git.init(layout)
 
 
 def main():
     from . import args
 
     parser = args.getparser('Initiaize content pool repository')
-    parser.parse_args()
-    create_pool()
+    parser.add_argument('--layout', '-l', choices=path.LAYOUTS,
+                        default=path.FLAT, help='content directory layout '
+                        '(sharded layout stores content in nested '
+                        'directories named after the first characters of '
+                        'the content ID, default: %(default)s)')
+    args = parser.parse_args()
+    create_pool(args.layout)
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ This software is free software licensed under the terms of GPLv3. See COPYING
 file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
+import io
 import json
 
 
@@ -30,9 +31,9 @@ def save(path, data):
 def load(path):
     """ Load data from a file at given path """
     try:
-        with open(path, 'r') as f:
+        with io.open(path, 'r', encoding='utf8') as f:
             try:
-                return json.load(f, encoding='utf8')
+                return json.load(f)
             except ValueError:
                 raise LoadError('malformed json')
     except FILE_ERRORS:
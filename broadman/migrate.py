@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+Migrate content pool to a different directory layout
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import conz
+import scandir
+
+from . import git
+from . import path
+from . import index
+
+
+cn = conz.Console()
+
+
+def get_servers():
+    """ Return names of all server directories in the pool """
+    servers = []
+    for entry in scandir.scandir(path.POOLDIR):
+        if entry.name.startswith('.') or not entry.is_dir():
+            continue
+        servers.append(entry.name)
+    return sorted(servers)
+
+
+def prune_shards(server):
+    """ Remove shard directories that are left empty after migration """
+    for entry in path.scanshards(path.serverdir(server), path.SHARDDEPTH - 1):
+        if len(entry.name) != path.SHARDLEN or not entry.is_dir():
+            continue
+        for d in [entry.path, os.path.dirname(entry.path)]:
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+
+
+def move(src, dest):
+    ddir = os.path.dirname(dest)
+    if not os.path.isdir(ddir):
+        os.makedirs(ddir)
+    os.rename(src, dest)
+
+
+def relink(cid, src, dest, layout):
+    """ Recreate server symlink so that it points to content in given
+    layout """
+    ddir = os.path.dirname(dest)
+    if not os.path.isdir(ddir):
+        os.makedirs(ddir)
+    os.unlink(src)
+    os.symlink(path.contentdir(cid, layout=layout), dest)
+
+
+def migrate_server(server, old, new, done):
+    """ Move content or server links of a server to paths in ``new`` layout,
+    and record each move in ``done`` as (server, cid, src, dest) tuple """
+    # Get the full list first, as we will be modifying the directory
+    dirs = list(path.find_contentdirs([], server=server, layout=old))
+    for src in dirs:
+        cid = os.path.basename(src)
+        dest = path.contentdir(cid, server, layout=new)
+        if server == path.DEFAULT_SERVER:
+            move(src, dest)
+        else:
+            relink(cid, src, dest, new)
+        done.append((server, cid, src, dest))
+    if old == path.SHARDED:
+        prune_shards(server)
+    return len(dirs)
+
+
+def rollback(done, old):
+    """ Undo moves recorded by ``migrate_server()``, restoring paths in
+    ``old`` layout """
+    for server, cid, src, dest in reversed(done):
+        if server == path.DEFAULT_SERVER:
+            move(dest, src)
+        else:
+            relink(cid, dest, src, old)
+    for server in set(d[0] for d in done):
+        prune_shards(server)
+
+
+def migrate(layout):
+    old = path.poollayout()
+    if old == layout:
+        raise ValueError('pool already uses {} layout'.format(layout))
+    servers = get_servers()
+    for s in servers:
+        if git.has_changes(path.serverdir(s)):
+            raise RuntimeError('{} has pending changes, please update '
+                               'first'.format(s))
+    git.ignore_derived()
+    opts = path.read_options()
+    # Master is migrated first so that symlinks are never left dangling
+    servers.remove(path.DEFAULT_SERVER)
+    servers.insert(0, path.DEFAULT_SERVER)
+    done = []
+    try:
+        for s in servers:
+            with cn.progress('Migrating {}'.format(s)):
+                count = migrate_server(s, old, layout, done)
+            cn.pverb('{}: {} items'.format(s, count))
+        # Version file is only written once all content is in place, so
+        # that an interrupted migration leaves the pool in the old layout
+        path.write_options(dict(opts, layout=layout))
+        with cn.progress('Committing changes'):
+            git.commit_migrate(servers, layout)
+    except BaseException:
+        with cn.progress('Rolling back changes'):
+            rollback(done, old)
+            path.write_options(opts)
+            git.unstage([path.serverdir(s) for s in servers] +
+                        [path.VERSION])
+        raise
+    with cn.progress('Rebuilding indexes'):
+        for s in servers:
+            index.rebuild(s)
+
+
+def main():
+    from . import args
+
+    parser = args.getparser('Migrate content pool to a different layout',
+                            has_debug=True)
+    parser.add_argument('layout', metavar='LAYOUT', choices=path.LAYOUTS,
+                        help='target layout (one of: {})'.format(
+                            ', '.join(path.LAYOUTS)))
+    args = parser.parse_args()
+
+    cn.verbose = True
+    cn.debug = args.debug
+
+    try:
+        migrate(args.layout)
+        cn.pok('pool migration')
+    except (ValueError, RuntimeError) as e:
+        cn.perr(e)
+        cn.png('pool migration')
+        cn.quit(1)
+    except cn.ProgressAbrt:
+        cn.png('pool migration')
+        cn.quit(1)
+
+
+if __name__ == '__main__':
+    main()
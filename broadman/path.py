@@ -14,6 +14,8 @@ import re
 import os
 import scandir
 
+from . import __version__
+
 
 try:
     FILE_ERRORS = (IOError, OSError, FileNotFoundError)
@@ -32,9 +34,38 @@ POOLDIR = os.environ.get('OUTERNET_CONTENT', '.').rstrip(os.sep)
 # Path to backlog file
 BACKLOG = os.path.join(POOLDIR, '.backlog')
 
+# Backlog entries completed by an unfinished sync
+JOURNAL = BACKLOG + '.journal'
+
+# Version file, which also records pool options such as layout
+VERSION = os.path.join(POOLDIR, '.version')
+
 # Broad cast log database
 BROADCAST = os.path.join(POOLDIR, 'broadcast.sqlite')
 
+# Broadcast records in JSON lines format, used instead of the database in log
+# mode
+BROADCAST_LOG = os.path.join(POOLDIR, 'broadcast.log')
+
+# Directory for derived data that is not tracked by git
+CACHEDIR = os.path.join(POOLDIR, '.cache')
+
+# Directory holding per-server content ID indexes
+INDEXDIR = os.path.join(CACHEDIR, 'index')
+
+# Metadata catalog database
+CATALOG = os.path.join(CACHEDIR, 'catalog.sqlite')
+
+# Broadcast database built from the broadcast log in log mode
+BROADCAST_CACHE = os.path.join(CACHEDIR, 'broadcast.sqlite')
+
+# Directory holding packed content zip files
+ZIPDIR = os.path.join(CACHEDIR, 'zips')
+
+# Directory where imported content is unpacked before it is moved into the
+# pool, which must be on the same filesystem as the pool
+STAGINGDIR = os.path.join(CACHEDIR, 'staging')
+
 # Default content ID length
 CIDLEN = 32
 
@@ -47,6 +78,26 @@ CIDRE = re.compile('%(pc)s{%(len)s}' % {'pc': PATHCHARS, 'len': CIDLEN})
 # Default server directory
 DEFAULT_SERVER = 'master'
 
+# Content directory layouts
+FLAT = 'flat'  # POOLDIR/SERVER/CID
+SHARDED = 'sharded'  # POOLDIR/SERVER/C1/C2/CID
+LAYOUTS = (FLAT, SHARDED)
+
+# Length of shard directory names and number of shard levels
+SHARDLEN = 2
+SHARDDEPTH = 2
+
+# Pool layout as read from the version file
+_layout = None
+
+# Ways of keeping broadcast records in the repository
+DBMODE = 'db'  # POOLDIR/broadcast.sqlite is committed
+LOGMODE = 'log'  # POOLDIR/broadcast.log is committed
+BROADCAST_MODES = (DBMODE, LOGMODE)
+
+# Broadcast mode as read from the version file
+_mode = None
+
 
 def fnwalk(path, fn, shallow=False):
     """
@@ -101,6 +152,28 @@ def countwalk(path, fn):
     return count
 
 
+def dirsize(path):
+    """
+    Walk directory tree and calculate its size.
+
+    This function returns a tuple of apparent size (sum of sizes of all files
+    and symlinks, excluding directories) and disk usage (space taken by all
+    entries including directories, as reported by the file system), both in
+    bytes. Symlinks are not followed.
+    """
+    size = usage = 0
+    for e in scandir.scandir(path):
+        st = e.stat(follow_symlinks=False)
+        usage += st.st_blocks * 512
+        if e.is_dir(follow_symlinks=False):
+            s, u = dirsize(e.path)
+            size += s
+            usage += u
+        else:
+            size += st.st_size
+    return size, usage
+
+
 def cidrx(s, l=CIDLEN):
     """
     Return a pattern that matches full or partial path segment of given length
@@ -114,6 +187,84 @@ def cidrx(s, l=CIDLEN):
     return s + '%s{%s}' % (PATHCHARS, l - lens)
 
 
+def read_options():
+    """
+    Return pool options recorded in the version file as a dict
+
+    The first line of the version file is the version of broadman that
+    created the pool. Remaining lines are options in ``KEY VALUE`` format.
+    """
+    opts = {}
+    try:
+        with open(VERSION, 'r') as f:
+            f.readline()
+            for l in f:
+                key, _, val = l.strip().partition(' ')
+                if key:
+                    opts[key] = val.strip()
+    except FILE_ERRORS:
+        pass
+    return opts
+
+
+def write_options(opts):
+    """
+    Write the version file with given pool options
+    """
+    global _layout, _mode
+    with open(VERSION, 'w') as f:
+        f.write(__version__ + '\n')
+        for key in sorted(opts):
+            f.write('{} {}\n'.format(key, opts[key]))
+    _layout = None
+    _mode = None
+
+
+def poollayout():
+    """
+    Return the content directory layout of the pool
+    """
+    global _layout
+    if _layout is None:
+        _layout = read_options().get('layout', FLAT)
+    return _layout
+
+
+def broadcastmode():
+    """
+    Return the way broadcast records are kept in the repository
+    """
+    global _mode
+    if _mode is None:
+        _mode = read_options().get('broadcast', DBMODE)
+    return _mode
+
+
+def broadcastdb():
+    """
+    Return path to the broadcast database for the pool's broadcast mode
+    """
+    if broadcastmode() == LOGMODE:
+        return BROADCAST_CACHE
+    return BROADCAST
+
+
+def broadcastrecord():
+    """
+    Return path to the file holding broadcast records that is committed
+    """
+    if broadcastmode() == LOGMODE:
+        return BROADCAST_LOG
+    return BROADCAST
+
+
+def shards(cid):
+    """
+    Return a list of shard directory names for given content ID
+    """
+    return [cid[i * SHARDLEN:(i + 1) * SHARDLEN] for i in range(SHARDDEPTH)]
+
+
 def serverdir(server=DEFAULT_SERVER):
     """
     Return server directory.
@@ -121,11 +272,17 @@ def serverdir(server=DEFAULT_SERVER):
     return os.path.join(POOLDIR, server)
 
 
-def contentdir(cid, server=DEFAULT_SERVER):
+def contentdir(cid, server=DEFAULT_SERVER, layout=None):
     """
     Return a content directory matching content id regardless of whether it
     exists
+
+    The path depends on pool layout. If ``layout`` is omitted, the layout
+    recorded in the pool's version file is used.
     """
+    layout = layout or poollayout()
+    if layout == SHARDED:
+        return os.path.join(serverdir(server), *(shards(cid) + [cid]))
     return os.path.join(serverdir(server), cid)
 
 
@@ -139,17 +296,40 @@ def cid(s):
     return s[m.start():m.end()]
 
 
-def find_contentdirs(cids, server=DEFAULT_SERVER):
+def find_contentdirs(cids, server=DEFAULT_SERVER, layout=None):
+    """
+    Scan server directory for content directories matching full or partial
+    content IDs
+
+    This function reads the entire server directory on each call. Use
+    ``index.find_contentdirs()`` for repeated lookups.
+
+    In sharded pools, shard directories are traversed as well. If ``layout``
+    is omitted, the layout recorded in the pool's version file is used.
+    """
     if not cids:
         cidsrx = cidrx('')
     else:
         cidsrx = '|'.join(cidrx(cid) for cid in cids)
     cidsrx = re.compile(cidsrx)
-    sd = serverdir(server)
+    depth = SHARDDEPTH if (layout or poollayout()) == SHARDED else 0
+    for entry in scanshards(serverdir(server), depth):
+        if cidsrx.search(entry.name):
+            yield entry.path
+
+
+def scanshards(path, depth):
+    """
+    Return iterator over directory entries found ``depth`` levels of shard
+    directories below ``path``
+    """
     try:
-        for entry in scandir.scandir(sd):
-            if cidsrx.search(entry.name):
-                yield entry.path
+        for entry in scandir.scandir(path):
+            if not depth:
+                yield entry
+            elif len(entry.name) == SHARDLEN and entry.is_dir():
+                for child in scanshards(entry.path, depth - 1):
+                    yield child
     except FILE_ERRORS:
         return
 
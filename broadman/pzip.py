@@ -0,0 +1,398 @@
+"""
+Functions for writing zip files using multiple threads
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+Compressed members are split into chunks that are deflated in a thread pool
+(zlib releases the GIL while compressing), so that even a single large file
+is compressed using all cores. Each chunk is compressed independently, using
+the end of the previous chunk as preset dictionary, and all but the last one
+are ended with a sync flush, so that the chunks concatenate into a single
+valid deflate stream. CRC32 checksums of the chunks are combined using the
+same algorithm as zlib's ``crc32_combine()``.
+
+Chunks are written in order as they are finished, and local headers are
+updated with the sizes and checksums once the member is complete. ZIP64
+extensions are used for large members and archives, as in the ``zipfile``
+module.
+
+Preset dictionaries are only supported by zlib on Python 3.3 and later. On
+older versions, each member is compressed as a single stream in the calling
+thread, the same way the ``zipfile`` module does it.
+"""
+
+import os
+import time
+import zlib
+import struct
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Same limit as used by the zipfile module
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+ZIP_MAX = 0xFFFFFFFF
+
+# Size of chunks compressed by a single thread
+CHUNK = 4 * 1024 * 1024
+
+# Size of the deflate window, used as preset dictionary for each chunk
+WINDOW = 32 * 1024
+
+FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_DIR = struct.Struct('<4s4B4HL2L5H2L')
+END_ARCHIVE = struct.Struct('<4s4H2LH')
+END_ARCHIVE64 = struct.Struct('<4sQ2H2L4Q')
+END_ARCHIVE64_LOCATOR = struct.Struct('<4sLQL')
+
+FILE_HEADER_SIG = b'PK\003\004'
+CENTRAL_DIR_SIG = b'PK\001\002'
+END_ARCHIVE_SIG = b'PK\005\006'
+END_ARCHIVE64_SIG = b'PK\006\006'
+END_ARCHIVE64_LOCATOR_SIG = b'PK\006\007'
+
+# Unix
+CREATE_SYSTEM = 3
+
+DEFAULT_VERSION = 20
+ZIP64_VERSION = 45
+
+# Filename is encoded in UTF-8
+UTF8_FLAG = 0x800
+
+CRC_POLY = 0xedb88320
+
+_zeros_ops = {}
+
+
+def has_zdict():
+    """ Check whether zlib supports preset dictionaries for compression """
+    try:
+        zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15,
+                         zdict=b'x')
+    except TypeError:
+        return False
+    return True
+
+
+ZDICT = has_zdict()
+
+
+def gf2_times(mat, vec):
+    s = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            s ^= mat[i]
+        vec >>= 1
+        i += 1
+    return s
+
+
+def gf2_square(mat):
+    return [gf2_times(mat, mat[n]) for n in range(32)]
+
+
+def zeros_op(length):
+    """ Return operator that applies ``length`` zero bytes to a CRC """
+    if length in _zeros_ops:
+        return _zeros_ops[length]
+    # Operator for a single zero bit
+    op = [CRC_POLY] + [1 << n for n in range(31)]
+    for _ in range(3):
+        op = gf2_square(op)
+    result = None
+    n = length
+    while n:
+        if n & 1:
+            if result is None:
+                result = op
+            else:
+                result = [gf2_times(op, result[i]) for i in range(32)]
+        n >>= 1
+        if n:
+            op = gf2_square(op)
+    _zeros_ops[length] = result
+    return result
+
+
+def crc32_combine(crc1, crc2, len2):
+    """ Return CRC32 of concatenated data given CRC32 of both parts and the
+    length of the second part """
+    if not len2:
+        return crc1
+    return gf2_times(zeros_op(len2), crc1) ^ crc2
+
+
+def compress_chunk(args):
+    """ Compress a chunk of a file and return its CRC32, size and data """
+    fpath, offset, length, level, final = args
+    with open(fpath, 'rb') as f:
+        start = max(0, offset - WINDOW)
+        f.seek(start)
+        zdict = f.read(offset - start)
+        data = f.read(length)
+    kwargs = {}
+    if zdict:
+        kwargs['zdict'] = zdict
+    c = zlib.compressobj(level, zlib.DEFLATED, -15, **kwargs)
+    out = c.compress(data)
+    out += c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return zlib.crc32(data) & ZIP_MAX, len(data), out
+
+
+def dostime(mtime, utc=False):
+    t = time.gmtime(mtime) if utc else time.localtime(mtime)
+    year = max(t[0], 1980)
+    date = (year - 1980) << 9 | t[1] << 5 | t[2]
+    dtime = t[3] << 11 | t[4] << 5 | t[5] // 2
+    return date, dtime
+
+
+class Member:
+    """
+    Information about a single zip file member
+
+    If ``mtime`` is specified, it is used as modification time instead of
+    that of the file (stored in UTC so that it does not depend on the time
+    zone), and permissions are normalized to 0644, or 0755 for executables.
+    """
+
+    def __init__(self, name, fpath, data, compress_type, mtime=None):
+        self.name = name
+        self.fpath = fpath
+        self.data = data
+        self.compress_type = compress_type
+        if data is None:
+            st = os.stat(fpath)
+            self.size = st.st_size
+            self.mtime = st.st_mtime
+            self.mode = st.st_mode
+        else:
+            self.size = len(data)
+            self.mtime = time.time()
+            self.mode = 0o100644
+        if mtime is not None:
+            self.mtime = mtime
+            self.mode = 0o100755 if self.mode & 0o111 else 0o100644
+        self.date, self.time = dostime(self.mtime, utc=mtime is not None)
+        self.crc = 0
+        self.compress_size = 0
+        self.offset = 0
+        try:
+            self.encoded = name.encode('ascii')
+            self.flags = 0
+        except UnicodeError:
+            self.encoded = name.encode('utf8')
+            self.flags = UTF8_FLAG
+        # Decide whether ZIP64 is needed before the size is known, in the
+        # same way as the zipfile module does
+        self.zip64 = self.size * 1.05 > ZIP64_LIMIT
+
+    def chunks(self, level):
+        """ Return arguments for compressing chunks of the member """
+        if self.data is not None or self.compress_type == ZIP_STORED:
+            return []
+        if not ZDICT:
+            # Compressed in a single stream by deflate_file()
+            return []
+        count = max(1, (self.size + CHUNK - 1) // CHUNK)
+        return [(self.fpath, i * CHUNK, CHUNK, level, i == count - 1)
+                for i in range(count)]
+
+
+class Writer:
+    """
+    Zip file writer that writes members as a sequence of data blocks
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.members = []
+
+    def begin(self, m):
+        m.offset = self.f.tell()
+        # Checksum and sizes are filled in by end()
+        extra = b''
+        size = 0
+        if m.zip64:
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            size = ZIP_MAX
+        version = ZIP64_VERSION if m.zip64 else DEFAULT_VERSION
+        self.f.write(FILE_HEADER.pack(
+            FILE_HEADER_SIG, version, 0, m.flags, m.compress_type, m.time,
+            m.date, 0, size, size, len(m.encoded), len(extra)))
+        self.f.write(m.encoded)
+        self.f.write(extra)
+        m.data_offset = self.f.tell()
+
+    def write(self, data):
+        self.f.write(data)
+
+    def end(self, m, crc, size):
+        """ Update the local header with CRC and sizes of the member """
+        pos = self.f.tell()
+        m.crc = crc
+        m.size = size
+        m.compress_size = pos - m.data_offset
+        if not m.zip64 and (m.size > ZIP64_LIMIT or
+                            m.compress_size > ZIP64_LIMIT):
+            raise RuntimeError('{} requires ZIP64 extensions'.format(m.name))
+        self.f.seek(m.offset + 14)
+        if m.zip64:
+            self.f.write(struct.pack('<L', crc))
+            self.f.seek(m.offset + FILE_HEADER.size + len(m.encoded) + 4)
+            self.f.write(struct.pack('<QQ', m.size, m.compress_size))
+        else:
+            self.f.write(struct.pack('<3L', crc, m.compress_size, m.size))
+        self.f.seek(pos)
+        self.members.append(m)
+
+    def close(self):
+        """ Write the central directory """
+        start = self.f.tell()
+        for m in self.members:
+            extra = []
+            size = m.size
+            compress_size = m.compress_size
+            offset = m.offset
+            if m.size > ZIP64_LIMIT or m.compress_size > ZIP64_LIMIT:
+                extra.extend([m.size, m.compress_size])
+                size = compress_size = ZIP_MAX
+            if m.offset > ZIP64_LIMIT:
+                extra.append(m.offset)
+                offset = ZIP_MAX
+            if extra:
+                extra = struct.pack('<HH' + 'Q' * len(extra), 1,
+                                    8 * len(extra), *extra)
+                version = ZIP64_VERSION
+            else:
+                extra = b''
+                version = ZIP64_VERSION if m.zip64 else DEFAULT_VERSION
+            self.f.write(CENTRAL_DIR.pack(
+                CENTRAL_DIR_SIG, version, CREATE_SYSTEM, version, 0, m.flags,
+                m.compress_type, m.time, m.date, m.crc, compress_size, size,
+                len(m.encoded), len(extra), 0, 0, 0,
+                (m.mode & 0xFFFF) << 16, offset))
+            self.f.write(m.encoded)
+            self.f.write(extra)
+        end = self.f.tell()
+        count = len(self.members)
+        cdsize = end - start
+        if (count > ZIP_FILECOUNT_LIMIT or cdsize > ZIP64_LIMIT or
+                start > ZIP64_LIMIT):
+            self.f.write(END_ARCHIVE64.pack(
+                END_ARCHIVE64_SIG, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                count, count, cdsize, start))
+            self.f.write(END_ARCHIVE64_LOCATOR.pack(
+                END_ARCHIVE64_LOCATOR_SIG, 0, end, 1))
+            count = min(count, ZIP_FILECOUNT_LIMIT)
+            cdsize = min(cdsize, ZIP_MAX)
+            start = min(start, ZIP_MAX)
+        self.f.write(END_ARCHIVE.pack(
+            END_ARCHIVE_SIG, 0, 0, count, count, cdsize, start, 0))
+
+
+def copy_file(w, fpath, length):
+    """ Copy file to the zip file and return its CRC32 and size """
+    crc = 0
+    size = 0
+    with open(fpath, 'rb') as f:
+        while size < length:
+            data = f.read(min(CHUNK, length - size))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            w.write(data)
+    return crc & ZIP_MAX, size
+
+
+def deflate_file(w, fpath, length, level):
+    """ Compress file into the zip file as a single stream and return its
+    CRC32 and size """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    with open(fpath, 'rb') as f:
+        while size < length:
+            data = f.read(min(CHUNK, length - size))
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            w.write(c.compress(data))
+    w.write(c.flush())
+    return crc & ZIP_MAX, size
+
+
+def write(zpath, members, level=None, jobs=None, mtime=None):
+    """ Create a zip file from given members using ``jobs`` threads
+
+    ``members`` is an iterable of (zipname, fpath, data, compress_type)
+    tuples. If ``data`` is not ``None``, it is used as member contents
+    instead of reading the file at ``fpath``. Number of threads defaults to
+    the number of CPUs. See ``Member`` for the meaning of ``mtime``.
+
+    Chunk boundaries do not depend on the number of threads, so given the
+    same members, level and ``mtime``, the output is always the same.
+    """
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    members = [Member(*m, mtime=mtime) for m in members]
+    chunks = iter([c for m in members for c in m.chunks(level)])
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = ThreadPool(jobs)
+    # Limit the number of chunks held in memory
+    window = jobs * 2
+    pending = collections.deque()
+
+    def fill():
+        while len(pending) < window:
+            try:
+                args = next(chunks)
+            except StopIteration:
+                return
+            pending.append(pool.apply_async(compress_chunk, (args,)))
+
+    try:
+        with open(zpath, 'wb') as f:
+            w = Writer(f)
+            for m in members:
+                fill()
+                w.begin(m)
+                if m.data is not None:
+                    data = m.data
+                    if m.compress_type == ZIP_DEFLATED:
+                        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+                        data = c.compress(data) + c.flush()
+                    w.write(data)
+                    w.end(m, zlib.crc32(m.data) & ZIP_MAX, len(m.data))
+                elif m.compress_type == ZIP_STORED:
+                    w.end(m, *copy_file(w, m.fpath, m.size))
+                elif not ZDICT:
+                    w.end(m, *deflate_file(w, m.fpath, m.size, level))
+                else:
+                    crc = 0
+                    size = 0
+                    for i, _ in enumerate(m.chunks(level)):
+                        fill()
+                        ccrc, length, out = pending.popleft().get()
+                        crc = crc32_combine(crc, ccrc, length) if i else ccrc
+                        size += length
+                        w.write(out)
+                    w.end(m, crc, size)
+            w.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return zpath
@@ -0,0 +1,370 @@
+"""
+Functions for compiling metadata query expressions
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+Query syntax
+============
+
+A query consists of one or more terms combined using ``AND``, ``OR`` and
+``NOT`` operators (case-insensitive), and grouped using parentheses. ``NOT``
+binds tightest and ``OR`` binds loosest. Each term has the following format::
+
+    KEY[:TYPE]OPERATOR VALUE
+
+There should be no spaces between the key, operator and value. Values that
+contain spaces or parentheses must be quoted using single or double quotes.
+
+The ``TYPE`` is one of the type markers used by ``data.totype()``:
+
+- ``d`` - datestamp (YYYY-MM-DD format)
+- ``t`` - timestamp (YYYY-MM-DD HH:MM:SS format)
+- ``n`` - numeric
+- ``b`` - boolean
+
+When type is omitted, values are compared as strings. The operators are:
+
+- ``=`` - equal (exact match for strings)
+- ``!=`` - not equal
+- ``~`` - contains (strings only)
+- ``>``, ``<``, ``>=``, ``<=`` - comparisons (typed values only)
+
+For typed values, ``=`` also accepts an inclusive range in ``LOW..HIGH``
+format.
+
+The special ``size`` key matches the size of the content directory, and its
+values can use ``b``, ``k`` and ``m`` suffixes (e.g., ``size>=10k``).
+
+Example::
+
+    title~news AND broadcast:d=2015-04-01..2015-04-30 AND NOT is_partner:b=yes
+"""
+
+import re
+import operator
+
+from . import data
+
+
+SIZE = 'size'
+
+TOKEN_RE = re.compile(r'''\s*(?:(\()|(\))|((?:[^\s()"']|"[^"]*"|'[^']*')+))''')
+TERM_RE = re.compile(r'^(?P<key>[^:=!<>~]+)(?::(?P<vtype>[^:=!<>~]+))?'
+                     r'(?P<op>!=|>=|<=|=|~|>|<)(?P<value>.*)$')
+
+KEYWORDS = ('AND', 'OR', 'NOT')
+
+COMPARISONS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '<': operator.lt,
+    '>=': operator.ge,
+    '<=': operator.le,
+}
+
+
+class QueryError(ValueError):
+    pass
+
+
+def tokenize(s):
+    """ Split query string into a list of tokens """
+    tokens = []
+    pos = 0
+    s = s.strip()
+    while pos < len(s):
+        m = TOKEN_RE.match(s, pos)
+        if not m or m.end() == pos:
+            raise QueryError('unexpected character at {}'.format(pos))
+        pos = m.end()
+        lparen, rparen, word = m.groups()
+        if word and word.upper() in KEYWORDS:
+            word = word.upper()
+        tokens.append(lparen or rparen or word)
+    return tokens
+
+
+def unquote(s):
+    return re.sub(r'''"([^"]*)"|'([^']*)\'''',
+                  lambda m: m.group(1) or m.group(2) or '', s)
+
+
+def strterm(key, op, value, icase):
+    """ Return predicate for string comparison """
+    if op not in ('=', '!=', '~'):
+        raise QueryError('{} cannot be used with strings'.format(op))
+    xmatch = op != '~'
+    invert = op == '!='
+
+    def pred(d, size):
+        try:
+            return invert ^ data.smatch(d.get(key), value, xmatch=xmatch,
+                                        icase=icase)
+        except TypeError:
+            # Missing key without icase
+            return invert
+
+    return pred
+
+
+def typedterm(key, vtype, op, value):
+    """ Return predicate for comparison of typed or size values """
+    if op == '~':
+        raise QueryError('~ can only be used with strings')
+    if key == SIZE:
+        convert = data.parse_size
+    else:
+        convert = lambda v: data.totype(v, vtype)
+
+    try:
+        if op == '=' and '..' in value and vtype != data.BOOLEAN:
+            low, high = (convert(v) for v in value.split('..', 1))
+            test = lambda x: low <= x <= high
+        else:
+            y = convert(value)
+            cmp = COMPARISONS[op]
+            test = lambda x: cmp(x, y)
+    except (ValueError, AttributeError, KeyError):
+        raise QueryError('invalid value for {}: {}'.format(key, value))
+
+    def pred(d, size):
+        if key == SIZE:
+            x = size()
+        else:
+            x = data.coerce(d.get(key), vtype)
+        if x is None:
+            return op == '!='
+        try:
+            return test(x)
+        except TypeError:
+            return False
+
+    return pred
+
+
+def parse_term(s):
+    """ Split a single term into key, type, operator and unquoted value """
+    m = TERM_RE.match(s)
+    if not m:
+        raise QueryError('invalid term: {}'.format(s))
+    key, vtype, op, value = m.group('key', 'vtype', 'op', 'value')
+    if vtype and vtype not in (data.DATESTAMP, data.TIMESTAMP, data.NUMERIC,
+                               data.BOOLEAN):
+        raise QueryError('{} is not a supported type'.format(vtype))
+    return key, vtype, op, unquote(value)
+
+
+def term(s, icase=False):
+    """ Compile a single term into a predicate """
+    key, vtype, op, value = parse_term(s)
+    if vtype or key == SIZE:
+        return typedterm(key, vtype, op, value)
+    return strterm(key, op, value, icase)
+
+
+class Predicates:
+    """
+    Builder that combines terms into predicate functions
+    """
+
+    def __init__(self, icase=False):
+        self.icase = icase
+
+    def any(self, preds):
+        return lambda d, size: any(p(d, size) for p in preds)
+
+    def all(self, preds):
+        return lambda d, size: all(p(d, size) for p in preds)
+
+    def negate(self, pred):
+        return lambda d, size: not pred(d, size)
+
+    def term(self, s):
+        return term(s, self.icase)
+
+
+class Conditions:
+    """
+    Builder that combines terms into an SQL condition
+
+    The condition matches rows of a table that has a text column for each of
+    the keys in ``columns``, holding string values or ``NULL`` for missing
+    keys, and a ``size`` column. It matches the same rows as the predicate
+    compiled from the same query would match their metadata. Values are
+    collected in ``params`` in the order of placeholders.
+
+    SQLite's ``lower()`` only handles ASCII, so case-insensitive conditions
+    use a ``py_lower()`` function, which must be registered on the
+    connection.
+
+    ``QueryError`` is raised for terms that have no SQL equivalent.
+    """
+
+    def __init__(self, columns, icase=False):
+        self.columns = columns
+        self.icase = icase
+        self.params = []
+
+    def any(self, conds):
+        return '({})'.format(' OR '.join(conds))
+
+    def all(self, conds):
+        return '({})'.format(' AND '.join(conds))
+
+    def negate(self, cond):
+        return '(NOT {})'.format(cond)
+
+    def string(self, key, op, value):
+        """ Return condition for string comparison """
+        if key not in self.columns:
+            raise QueryError('{} is not a column'.format(key))
+        if self.icase:
+            # Missing keys are compared as 'none', just like in data.smatch()
+            col = 'py_lower(coalesce("{}", \'None\'))'.format(key)
+            value = value.lower()
+        else:
+            col = '"{}"'.format(key)
+        if op == '~':
+            cond = 'instr({}, ?) > 0'.format(col)
+        elif op in ('=', '!='):
+            cond = '{} {} ?'.format(col, op)
+        else:
+            raise QueryError('{} cannot be used with strings'.format(op))
+        self.params.append(value)
+        # Only != matches missing keys
+        return 'coalesce({}, {})'.format(cond, int(op == '!='))
+
+    def size(self, op, value):
+        """ Return condition for size comparison """
+        if op not in COMPARISONS:
+            raise QueryError('{} cannot be used with size'.format(op))
+        try:
+            if op == '=' and '..' in value:
+                params = [data.parse_size(v) for v in value.split('..', 1)]
+                cond = 'size between ? and ?'
+            else:
+                params = [data.parse_size(value)]
+                cond = 'size {} ?'.format(op)
+        except (ValueError, AttributeError, KeyError):
+            raise QueryError('invalid value for size: {}'.format(value))
+        self.params.extend(params)
+        if op == '!=':
+            return '(size is null or {})'.format(cond)
+        return '(size is not null and {})'.format(cond)
+
+    def term(self, s):
+        key, vtype, op, value = parse_term(s)
+        if key == SIZE:
+            return self.size(op, value)
+        if vtype:
+            raise QueryError('typed values cannot be compared in SQL')
+        return self.string(key, op, value)
+
+
+class Parser:
+    """
+    Recursive descent parser that turns a list of tokens into a predicate, or
+    whatever else the ``builder`` combines terms into
+    """
+
+    def __init__(self, tokens, builder):
+        self.tokens = tokens
+        self.pos = 0
+        self.builder = builder
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        tok = self.peek()
+        if tok is None:
+            raise QueryError('unexpected end of query')
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        pred = self.orexpr()
+        if self.peek() is not None:
+            raise QueryError('unexpected {}'.format(self.peek()))
+        return pred
+
+    def orexpr(self):
+        preds = [self.andexpr()]
+        while self.peek() == 'OR':
+            self.next()
+            preds.append(self.andexpr())
+        if len(preds) == 1:
+            return preds[0]
+        return self.builder.any(preds)
+
+    def andexpr(self):
+        preds = [self.notexpr()]
+        while self.peek() == 'AND':
+            self.next()
+            preds.append(self.notexpr())
+        if len(preds) == 1:
+            return preds[0]
+        return self.builder.all(preds)
+
+    def notexpr(self):
+        if self.peek() == 'NOT':
+            self.next()
+            return self.builder.negate(self.notexpr())
+        return self.atom()
+
+    def atom(self):
+        tok = self.next()
+        if tok == '(':
+            pred = self.orexpr()
+            if self.next() != ')':
+                raise QueryError('missing )')
+            return pred
+        if tok in KEYWORDS or tok == ')':
+            raise QueryError('unexpected {}'.format(tok))
+        return self.builder.term(tok)
+
+
+def parse(s):
+    tokens = tokenize(s)
+    if not tokens:
+        raise QueryError('empty query')
+    return tokens
+
+
+def compile(s, icase=False):
+    """ Compile query string into a predicate function
+
+    The predicate takes two arguments. The first argument is the metadata
+    dict, and the second is a function that takes no arguments and returns
+    the content size. The size function is only called if the query contains
+    a ``size`` term, and only when that term needs to be evaluated.
+
+    If ``icase`` is ``True``, string comparisons are case-insensitive.
+
+    ``QueryError`` is raised if the query is malformed.
+    """
+    return Parser(parse(s), Predicates(icase)).parse()
+
+
+def tosql(s, columns, icase=False):
+    """ Translate query string into an SQL condition
+
+    Returns a tuple of condition and a list of parameters. See
+    ``Conditions`` for the table the condition applies to. ``QueryError`` is
+    raised if the query is malformed or cannot be expressed in SQL.
+    """
+    builder = Conditions(columns, icase)
+    return Parser(parse(s), builder).parse(), builder.params
+
+
+def keys(s):
+    """ Return the set of keys used in query string """
+    return set(parse_term(tok)[0] for tok in parse(s)
+               if tok not in KEYWORDS and tok not in ('(', ')'))
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+"""
+Refresh the metadata catalog
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import conz
+
+from . import catalog
+
+
+cn = conz.Console()
+
+
+def main():
+    from . import args
+
+    parser = args.getparser('Refresh metadata catalog', has_debug=True)
+    args = parser.parse_args()
+
+    cn.verbose = True
+    cn.debug = args.debug
+
+    try:
+        with cn.progress('Refreshing catalog',
+                         excs=(catalog.OperationalError,)):
+            cat = catalog.Catalog()
+            count = cat.refresh()
+            cat.close()
+        cn.pok('{} items reloaded'.format(count))
+    except cn.ProgressAbrt:
+        cn.png('catalog refresh')
+        cn.quit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+"""
+Report on broadcasts recorded in the broadcast database
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+Each report is a single query that is answered using one of the indexes
+created by the ``db`` module, and rows are written out as they are read, so
+that reports on large databases start printing immediately and do not need
+to be held in memory.
+"""
+
+import os
+import sys
+import csv
+import json
+import datetime
+
+import conz
+import sqlize as sql
+
+from . import db
+from . import path
+
+
+FORMATS = ('text', 'csv', 'jsonl')
+
+# Default minimum number of days between collection and airing
+MIN_LAG = 30
+
+cn = conz.Console()
+
+
+def filters(server=None, publisher=None, since=None, until=None,
+            where=None, params=None):
+    """ Return conditions and parameters for common filters, where ``since``
+    and ``until`` are inclusive broadcast dates """
+    where = where or []
+    params = params or {}
+    if server:
+        where.append('server_id = :server')
+        params['server'] = server
+    if publisher:
+        where.append('publisher = :publisher')
+        params['publisher'] = publisher
+    # Same expression as in the broadcasts_daily index
+    if since:
+        where.append('date(aired) >= :since')
+        params['since'] = since.isoformat()
+    if until:
+        where.append('date(aired) <= :until')
+        params['until'] = until.isoformat()
+    return where, params
+
+
+def live(**kwargs):
+    """ Content that is currently on servers """
+    where, params = filters(where=['removed is null'], **kwargs)
+    q = sql.Select(['server_id', 'content_id', 'commit_hash', 'title', 'url',
+                    'size', 'aired'], sets=db.DB.TABLE, where=where,
+                   order=['server_id', 'aired'])
+    return q, params
+
+
+def daily(**kwargs):
+    """ Number of items and bytes aired per day and server """
+    where, params = filters(**kwargs)
+    q = sql.Select(['date(aired) as day', 'server_id', 'count(*) as items',
+                    'sum(size) as bytes'], sets=db.DB.TABLE, where=where,
+                   group=['day', 'server_id'], order=['day', 'server_id'])
+    return q, params
+
+
+def publishers(**kwargs):
+    """ Number of items and bytes aired per publisher """
+    where, params = filters(**kwargs)
+    q = sql.Select(['publisher', 'count(*) as items', 'sum(size) as bytes'],
+                   sets=db.DB.TABLE, where=where, group=['publisher'],
+                   order=['publisher'])
+    return q, params
+
+
+def lag(min_lag=MIN_LAG, **kwargs):
+    """ Content aired at least ``min_lag`` days after it was collected """
+    where, params = filters(where=['{} >= :lag'.format(db.DB.LAG)],
+                            params={'lag': min_lag}, **kwargs)
+    q = sql.Select(['server_id', 'content_id', 'title', 'collected', 'aired',
+                    'round({}, 1) as lag_days'.format(db.DB.LAG)],
+                   sets=db.DB.TABLE, where=where,
+                   order=['-' + db.DB.LAG])
+    return q, params
+
+
+VIEWS = {
+    'live': live,
+    'daily': daily,
+    'publishers': publishers,
+    'lag': lag,
+}
+
+
+def query(view, limit=None, min_lag=MIN_LAG, **kwargs):
+    """ Return cursor over the rows of given report view
+
+    Keyword arguments are used as filters (see ``filters()``), and
+    ``min_lag`` is only used by the lag view.
+    """
+    if view == 'lag':
+        kwargs['min_lag'] = min_lag
+    q, params = VIEWS[view](**kwargs)
+    if limit:
+        q.limit = limit
+    return db.connect(readonly=True).con.execute(str(q), params)
+
+
+def columns(cur):
+    return [d[0] for d in cur.description]
+
+
+def write_text(cur, out):
+    out.write('\t'.join(columns(cur)) + '\n')
+    for row in cur:
+        out.write('\t'.join('' if v is None else str(v) for v in row) + '\n')
+
+
+def write_csv(cur, out):
+    w = csv.writer(out)
+    w.writerow(columns(cur))
+    for row in cur:
+        w.writerow(tuple(row))
+
+
+def write_jsonl(cur, out):
+    cols = columns(cur)
+    for row in cur:
+        out.write(json.dumps(dict(zip(cols, row)), sort_keys=True) + '\n')
+
+
+WRITERS = {
+    'text': write_text,
+    'csv': write_csv,
+    'jsonl': write_jsonl,
+}
+
+
+def datearg(s):
+    return datetime.datetime.strptime(s, '%Y-%m-%d').date()
+
+
+def main():
+    from . import args
+
+    parser = args.getparser('Report on broadcasts', has_debug=True)
+    parser.add_argument('view', choices=sorted(VIEWS),
+                        help='live: content currently on servers, daily: '
+                        'items and bytes aired per day and server, '
+                        'publishers: items and bytes aired per publisher, '
+                        'lag: content aired long after it was collected')
+    parser.add_argument('--server', '-s', metavar='SERVER',
+                        help='only include broadcasts on this server')
+    parser.add_argument('--publisher', '-P', metavar='HOST',
+                        help='only include content from this publisher '
+                        '(host name without www.)')
+    parser.add_argument('--since', metavar='YYYY-MM-DD', type=datearg,
+                        help='only include content aired on this day or '
+                        'later')
+    parser.add_argument('--until', metavar='YYYY-MM-DD', type=datearg,
+                        help='only include content aired on this day or '
+                        'earlier')
+    parser.add_argument('--min-lag', metavar='DAYS', type=float,
+                        default=MIN_LAG, help='minimum number of days '
+                        'between collection and airing for lag view '
+                        '(default: %(default)s)')
+    parser.add_argument('--limit', '-n', metavar='N', type=int,
+                        help='show at most N rows')
+    parser.add_argument('--format', '-f', choices=FORMATS, default='text',
+                        help='output format (default: %(default)s)')
+    args = parser.parse_args()
+
+    cn.debug = args.debug
+
+    if not os.path.exists(path.broadcastrecord()):
+        cn.perr('Broadcast database not found')
+        cn.quit(1)
+
+    try:
+        cur = query(args.view, limit=args.limit, server=args.server,
+                    publisher=args.publisher, since=args.since,
+                    until=args.until, min_lag=args.min_lag)
+        WRITERS[args.format](cur, sys.stdout)
+    except db.OperationalError as err:
+        cn.pverr('bcreport', err)
+        cn.quit(1)
+
+
+if __name__ == '__main__':
+    main()
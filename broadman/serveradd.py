@@ -18,6 +18,7 @@ import conz
 
 from . import git
 from . import path
+from . import index
 from . import jsonf
 from . import backlog
 
@@ -55,15 +56,22 @@ def add_to_servers(cid, servers):
     # caller is expected to handle this.
     if validator.validate(jsonf.load(ipath)):
         raise RuntimeError('content contains invalid metadata')
+    entries = []
     for s in servers:
         target = path.contentdir(cid, server=s)
         if not os.path.islink(target):
+            tdir = os.path.dirname(target)
+            if not os.path.isdir(tdir):
+                # Shard directories are only created as needed
+                os.makedirs(tdir)
             os.symlink(cdir, target)
             git.commit_add_to_server(target, s)
+            index.add(cid, s)
         # We add this to backlog regardless of whether a new symlink is crated.
         # We assume that user wishes to update the content even if symlink
         # already exists.
-        backlog.cadd(cid, s)
+        entries.append(('ADD', cid, s))
+    backlog.write_entries(entries)
 
 
 def main():
@@ -72,7 +80,7 @@ def main():
     parser = args.getparser(
         'Add content to a server',
         usage='%(prog)s [options] CID [CID...]\n       '
-        'CID | %(prog)s [options]')
+        'CID | %(prog)s [options]', has_batch=True)
     parser.add_argument('cids', metavar='CONTENT', nargs='*',
                         help='content ID or path to content directory')
     parser.add_argument('--create', '-c', action='store_true',
@@ -90,16 +98,17 @@ def main():
             cn.quit(1)
         src = args.cids
     else:
-        src = args.readpipe()
-
-    for cid in src:
-        cid = path.cid(cid)
-        try:
-            add_to_servers(cid, servers=args.servers)
-            cn.pstd(cn.color.green('{}: OK'.format(cid)))
-        except (jsonf.LoadError, RuntimeError) as e:
-            cn.pverr(cid, e)
-            cn.pstd(cn.color.red('{}: ERR'.format(cid)))
+        src = cn.readpipe()
+
+    with git.batch(args.batch_size if args.batch else None):
+        for cid in src:
+            cid = path.cid(cid)
+            try:
+                add_to_servers(cid, servers=args.servers)
+                cn.pstd(cn.color.green('{}: OK'.format(cid)))
+            except (jsonf.LoadError, RuntimeError) as e:
+                cn.pverr(cid, e)
+                cn.pstd(cn.color.red('{}: ERR'.format(cid)))
 
 
 if __name__ == '__main__':
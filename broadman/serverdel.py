@@ -16,6 +16,7 @@ import conz
 
 from . import git
 from . import path
+from . import index
 from . import backlog
 
 
@@ -34,17 +35,20 @@ def validate_servers(servers):
 def remove_from_servers(cid, servers, force=False):
     cid = path.cid(cid)
     errors = False
+    entries = []
     for s in servers:
         cpath = path.contentdir(cid, server=s)
         if os.path.islink(cpath):
             os.unlink(cpath)
             git.commit_remove_from_server(cpath, s)
+            index.remove(cid, s)
         else:
             if not force:
                 errors = True
                 cn.pverr(cid, 'Not found on {}'.format(s))
                 continue
-        backlog.cdel(cid, s)
+        entries.append(('DEL', cid, s))
+    backlog.write_entries(entries)
     return errors
 
 
@@ -54,7 +58,7 @@ def main():
     parser = args.getparser(
         'Remove content from servers',
         usage='%(prog)s [options] CID [CID...]\n       '
-        'CID | %(prog)s [options]')
+        'CID | %(prog)s [options]', has_batch=True)
     required = parser.add_argument_group('required')
     required = required.add_mutually_exclusive_group(required=True)
     parser.add_argument('cids', metavar='CONTENT', nargs='*',
@@ -81,11 +85,13 @@ def main():
     else:
         src = cn.readpipe()
 
-    for cid in src:
-        if remove_from_servers(cid, args.servers, args.force):
-            cn.pstd(cn.color.yellow('{}: WARN'.format(cid)))
-        else:
-            cn.pstd(cn.color.green('{}: OK'.format(cid)))
+    with git.batch(args.batch_size if args.batch else None):
+        for cid in src:
+            cid = cid.strip()
+            if remove_from_servers(cid, args.servers, args.force):
+                cn.pstd(cn.color.yellow('{}: WARN'.format(cid)))
+            else:
+                cn.pstd(cn.color.green('{}: OK'.format(cid)))
 
 
 if __name__ == '__main__':
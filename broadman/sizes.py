@@ -0,0 +1,137 @@
+"""
+Functions for calculating content sizes
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import sqlite3
+
+from git.exc import InvalidGitRepositoryError, NoSuchPathError
+
+from . import git
+from . import path
+
+
+# Number of content directories passed to a single git invocation
+CHUNK = 1000
+
+
+class Sizes:
+    """
+    Content size calculator with a persistent cache
+
+    Sizes are calculated in-process by walking the content directory, and
+    stored in a table in the catalog database keyed on the hash of the
+    committed tree of the content directory. Since the tree hash changes
+    whenever committed content changes, cached sizes never need to be
+    invalidated. Content with pending changes, and content in a pool that is
+    not a repository, is always measured directly.
+
+    Tree hashes and pending changes are looked up only for the requested
+    content. ``load()`` looks them up for many content IDs with a single git
+    invocation each, and is called for a single content ID when a size of
+    content that was not loaded is requested.
+
+    An existing database connection can be passed as ``con`` in order to
+    share it with other tables in the catalog database, in which case it is
+    left to its owner to commit. Otherwise the database is only opened when a
+    cached size is first needed. Tree hashes and pending changes returned by
+    ``state()`` of another instance can be passed as ``state``, so that worker
+    processes do not need to invoke git.
+    """
+    SCHEMA = """
+    create table if not exists sizes (
+        tree text primary key,
+        size integer,
+        usage integer
+    );
+    """
+
+    def __init__(self, db=None, con=None, state=None):
+        self.db = db
+        self.owned = con is None
+        self._con = con
+        if con is not None:
+            con.executescript(self.SCHEMA)
+        self.trees = {}
+        self.changed = set()
+        if state:
+            self.update(state)
+
+    @property
+    def con(self):
+        if self._con is None:
+            db = self.db or path.CATALOG
+            ddir = os.path.dirname(db)
+            if ddir and not os.path.isdir(ddir):
+                os.makedirs(ddir)
+            # Worker processes may share the database, so wait for locks
+            self._con = sqlite3.connect(db, timeout=30)
+            self._con.executescript(self.SCHEMA)
+        return self._con
+
+    def load(self, cids):
+        """ Look up tree hashes and pending changes of given content """
+        cids = list(cids)
+        for i in range(0, len(cids), CHUNK):
+            chunk = cids[i:i + CHUNK]
+            dirs = [path.contentdir(cid) for cid in chunk]
+            try:
+                trees = list(git.list_trees(dirs))
+                changes = git.has_changes(*dirs).split('\n')
+            except (InvalidGitRepositoryError, NoSuchPathError):
+                trees, changes = [], []
+            for cid in chunk:
+                self.trees[cid] = None
+                self.changed.discard(cid)
+            for tpath, tree in trees:
+                self.trees[os.path.basename(tpath)] = tree
+            self.changed.update(path.cid(c) for c in changes if c)
+
+    def state(self, cids=None):
+        """ Return tree hashes and pending changes of given or all loaded
+        content """
+        if cids is None:
+            return self.trees, self.changed
+        cids = set(cids)
+        return (dict((cid, self.trees.get(cid)) for cid in cids),
+                self.changed & cids)
+
+    def update(self, state):
+        """ Add tree hashes and pending changes returned by ``state()`` """
+        trees, changed = state
+        self.trees.update(trees)
+        self.changed.difference_update(trees)
+        self.changed.update(changed)
+
+    def get(self, cid):
+        """ Return a tuple of apparent size and disk usage in bytes """
+        if cid not in self.trees:
+            self.load([cid])
+        cdir = path.contentdir(cid)
+        tree = self.trees[cid]
+        if tree is None or cid in self.changed:
+            return path.dirsize(cdir)
+        row = self.con.execute('select size, usage from sizes where tree = ?',
+                               (tree,)).fetchone()
+        if row:
+            return tuple(row)
+        size, usage = path.dirsize(cdir)
+        self.con.execute('insert or replace into sizes values (?, ?, ?)',
+                         (tree, size, usage))
+        if self.owned:
+            self.con.commit()
+        return size, usage
+
+    def size(self, cid):
+        """ Return apparent size in bytes """
+        return self.get(cid)[0]
+
+    def close(self):
+        if self.owned and self._con is not None:
+            self._con.close()
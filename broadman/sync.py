@@ -36,20 +36,31 @@ this script.
 import os
 import json
 import shlex
+import argparse
 import tempfile
 import datetime
+import functools
+import threading
 import subprocess
-import contextlib
+import collections
 
 import conz
 
 from . import db
+from . import data
 from . import git
 from . import path
 from . import zips
 from . import jsonf
+from . import backlog
+from . import zipcache
 
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 try:
     FILE_ERRORS = (IOError, OSError, FileNotFoundError)
 except NameError:
@@ -82,32 +93,148 @@ def read_syncdef(srv):
     return defs
 
 
-@contextlib.contextmanager
-def patched_info(infopath):
-    # We use a context manager to patch the metadata because zipfile module
-    # does not support modifying contents in-place, and in many cases we cannot
-    # afford to copy contents (e.g., content that's multiple gigabytes).
-    data_orig = jsonf.load(infopath)
-    data = data_orig.copy()
-    data['broadcast'] = broadcast_date()
-    jsonf.save(infopath, data)
-    yield
-    jsonf.save(infopath, data_orig)
+def write_pack(cid, zpath, mtime=None, **kwargs):
+    """ Pack content into a zip file at given path
 
+    The packed metadata has the broadcast date set, while the metadata file
+    in the content directory is left as is. If ``mtime`` (commit time of the
+    content) is specified, the zip file is reproducible, with ``mtime`` used
+    as modification time of all files. Any keyword arguments are passed to
+    ``zips.pack()``.
 
-def pack_content(cid):
+    This is called from worker threads, so it must not use the ``git``
+    module, whose session is not thread-safe.
+    """
     cdir = path.contentdir(cid)
-    tdir = tempfile.mkdtemp()
-    infopath = os.path.join(cdir, 'info.json')
+    with open(path.infopath(cdir), 'rb') as f:
+        info = add_broadcast_date(f.read())
+    zips.pack(zpath, cdir, root=cid, overrides={'info.json': info},
+              mtime=mtime, **kwargs)
 
-    # Pack content
+
+def pack_content(cid, zpath, mtime=None, **kwargs):
     with cn.progress('Packing zip file', excs=FILE_ERRORS + (RuntimeError,)):
-        zname = cid + '.zip'
-        zpath = os.path.join(tdir, zname)
-        with patched_info(infopath):
-            zips.pack(zpath, cdir)
+        write_pack(cid, zpath, mtime, **kwargs)
+
+
+def remove_pack(zpath):
+    tdir = os.path.dirname(zpath)
+    if os.path.exists(zpath):
+        os.unlink(zpath)
+    os.rmdir(tdir)
+
 
-    return zpath
+def content_commits(ops):
+    """ Return latest commit hashes of added content, except for content
+    that has pending changes """
+    changes = git.has_changes(path.serverdir()).split('\n')
+    dirty = set(path.cid(l) for l in changes if l)
+    cids = set(op[1] for op in ops if op[0] == 'ADD')
+    return dict((cid, git.latest_hash(path.contentdir(cid)))
+                for cid in cids - dirty)
+
+
+def commit_times(commits):
+    """ Return commit times of content given a dict of commit hashes """
+    times = git.commit_times(commits.values())
+    return dict((cid, times[sha]) for cid, sha in commits.items())
+
+
+def aired(ops, commits):
+    """ Return (cid, server) pairs of added content whose latest commit is
+    already on the server according to the broadcast database """
+    d = db.connect()
+    return set((op[1], op[2]) for op in ops
+               if op[0] == 'ADD' and op[1] in commits and
+               d.is_aired(op[1], op[2], commits[op[1]]))
+
+
+def renew(pairs, ttl):
+    """ Set expiry of (cid, server) pairs of content that is already on the
+    servers to ``ttl`` days from now """
+    expires = datetime.datetime.utcnow() + datetime.timedelta(days=ttl)
+    d = db.connect()
+    for cid, srv in sorted(pairs):
+        d.set_expiry(cid, srv, expires)
+    d.commit()
+
+
+class Packs:
+    """
+    Zip files of content that is being added to servers
+
+    Content added to several servers is packed once. If ``cache`` is used,
+    zip files of content found in ``commits`` are taken from the cache, and
+    are kept for subsequent runs. Other zip files are packed into temporary
+    directories and removed after they were sent to the last server.
+
+    Content found in ``mtimes`` is packed reproducibly using the given
+    modification time. Commit hashes and times must be looked up in advance,
+    since packing may happen in worker threads, which cannot use git.
+
+    Packing is thread-safe, and each content is packed by the first thread
+    that asks for it while any other threads wait for it.
+    """
+
+    def __init__(self, ops, pack=pack_content, cache=None, commits={},
+                 mtimes={}):
+        self.pack = pack
+        self.cache = cache
+        self.commits = commits
+        self.mtimes = mtimes
+        self.uses = collections.Counter(op[1] for op in ops
+                                        if op[0] == 'ADD')
+        self.packs = {}
+        self.temp = set()
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def make(self, cid):
+        commit = self.commits.get(cid)
+        mtime = self.mtimes.get(cid)
+        if self.cache is not None and commit:
+            return self.cache.get(cid, commit, broadcast_date(),
+                                  lambda zpath: self.pack(cid, zpath, mtime))
+        zpath = os.path.join(tempfile.mkdtemp(), cid + '.zip')
+        try:
+            self.pack(cid, zpath, mtime)
+        except BaseException:
+            remove_pack(zpath)
+            raise
+        with self.lock:
+            self.temp.add(zpath)
+        return zpath
+
+    def get(self, cid):
+        """ Return zip file path and pack time for given content """
+        with self.lock:
+            lock = self.locks.setdefault(cid, threading.Lock())
+        with lock:
+            if cid not in self.packs:
+                zpath = self.make(cid)
+                self.packs[cid] = (zpath, datetime.datetime.utcnow())
+            return self.packs[cid]
+
+    def discard(self, zpath):
+        if zpath in self.temp:
+            self.temp.discard(zpath)
+            remove_pack(zpath)
+        else:
+            self.cache.release(zpath)
+
+    def release(self, cid):
+        """ Note that content was sent to one server """
+        with self.lock:
+            self.uses[cid] -= 1
+            if self.uses[cid] or cid not in self.packs:
+                return
+            zpath, _ = self.packs.pop(cid)
+            self.discard(zpath)
+
+    def cleanup(self):
+        for zpath, _ in self.packs.values():
+            self.discard(zpath)
+        self.packs = {}
 
 
 def get_metadata(cid):
@@ -116,85 +243,379 @@ def get_metadata(cid):
     return jsonf.load(ipath)
 
 
+def add_syncdef(cid, srv, zpath):
+    return read_syncdef(srv)['add'] % {
+        'cid': cid,
+        'zip': os.path.abspath(zpath),
+        'path': os.path.abspath(path.contentdir(cid)),
+    }
+
+
+def del_syncdef(cid, srv):
+    return read_syncdef(srv)['del'] % {
+        'cid': cid
+    }
+
+
+def call_syncdef(syncdef, nosyncdef=False):
+    if nosyncdef:
+        return
+    syncdef = shlex.split(syncdef)
+    subprocess.check_call(syncdef)
+
+
 def run_syncdef(syncdef, nosyncdef=False):
     with cn.progress('Executing syncdef',
                      excs=(subprocess.CalledProcessError,)) as prg:
         if nosyncdef:
             prg.end('SKIPPED')
             return
-        syncdef = shlex.split(syncdef)
-        subprocess.check_call(syncdef)
-
+        call_syncdef(syncdef)
 
-def add_content(cid, srv, user, metadata, nosyncdef=False):
-    # Pack the zipball
-    zpath = pack_content(cid)
-    packed = datetime.datetime.utcnow()
 
-    cdir = path.contentdir(cid)
-    syncdef = read_syncdef(srv)['add'] % {
-        'cid': cid,
-        'zip': os.path.abspath(zpath),
-        'path': os.path.abspath(cdir),
-    }
-    run_syncdef(syncdef, nosyncdef)
-    aired = datetime.datetime.utcnow()
+def store_add(cid, srv, metadata, size, packed, aired, ttl=None):
+    """ Add broadcast to the database without committing it
 
+    If ``ttl`` is specified, the broadcast expires ``ttl`` days after it was
+    aired.
+    """
     # Get extra metadata for the database
-    hash = git.get_history(cdir)[0]
+    hash = git.latest_hash(path.contentdir(cid))
     url = metadata['url']
     title = metadata['title']
-    size = os.stat(zpath).st_size
     collected = datetime.datetime.strptime(metadata['timestamp'], DTFMT)
+    expires = aired + datetime.timedelta(days=ttl) if ttl else None
+    d = db.connect()
+    d.add_content(id=cid, server=srv, commit=hash, title=title, url=url,
+                  size=size, collected=collected, packed=packed,
+                  aired=aired, expires=expires)
+
+
+def store_remove(cid, srv):
+    """ Mark broadcast as removed without committing it """
+    db.connect().remove_content(cid, srv)
+
+
+def add_content(cid, srv, user, metadata, pack, nosyncdef=False, ttl=None):
+    zpath, packed = pack
+    run_syncdef(add_syncdef(cid, srv, zpath), nosyncdef)
+    aired = datetime.datetime.utcnow()
+    size = os.stat(zpath).st_size
 
     # Write the data to database
     with cn.progress('Storing broadcast data', excs=[db.OperationalError]):
-        d = db.DB()
-        d.add_content(id=cid, server=srv, commit=hash, title=title, url=url,
-                      size=size, collected=collected, packed=packed,
-                      aired=aired, expires=None)
-
-    tdir = os.path.dirname(zpath)
-    os.unlink(zpath)
-    os.rmdir(tdir)
+        store_add(cid, srv, metadata, size, packed, aired, ttl)
+        db.connect().commit()
 
 
 def remove_content(cid, srv, user, metadata, nosyncdef=False):
-    syncdef = read_syncdef(srv)['del'] % {
-        'cid': cid
-    }
-    run_syncdef(syncdef, nosyncdef)
+    run_syncdef(del_syncdef(cid, srv), nosyncdef)
     with cn.progress('Storing broadcast data', excs=[db.OperationalError]):
-        d = db.DB()
-        d.remove_content(cid)
+        store_remove(cid, srv)
+        db.connect().commit()
+
+
+class Scheduler:
+    """
+    Hands out backlog operations to worker threads
+
+    Operations are started in backlog order, except that an operation is
+    skipped over while its server already has ``limit`` operations running.
+    Operations for a single server are therefore always started in order, and
+    with the default limit of 1, each one is finished before the next one
+    starts.
+    """
+
+    def __init__(self, ops, limit=1):
+        self.pending = list(enumerate(ops))
+        self.limit = limit
+        self.running = collections.Counter()
+        self.cond = threading.Condition()
+
+    def next(self):
+        """ Return next (index, operation) pair, or ``None`` when done """
+        with self.cond:
+            while self.pending:
+                busy = set()
+                for i, (n, op) in enumerate(self.pending):
+                    srv = op[2]
+                    if srv in busy or self.running[srv] >= self.limit:
+                        # Later operations for this server must wait too
+                        busy.add(srv)
+                        continue
+                    del self.pending[i]
+                    self.running[srv] += 1
+                    return n, op
+                self.cond.wait()
+            return None
+
+    def done(self, op):
+        with self.cond:
+            self.running[op[2]] -= 1
+            self.cond.notify_all()
+
+    def abort(self):
+        """ Do not start any more operations """
+        with self.cond:
+            self.pending = []
+            self.cond.notify_all()
+
+
+def transfer(op, packs, nosyncdef=False):
+    """ Pack content if needed and run the syncdef for given operation
+
+    Returns the pack time, zip file size and time of completion for added
+    content, and ``None`` for removed content.
+    """
+    act, cid, srv = op[:3]
+    if act == 'DEL':
+        call_syncdef(del_syncdef(cid, srv), nosyncdef)
+        return None
+    try:
+        zpath, packed = packs.get(cid)
+        call_syncdef(add_syncdef(cid, srv, zpath), nosyncdef)
+        return packed, os.stat(zpath).st_size, datetime.datetime.utcnow()
+    finally:
+        packs.release(cid)
+
+
+def worker(sched, packs, results, nosyncdef=False):
+    while True:
+        item = sched.next()
+        if item is None:
+            break
+        n, op = item
+        try:
+            ret = transfer(op, packs, nosyncdef)
+            results.put((n, op, ret, None))
+        except Exception as err:
+            results.put((n, op, None, err))
+        finally:
+            sched.done(op)
+    results.put(None)
+
+
+def store_result(op, ret, metadata, ttl=None):
+    """ Store the result of ``transfer()`` without committing it """
+    act, cid, srv = op[:3]
+    if ret is None:
+        store_remove(cid, srv)
+    else:
+        store_add(cid, srv, metadata[cid], ret[1], ret[0], ret[2], ttl)
+
+
+def report(op, err):
+    cn.pverr('{} {}'.format(*op[1:3]), err)
+    cn.pstd(cn.color.red('{} {}: ERR'.format(*op[1:3])))
+
+
+def parsync(ops, packs, jobs, limit=1, nosyncdef=False, journal=None,
+            ttl=None):
+    """ Sync operations using ``jobs`` worker threads
+
+    Packing and syncdefs run in the worker threads, while the database and
+    the ``journal`` are only written to from the calling thread. Returns the
+    list of finished operations in the backlog order.
+    """
+    metadata = dict((op[1], get_metadata(op[1])) for op in ops
+                    if op[0] == 'ADD')
+    sched = Scheduler(ops, limit)
+    results = queue.Queue()
+    threads = [threading.Thread(target=worker,
+                                args=(sched, packs, results, nosyncdef))
+               for _ in range(jobs)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    finished = {}
+    failed = False
+    running = len(threads)
+    try:
+        while running:
+            # Results that are ready are stored in a single transaction
+            batch = [results.get()]
+            while True:
+                try:
+                    batch.append(results.get_nowait())
+                except queue.Empty:
+                    break
+            stored = []
+            for res in batch:
+                if res is None:
+                    running -= 1
+                    continue
+                n, op, ret, err = res
+                if err is None:
+                    try:
+                        store_result(op, ret, metadata, ttl)
+                        stored.append((n, op))
+                        continue
+                    except db.OperationalError as exc:
+                        err = exc
+                failed = True
+                sched.abort()
+                report(op, err)
+            try:
+                db.connect().commit()
+            except db.OperationalError as exc:
+                db.connect().rollback()
+                failed = True
+                sched.abort()
+                for n, op in stored:
+                    report(op, exc)
+                continue
+            for n, op in stored:
+                if journal:
+                    journal.mark(op)
+                finished[n] = result(op)
+                cn.pstd(cn.color.green('{} {}: OK'.format(*op[1:3])))
+    finally:
+        sched.abort()
+        for t in threads:
+            t.join()
+        packs.cleanup()
+    if failed:
+        raise cn.ProgressAbrt()
+    return [finished[n] for n in sorted(finished)]
+
+
+def result(op):
+    """ Return line that represents finished operation in the BKL commit """
+    sign = '+' if op[0] == 'ADD' else '-'
+    return '{} {}'.format(sign, op[1])
+
+
+def resume(ops, completed):
+    """ Split operations into those completed by an interrupted sync, as
+    listed in the journal, and remaining ones
+
+    Returns finished lines for the completed operations in journal order,
+    and a list of remaining operations.
+    """
+    done = [result(l.split(' ')) for l in completed]
+    completed = set(completed)
+    return done, [op for op in ops if ' '.join(op) not in completed]
 
 
 def get_backlog():
-    with open(path.BACKLOG, 'r') as f:
-        return f.readlines()
-
-
-def clear_backlog():
-    with open(path.BACKLOG, 'w') as f:
-        f.write('')
-
-
-def syncall(nosyncdef=False):
-    backlog = get_backlog()
-    if not backlog:
+    # Raw lines are used so that compaction can report what it saved
+    try:
+        with open(path.BACKLOG, 'r') as f:
+            return f.readlines()
+    except FILE_ERRORS:
+        return []
+
+
+def clear_backlog(ops):
+    """ Remove synced operations from the backlog, keeping entries that were
+    added or replaced while syncing """
+    backlog.store().prune(ops)
+
+
+def summary(stats):
+    return ('{entries} backlog entries, {operations} operations ({packs} '
+            'packs and {transfers} transfers saved)'.format(**stats))
+
+
+def plan():
+    """ Print net operations that sync would perform """
+    ops, stats = backlog.compact(get_backlog())
+    done, ops = resume(ops, backlog.Journal().load())
+    for act, cid, srv, user, ts in ops:
+        sign = '+' if act == 'ADD' else '-'
+        cn.pstd('{} {} {}'.format(sign, cid, srv))
+    cn.pstd(summary(stats))
+    if done:
+        cn.pstd('{} operations done by an interrupted sync'.format(len(done)))
+
+
+def syncall(nosyncdef=False, jobs=1, limit=1, budget=zipcache.BUDGET,
+            level=None, sample=False, packjobs=None, force=False, ttl=None):
+    ops, stats = backlog.compact(get_backlog())
+    synced = ops
+    journal = backlog.Journal()
+    done, ops = resume(ops, journal.load())
+    if not ops and not done:
         raise RuntimeError('No backlog')
-    finished = []
-    for bl in backlog:
-        act, cid, srv, user, ts = bl.strip().split(' ')
-        metadata = get_metadata(cid)
-        if act == 'ADD':
-            add_content(cid, srv, user, metadata, nosyncdef)
-            finished.append('+ {}'.format(cid))
-        elif act == 'DEL':
-            remove_content(cid, srv, user, metadata, nosyncdef)
-            finished.append('- {}'.format(cid))
-    clear_backlog()
-    git.commit_backlog(finished)
+    cn.pverb(summary(stats))
+    if done:
+        cn.pstd('resuming sync, {} operations already done'.format(len(done)))
+    cache = None
+    if budget:
+        options = {'level': level, 'sample': sample,
+                   'store': zips.STORED_EXTENSIONS}
+        cache = zipcache.ZipCache(budget, options=options)
+    # Content without pending changes is packed reproducibly
+    commits = content_commits(ops)
+    skipped = []
+    if not force:
+        with cn.progress('Checking broadcast data',
+                         excs=[db.OperationalError]):
+            onair = aired(ops, commits)
+        skipped = ['= {} {}'.format(op[1], op[2]) for op in ops
+                   if (op[1], op[2]) in onair]
+        ops = [op for op in ops if (op[1], op[2]) not in onair]
+        if ttl and onair:
+            # Content does not need to be sent again, but it should stay on
+            # the servers for as long as it would if it were
+            with cn.progress('Updating expiry of aired content',
+                             excs=[db.OperationalError]):
+                renew(onair, ttl)
+    # Looked up in advance, since packing may happen in worker threads
+    mtimes = commit_times(dict((op[1], commits[op[1]]) for op in ops
+                               if op[1] in commits))
+    try:
+        if jobs > 1:
+            pack = functools.partial(write_pack, level=level, sample=sample,
+                                     jobs=packjobs)
+            packs = Packs(ops, pack, cache, commits, mtimes)
+            finished = parsync(ops, packs, jobs, limit, nosyncdef, journal,
+                               ttl)
+        else:
+            finished = []
+            pack = functools.partial(pack_content, level=level,
+                                     sample=sample, jobs=packjobs)
+            packs = Packs(ops, pack, cache, commits, mtimes)
+            try:
+                for op in ops:
+                    act, cid, srv, user, ts = op
+                    metadata = get_metadata(cid)
+                    if act == 'ADD':
+                        pack = packs.get(cid)
+                        add_content(cid, srv, user, metadata, pack,
+                                    nosyncdef, ttl)
+                        packs.release(cid)
+                    elif act == 'DEL':
+                        remove_content(cid, srv, user, metadata, nosyncdef)
+                    journal.mark(op)
+                    finished.append(result(op))
+            finally:
+                packs.cleanup()
+    finally:
+        journal.checkpoint()
+        journal.close()
+    if cache:
+        cn.pstd('zip cache: {} hits, {} misses'.format(cache.hits,
+                                                       cache.misses))
+    if skipped:
+        cn.pstd('{} already aired items skipped'.format(len(skipped)))
+        if ttl:
+            cn.pstd('expiry of skipped items set to {:g} days from now'.format(
+                ttl))
+    # If interrupted before the backlog is cleared, entries completed since
+    # the last checkpoint are synced again, which is safe
+    journal.clear()
+    clear_backlog(synced)
+    # Database file is committed, so the write-ahead log must be merged
+    db.close()
+    git.commit_backlog(done + finished, skipped)
+
+
+def sizearg(s):
+    try:
+        return data.parse_size(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(s))
 
 
 def main():
@@ -205,18 +626,54 @@ def main():
     parser.add_argument('--no-sync-to-server', action='store_true',
                         help='do not sync changes to server (USE THIS OPTION '
                         'ONLY FOR TESTING)', dest='nosync')
+    parser.add_argument('--jobs', '-j', metavar='N', type=int, default=1,
+                        help='number of operations to run in parallel '
+                        '(default: %(default)s)')
+    parser.add_argument('--per-server-limit', metavar='M', type=int,
+                        default=1, dest='limit', help='maximum number of '
+                        'parallel operations per server (default: '
+                        '%(default)s)')
+    parser.add_argument('--zip-cache', metavar='SIZE', type=sizearg,
+                        default=zipcache.BUDGET, dest='budget',
+                        help='maximum size of the zip cache, with b, k or m '
+                        'suffix, or 0 to disable the cache (default: 1024m)')
+    parser.add_argument('--level', '-l', metavar='N', type=int,
+                        choices=range(10), help='deflate compression level '
+                        'from 0 to 9 (default: zlib default)')
+    parser.add_argument('--sample', action='store_true',
+                        help='store files that do not compress well without '
+                        'compression, based on a sample of their contents')
+    parser.add_argument('--pack-jobs', metavar='N', type=int,
+                        dest='packjobs', help='number of threads used to '
+                        'compress a single zip file (default: 1)')
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='sync content even if the same commit was '
+                        'already aired on the server')
+    parser.add_argument('--ttl', metavar='DAYS', type=float,
+                        help='remove synced content from servers after this '
+                        'many days (see the expire tool), also for content '
+                        'that is skipped because it was already aired')
+    parser.add_argument('--plan', '-p', action='store_true',
+                        help='only show the operations that would be '
+                        'performed, with redundant backlog entries removed')
     args = parser.parse_args()
 
     cn.verbose = args.verbose
     cn.debug = args.debug
 
+    if args.plan:
+        plan()
+        return
+
     def fail(msg):
         cn.perr(msg)
         cn.png('backlog sync')
         cn.quit(1)
 
     try:
-        syncall(args.nosync)
+        git.ignore_derived()
+        syncall(args.nosync, args.jobs, args.limit, args.budget, args.level,
+                args.sample, args.packjobs, args.force, args.ttl)
         cn.pok('backlog sync')
     except cn.ProgressAbrt:
         cn.png('backlog sync')
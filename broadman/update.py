@@ -17,6 +17,7 @@ import outernet_metadata.validator as validator
 
 from . import git
 from . import path
+from . import index
 from . import jsonf
 
 
@@ -26,6 +27,7 @@ cn = conz.Console()
 def remove(cid):
     cdir = path.contentdir(cid)
     git.remove(cdir)
+    index.remove(cid)
 
 
 def reset(cid):
@@ -73,7 +75,7 @@ def main():
     parser = args.getparser(
         'Update or reset content',
         usage='%(prog)s [options] CID [CID...])\n       '
-        'CID | %(prog)s [options]')
+        'CID | %(prog)s [options]', has_batch=True)
     parser.add_argument('cids', metavar='CID', nargs='*',
                         help='content ID or content directory path')
     revgrp = parser.add_argument_group('Rollback options')
@@ -107,13 +109,15 @@ def main():
     else:
         fn = update
 
-    for cid in src:
-        cid = path.cid(cid.strip())
-        try:
-            fn(cid)
-            cn.pok(cid)
-        except ValueError:
-            cn.png(cid)
+    git.ignore_derived()
+    with git.batch(args.batch_size if args.batch else None):
+        for cid in src:
+            cid = path.cid(cid.strip())
+            try:
+                fn(cid)
+                cn.pok(cid)
+            except ValueError:
+                cn.png(cid)
 
 
 if __name__ == '__main__':
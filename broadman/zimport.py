@@ -12,6 +12,7 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 
 import os
 import sys
+import errno
 import shutil
 import tempfile
 
@@ -24,6 +25,7 @@ from outernet_metadata import validator
 from . import git
 from . import path
 from . import zips
+from . import index
 from . import jsonf
 from . import editor
 
@@ -77,18 +79,39 @@ def prep_target(p):
     os.makedirs(p)
 
 
-def copy_files(srcdir, targetdir):
-    shutil.copytree(srcdir, targetdir)
+def make_staging():
+    """ Return a new staging directory on the same filesystem as the pool """
+    if not os.path.isdir(path.STAGINGDIR):
+        os.makedirs(path.STAGINGDIR)
+    return tempfile.mkdtemp(dir=path.STAGINGDIR)
+
+
+def move_files(srcdir, targetdir):
+    """ Move unpacked content into place
+
+    This is a single rename, so content is never left half moved. Staging
+    directory on a different filesystem (e.g., when the master directory is a
+    mount point) is an error rather than a reason to copy files.
+    """
+    try:
+        os.rename(srcdir, targetdir)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        raise RuntimeError('{} is not on the same filesystem as {}'.format(
+            path.STAGINGDIR, targetdir))
 
 
 def doimport(p, interactive=False):
     cn.pverb('Importing from {}'.format(p))
-    tmpdir = tempfile.mkdtemp()
-    hash = zips.zcid(p)
-    infpath = os.path.join(tmpdir, hash, 'info.json')
-    target_path = path.contentdir(hash)
+    tmpdir = None
     warnings = False
     try:
+        with cn.progress('Preparing staging directory'):
+            tmpdir = make_staging()
+            hash = zips.zcid(p)
+            infpath = os.path.join(tmpdir, hash, 'info.json')
+            target_path = path.contentdir(hash)
         with cn.progress('Preparing target directory') as prg:
             try:
                 prep_target(target_path)
@@ -106,21 +129,23 @@ def doimport(p, interactive=False):
             except ValueError:
                 warnings = True
                 cn.perr('{} invalid metadata data'.format(hash))
-        with cn.progress('Copying files'):
-            shutil.copytree(os.path.join(tmpdir, hash), target_path)
-        with cn.progress('Cleaning up'):
-            shutil.rmtree(tmpdir)
+        with cn.progress('Moving files into place',
+                         'Cannot move files: {err}'):
+            move_files(os.path.join(tmpdir, hash), target_path)
         with cn.progress('Committing changes', excs=(GitCommandError,)):
             git.commit_import(target_path)
+        index.add(hash)
         if warnings:
             cn.pstd(cn.color.yellow('{} WARN'.format(p)))
         else:
             cn.pstd(cn.color.green('{} OK'.format(p)))
     except cn.ProgressAbrt:
         cn.pstd(cn.color.red('{} ERR'.format(p)))
-        shutil.rmtree(tmpdir)
         if cn.verbose:
             sys.exit(1)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 def main():
@@ -129,8 +154,8 @@ def main():
     parser = args.getparser(
         'Import existing content zipball into content pool',
         usage='%(prog)s [-h] [-V] [-v] PATH\n'
-        '       PATH | %(prog)s [-h] [-V]',
-        has_debug=True)
+        '       PATH | %(prog)s [-h] [-V] [-b] [--batch-size N]',
+        has_debug=True, has_batch=True)
 
     parser.add_argument('path', metavar='PATH', nargs='?',
                         help='path to zipball')
@@ -146,10 +171,11 @@ def main():
             sys.exit(0)
         doimport(args.path)
     else:
-        p = sys.stdin.readline()
-        while p:
-            doimport(p.strip())
+        with git.batch(args.batch_size if args.batch else None):
             p = sys.stdin.readline()
+            while p:
+                doimport(p.strip())
+                p = sys.stdin.readline()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""
+Functions for working with the cache of packed content
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+
+from . import path
+
+
+# Default cache size in bytes
+BUDGET = 1024 * 1024 * 1024
+
+
+class ZipCache:
+    """
+    Cache of content zip files keyed on content ID, commit hash, broadcast
+    date and pack options
+
+    Each zip file is stored in its own directory in ``path.ZIPDIR``, and is
+    always named ``<cid>.zip`` so that the name seen by syncdefs does not
+    depend on whether the zip file was cached.
+
+    When total size of the cached zip files exceeds the ``budget``, least
+    recently used files are removed. Use is tracked using modification time
+    of the zip files, which is updated on each cache hit. Files that were
+    handed out and not yet released are never removed.
+
+    ``options`` is a dict of settings that affect the contents of zip files
+    (e.g., compression level), so that zip files packed with different
+    settings are cached separately.
+    """
+
+    def __init__(self, budget=BUDGET, cdir=None, options={}):
+        self.dir = cdir or path.ZIPDIR
+        self.budget = budget
+        self.variant = hashlib.sha1(json.dumps(
+            options, sort_keys=True).encode('utf8')).hexdigest()[:8]
+        self.hits = 0
+        self.misses = 0
+        self.inuse = set()
+        self.lock = threading.Lock()
+
+    def entry(self, cid, commit, date):
+        name = '{}.{}.{}.{}'.format(cid, commit, date, self.variant)
+        return os.path.join(self.dir, name, cid + '.zip')
+
+    def get(self, cid, commit, date, pack):
+        """ Return path to the zip file for given key
+
+        If the zip file is not cached, ``pack`` is called with a temporary
+        path to which it should write the zip file.
+        """
+        zpath = self.entry(cid, commit, date)
+        with self.lock:
+            self.inuse.add(zpath)
+        if os.path.exists(zpath):
+            os.utime(zpath, None)
+            with self.lock:
+                self.hits += 1
+            return zpath
+        try:
+            zdir = os.path.dirname(zpath)
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            tdir = tempfile.mkdtemp(dir=self.dir, prefix='.')
+            tmp = os.path.join(tdir, cid + '.zip')
+            try:
+                pack(tmp)
+                os.rename(tdir, zdir)
+            except OSError:
+                shutil.rmtree(tdir, ignore_errors=True)
+                # Another process may have packed the same content
+                if not os.path.exists(zpath):
+                    raise
+            except Exception:
+                shutil.rmtree(tdir, ignore_errors=True)
+                raise
+        except Exception:
+            self.release(zpath)
+            raise
+        with self.lock:
+            self.misses += 1
+        self.evict()
+        return zpath
+
+    def release(self, zpath):
+        """ Allow the zip file to be evicted """
+        with self.lock:
+            self.inuse.discard(zpath)
+
+    def evict(self):
+        """ Remove least recently used zip files until cache fits budget """
+        with self.lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.dir):
+                if name.startswith('.'):
+                    continue
+                zpath = os.path.join(self.dir, name, name.split('.')[0] +
+                                     '.zip')
+                try:
+                    st = os.stat(zpath)
+                except path.FILE_ERRORS:
+                    continue
+                entries.append((st.st_mtime, st.st_size, zpath))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, zpath in entries:
+                if total <= self.budget:
+                    break
+                if zpath in self.inuse:
+                    continue
+                shutil.rmtree(os.path.dirname(zpath), ignore_errors=True)
+                total -= size
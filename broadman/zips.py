@@ -9,9 +9,29 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import os
+import time
+import zlib
 import zipfile
 
 from . import path
+from . import pzip
+
+
+# Extensions of files that are already compressed, and are therefore stored
+# in zip files without compression
+STORED_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.webp',
+    '.mp3', '.ogg', '.oga', '.m4a', '.opus',
+    '.mp4', '.m4v', '.ogv', '.webm', '.mkv',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z',
+    '.pdf', '.woff', '.woff2',
+)
+
+# Number of bytes sampled when guessing whether file is compressible
+SAMPLE_SIZE = 64 * 1024
+
+# Files whose sample does not shrink below this ratio are stored
+SAMPLE_RATIO = 0.95
 
 
 def zcid(p):
@@ -35,12 +55,93 @@ def unzip(p, dest):
     z.close()
 
 
-def pack(zpath, src):
-    """ Create a new zip file from the specified directory """
-    hash = os.path.splitext(os.path.basename(zpath))[0]
-    zfile = zipfile.ZipFile(zpath, mode='w', compression=zipfile.ZIP_DEFLATED)
+def is_compressible(p):
+    """ Guess whether file is compressible by compressing its first bytes """
+    with open(p, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if len(sample) < 1024:
+        return True
+    return len(zlib.compress(sample, 1)) < len(sample) * SAMPLE_RATIO
+
+
+def compress_type(p, store=STORED_EXTENSIONS, sample=False):
+    """ Return zip compression type for given file
+
+    Files with extensions listed in ``store`` are not compressed. If
+    ``sample`` is ``True``, other files are not compressed either if their
+    sample does not compress well.
+    """
+    if os.path.splitext(p)[1].lower() in store:
+        return zipfile.ZIP_STORED
+    if sample and not is_compressible(p):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def override_info(zipname):
+    """ Return zip member info for data that is not read from a file """
+    zinfo = zipfile.ZipInfo(zipname, time.localtime()[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o644 << 16
+    return zinfo
+
+
+def members(src, root, overrides={}, store=STORED_EXTENSIONS, sample=False):
+    """ Return list of members for a zip file of the specified directory
+
+    Members are (zipname, fpath, data, compress_type) tuples sorted by name,
+    where ``data`` is ``None`` unless the file is overridden. See ``pack()``
+    for the meaning of the arguments.
+    """
+    overrides = dict((os.path.normpath(k), v) for k, v in overrides.items())
+    items = []
     for f in path.fnwalk(src, lambda x: os.path.isfile(x)):
-        zipname = os.path.join(hash, os.path.relpath(f, src))
-        zfile.write(f, arcname=zipname)
+        relpath = os.path.relpath(f, src)
+        zipname = os.path.join(root, relpath)
+        if relpath in overrides:
+            items.append((zipname, f, overrides.pop(relpath),
+                          zipfile.ZIP_DEFLATED))
+        else:
+            items.append((zipname, f, None, compress_type(f, store, sample)))
+    for relpath, data in overrides.items():
+        items.append((os.path.join(root, relpath), None, data,
+                      zipfile.ZIP_DEFLATED))
+    return sorted(items, key=lambda m: m[0])
+
+
+def pack(zpath, src, root=None, overrides={}, level=None,
+         store=STORED_EXTENSIONS, sample=False, jobs=None, mtime=None):
+    """ Create a new zip file from the specified directory
+
+    Files are stored in a directory named ``root`` within the zip file, which
+    defaults to the zip file name without the extension.
+
+    ``overrides`` maps paths relative to ``src`` to bytes that are stored in
+    the zip file instead of the contents of those files. Overrides for files
+    that do not exist are added to the zip file as well. Source directory is
+    never modified.
+
+    Compressed files use deflate ``level`` (zlib default if not specified).
+    See ``compress_type()`` for the meaning of ``store`` and ``sample``.
+
+    If ``jobs`` is greater than 1, files are compressed using that many
+    threads (see ``pzip`` module). The ``pzip`` module is also used when
+    ``level`` is specified, since ``zipfile`` only supports compression
+    levels on Python 3.7 and later.
+
+    If ``mtime`` is specified (usually the commit time of the content), the
+    zip file is reproducible: all members have ``mtime`` as modification
+    time and normalized permissions, so packing the same files again yields
+    an identical zip file regardless of ``jobs``.
+    """
+    items = members(src, root or zcid(zpath), overrides, store, sample)
+    if mtime is not None or level is not None or (jobs and jobs > 1):
+        return pzip.write(zpath, items, level, jobs or 1, mtime)
+    zfile = zipfile.ZipFile(zpath, mode='w', compression=zipfile.ZIP_DEFLATED)
+    for zipname, f, data, ctype in items:
+        if data is not None:
+            zfile.writestr(override_info(zipname), data)
+        else:
+            zfile.write(f, arcname=zipname, compress_type=ctype)
     zfile.close()
     return zpath
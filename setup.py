@@ -67,10 +67,15 @@ setup(
             'med = broadman.setmeta:main',
             'mcat = broadman.catmeta:main',
             'mclean = broadman.cleanmeta:main',
+            'mrefresh = broadman.refreshmeta:main',
             'pinit = broadman.initrepo:main',
+            'pmigrate = broadman.migrate:main',
             'srvadd = broadman.serveradd:main',
             'srvdel = broadman.serverdel:main',
             'srvsync = broadman.sync:main',
+            'expire = broadman.expire:main',
+            'bcreport = broadman.report:main',
+            'bclog = broadman.bclog:main',
             'update = broadman.update:main',
             'lschanged = broadman.getchanged:main',
         ],
@@ -0,0 +1,227 @@
+"""
+Tests for broadman.backlog module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import pytest
+
+import broadman.path as path
+import broadman.backlog as mod
+
+MOD = mod.__name__
+
+LINES = [
+    'ADD accbcb49659267846e5590b4694ee769 s1 foo@bar.com 2015-04-01T12:00:00',
+    'DEL acd6bc4b1e2d4e2a9c1e6b0e8a0f4f11 s1 foo@bar.com 2015-04-01T12:00:00',
+    'ADD accbcb49659267846e5590b4694ee769 s2 foo@bar.com 2015-04-01T12:00:00',
+]
+
+
+@pytest.fixture
+def backlog(tmpdir, monkeypatch):
+    """
+    Backlog file with a few entries
+    """
+    p = str(tmpdir.join('.backlog'))
+    with open(p, 'w') as f:
+        f.write('\n'.join(LINES) + '\n')
+    monkeypatch.setattr(path, 'BACKLOG', p)
+    monkeypatch.setattr(mod, '_backlog', None)
+    return p
+
+
+def read(p):
+    with open(p, 'r') as f:
+        return f.read().splitlines()
+
+
+def test_get(backlog):
+    """
+    Given a backlog file
+    When entry is looked up by content ID and server
+    Then matching entry is returned split into parts
+    """
+    b = mod.Backlog()
+    assert b.get('accbcb49659267846e5590b4694ee769', 's2') == LINES[2].split()
+    assert b.get('accbcb49659267846e5590b4694ee769', 's3') is None
+
+
+def test_add_appends(backlog):
+    """
+    Given a backlog file
+    When new entry is added and written
+    Then it is appended to the file
+    """
+    b = mod.Backlog()
+    line = 'ADD 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s1 foo@bar.com 2015-04-01'
+    b.add(line)
+    assert not b.dirty
+    assert read(backlog) == LINES
+    b.write()
+    assert read(backlog) == LINES + [line]
+
+
+def test_add_replaces(backlog):
+    """
+    Given a backlog file
+    When entry for existing cid-server combination is added
+    Then old entry is removed and file is rewritten on save
+    """
+    b = mod.Backlog()
+    line = 'DEL accbcb49659267846e5590b4694ee769 s1 foo@bar.com 2015-04-02'
+    b.add(line)
+    assert b.dirty
+    assert read(backlog) == LINES
+    b.save()
+    assert read(backlog) == LINES[1:] + [line]
+
+
+def test_cdel_reverts_add(backlog, monkeypatch):
+    """
+    Given a backlog with an ADD entry
+    When content is removed from the same server
+    Then ADD entry is removed instead of adding a DEL entry
+    """
+    monkeypatch.setattr(mod, '_user', 'foo@bar.com')
+    mod.cdel('accbcb49659267846e5590b4694ee769', 's1')
+    mod.save()
+    assert read(backlog) == LINES[1:]
+
+
+def test_clear(backlog):
+    """
+    Given a backlog file
+    When backlog is cleared
+    Then file is emptied
+    """
+    mod.store().clear()
+    assert read(backlog) == []
+    assert os.path.exists(backlog)
+
+
+def test_save_keeps_appended(backlog):
+    """
+    Given a loaded backlog
+    When another process appends entries before it is saved
+    Then appended entries are kept in the rewritten file
+    """
+    b = mod.Backlog()
+    b.remove('accbcb49659267846e5590b4694ee769', 's1')
+    other = mod.Backlog()
+    line = 'ADD 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s1 foo@bar.com 2015-04-02'
+    other.add(line)
+    other.write()
+    b.save()
+    assert read(backlog) == LINES[1:] + [line]
+    b.clear()
+    other.add(line.replace('s1', 's2'))
+    other.write()
+    assert read(backlog) == [line.replace('s1', 's2')]
+
+
+def test_write_keeps_appended(backlog):
+    """
+    Given a loaded backlog
+    When another process appends entries before new entries are written
+    Then entries of both are in the file and in memory
+    """
+    b = mod.Backlog()
+    b.load()
+    other = mod.Backlog()
+    line = 'ADD 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s1 foo@bar.com 2015-04-02'
+    other.add(line)
+    other.write()
+    mine = 'ADD 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s2 foo@bar.com 2015-04-02'
+    b.add(mine)
+    b.write()
+    assert read(backlog) == LINES + [line, mine]
+    assert b.lines() == LINES + [line, mine]
+
+
+def test_write_entries(backlog, monkeypatch):
+    """
+    Given a backlog file
+    When multiple entries are written at once
+    Then they share the timestamp and are applied in order
+    """
+    monkeypatch.setattr(mod, '_user', 'foo@bar.com')
+    monkeypatch.setattr(mod, 'timestamp', lambda: '2015-04-02T12:00:00')
+    mod.write_entries([
+        ('ADD', '0f1e2d3c4b5a69788796a5b4c3d2e1f0', 's1'),
+        ('DEL', '0f1e2d3c4b5a69788796a5b4c3d2e1f0', 's1'),
+        ('DEL', '0f1e2d3c4b5a69788796a5b4c3d2e1f0', 's2'),
+        ('ADD', '0f1e2d3c4b5a69788796a5b4c3d2e1f0', 's3'),
+    ])
+    mod.save()
+    assert read(backlog) == LINES + [
+        'DEL 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s2 foo@bar.com '
+        '2015-04-02T12:00:00',
+        'ADD 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s3 foo@bar.com '
+        '2015-04-02T12:00:00',
+    ]
+
+
+def test_compact():
+    """
+    Given backlog lines with redundant entries
+    When backlog is compacted
+    Then only the last operation for each cid-server combination is kept
+    """
+    lines = LINES + [
+        'DEL accbcb49659267846e5590b4694ee769 s1 foo@bar.com 2015-04-02',
+        'ADD accbcb49659267846e5590b4694ee769 s1 foo@bar.com 2015-04-03',
+        '',
+    ]
+    ops, stats = mod.compact(lines)
+    assert [' '.join(o) for o in ops] == LINES[1:] + [lines[-2]]
+    assert stats == {
+        'entries': 5,
+        'operations': 3,
+        'packs': 2,
+        'transfers': 2,
+    }
+
+
+def test_journal(backlog):
+    """
+    Given a journal with completed backlog entries
+    When a checkpoint is reached
+    Then completed entries are removed from the backlog
+    """
+    journal = mod.Journal(backlog + '.journal', interval=2)
+    journal.mark(LINES[0].split(' '))
+    assert read(backlog) == LINES
+    journal.mark(LINES[1].split(' '))
+    assert read(backlog) == LINES[2:]
+    journal.close()
+    assert mod.Journal(backlog + '.journal').load() == LINES[:2]
+    journal.clear()
+    assert not os.path.exists(backlog + '.journal')
+
+
+def test_journal_keeps_added(backlog):
+    """
+    Given a backlog that was loaded before a sync started
+    When entries are added or replaced by another process during the sync
+    Then a checkpoint only removes completed entries that were not replaced
+    """
+    mod.store().load()
+    other = mod.Backlog()
+    readded = LINES[0].replace('2015-04-01', '2015-04-02')
+    added = 'ADD 0f1e2d3c4b5a69788796a5b4c3d2e1f0 s1 foo@bar.com 2015-04-02'
+    other.add(readded)
+    other.add(added)
+    other.save()
+    journal = mod.Journal(backlog + '.journal')
+    journal.mark(LINES[0].split(' '))
+    journal.mark(LINES[1].split(' '))
+    journal.checkpoint()
+    journal.clear()
+    assert read(backlog) == [LINES[2], readded, added]
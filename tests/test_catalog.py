@@ -0,0 +1,222 @@
+"""
+Tests for broadman.catalog module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import json
+import shutil
+import argparse
+
+import pytest
+
+import broadman.git as git
+import broadman.path as path
+import broadman.index as index
+import broadman.filterjson as filterjson
+import broadman.catalog as mod
+
+MOD = mod.__name__
+
+parametrize = pytest.mark.parametrize
+
+CONTENT = {
+    'accbcb49659267846e5590b4694ee769': {
+        'title': 'Quick brown Fox',
+        'url': 'http://example.com/fox',
+        'broadcast': '2015-04-25',
+        'images': 3,
+        'is_partner': False,
+    },
+    'acd6bc4b1e2d4e2a9c1e6b0e8a0f4f11': {
+        'title': 'Lazy old Dog',
+        'url': 'http://example.com/dog',
+        'broadcast': '2015-03-10',
+        'images': 1,
+        'is_partner': True,
+    },
+    '0f1e2d3c4b5a69788796a5b4c3d2e1f0': {
+        'title': 42,
+        'url': 'http://example.com/42',
+        'broadcast': '2015-04-01',
+        'is_partner': False,
+    },
+}
+
+MISSING = 'ffffffffffffffffffffffffffffffff'
+
+
+def write(cid, meta, size=0):
+    cdir = path.contentdir(cid)
+    if not os.path.isdir(cdir):
+        os.makedirs(cdir)
+    with open(path.infopath(cdir), 'w') as f:
+        json.dump(meta, f)
+    with open(os.path.join(cdir, 'index.html'), 'w') as f:
+        f.write('x' * size)
+    return cdir
+
+
+@pytest.fixture
+def cat(tmpdir, monkeypatch):
+    """
+    Catalog of a pool with committed content of different sizes
+    """
+    pooldir = str(tmpdir.join('pool'))
+    os.makedirs(pooldir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pooldir, '.version'))
+    monkeypatch.setattr(path, 'INDEXDIR', str(tmpdir.join('index')))
+    monkeypatch.setattr(path, '_layout', None)
+    monkeypatch.setattr(git, '_session', None)
+    monkeypatch.setattr(index, '_indexes', {})
+    git.init()
+    for i, (cid, meta) in enumerate(sorted(CONTENT.items())):
+        git.commit(write(cid, meta, 1000 * i), 'ADD')
+    c = mod.Catalog(str(tmpdir.join('catalog.sqlite')))
+    c.refresh()
+    yield c
+    c.close()
+
+
+def test_refresh(cat):
+    """
+    Given content in the pool
+    When catalog is refreshed
+    Then metadata is stored both as a whole and in key columns
+    """
+    for cid, meta in CONTENT.items():
+        assert cat.metadata(cid) == meta
+        row = cat.get(cid)
+        assert row['url'] == meta['url']
+        assert row['is_partner'] == meta['is_partner']
+    assert mod.rowdata(cat.get(sorted(CONTENT)[1])) == {
+        'title': 'Quick brown Fox',
+        'url': 'http://example.com/fox',
+        'broadcast': '2015-04-25',
+        'is_partner': False,
+    }
+
+
+def test_refresh_irregular(cat):
+    """
+    Given metadata with a value that does not have the type of its column
+    When catalog is refreshed
+    Then the value is left out of the column and the row is irregular
+    """
+    row = cat.get('0f1e2d3c4b5a69788796a5b4c3d2e1f0')
+    assert row['irregular']
+    assert row['title'] is None
+    assert not cat.get('accbcb49659267846e5590b4694ee769')['irregular']
+
+
+def test_refresh_incremental(cat):
+    """
+    Given a refreshed catalog
+    When catalog is refreshed after content changes
+    Then only the changed content is reloaded
+    """
+    cid = 'acd6bc4b1e2d4e2a9c1e6b0e8a0f4f11'
+    assert cat.refresh() == 0
+    meta = dict(CONTENT[cid], title='Lazy young Dog')
+    cdir = write(cid, meta)
+    mtime = cat.get(cid)['mtime'] + 10
+    os.utime(path.infopath(cdir), (mtime, mtime))
+    assert cat.refresh() == 1
+    assert cat.get(cid)['title'] == 'Lazy young Dog'
+    assert cat.get(cid)['size'] < 1000
+
+
+def test_refresh_committed(cat):
+    """
+    Given a refreshed catalog
+    When content changes are committed without changing modification times
+    Then the content is reloaded on next refresh
+    """
+    cid = 'accbcb49659267846e5590b4694ee769'
+    old = cat.get(cid)['commit_hash']
+    cdir = path.contentdir(cid)
+    mtime = cat.get(cid)['mtime']
+    with open(os.path.join(cdir, 'index.html'), 'a') as f:
+        f.write('y')
+    git.commit(cdir, 'UPDATE')
+    os.utime(cdir, (mtime, mtime))
+    assert cat.refresh() == 1
+    assert cat.get(cid)['commit_hash'] not in (None, old)
+
+
+def test_refresh_hashes(cat, tmpdir, monkeypatch):
+    """
+    Given committed content
+    When a new catalog is refreshed
+    Then commit hashes of all content are looked up at once
+    """
+    expected = dict((cid, git.latest_hash(path.contentdir(cid)))
+                    for cid in CONTENT)
+    monkeypatch.setattr(git, 'latest_hash', None)
+    c = mod.Catalog(str(tmpdir.join('new.sqlite')))
+    assert c.refresh() == len(CONTENT)
+    for cid in CONTENT:
+        assert c.get(cid)['commit_hash'] == expected[cid]
+    c.close()
+
+
+def test_refresh_removed(cat):
+    """
+    Given a refreshed catalog
+    When content is removed from the pool
+    Then it is removed from the catalog on next refresh
+    """
+    cid = 'acd6bc4b1e2d4e2a9c1e6b0e8a0f4f11'
+    shutil.rmtree(path.contentdir(cid))
+    index.remove(cid)
+    assert cat.refresh() == 0
+    assert cat.get(cid) is None
+    assert cat.get('accbcb49659267846e5590b4694ee769') is not None
+
+
+def filterargs(query=None, key=None, keyword=None, **kwargs):
+    opts = dict(x=False, i=False, gt=False, lt=False, exclude=False, t=None)
+    opts.update(kwargs)
+    return argparse.Namespace(query=query, key=key, keyword=keyword, **opts)
+
+
+@parametrize('args', [
+    filterargs('title~Fox'),
+    filterargs('title~fox', i=True),
+    filterargs('title=42'),
+    filterargs('NOT title~o'),
+    filterargs('missing~x OR missing!=x'),
+    filterargs('size>=1k AND NOT is_partner:b=yes'),
+    filterargs('size=500..1500'),
+    filterargs('broadcast:d>2015-03-31'),
+    filterargs('images:n>2 OR url~dog'),
+    filterargs(key='title', keyword='DOG', i=True),
+    filterargs(key='title', keyword='Dog', exclude=True),
+    filterargs(key='size', keyword='1k'),
+    filterargs(key='is_partner', keyword='yes', t='b'),
+])
+def test_filter_catalog(cat, args, monkeypatch):
+    """
+    Given a refreshed catalog
+    When filtering content with --catalog
+    Then the same content matches as when metadata files are filtered, in
+    input order, and content that is not in the catalog is reported
+    """
+    monkeypatch.setattr(filterjson, '_sizes', cat.sizes)
+    out = []
+    err = []
+    monkeypatch.setattr(filterjson.cn, 'pstd', out.append)
+    monkeypatch.setattr(filterjson.cn, 'pverr', lambda p, msg: err.append(p))
+    paths = [path.contentdir(cid) for cid in CONTENT]
+    match = filterjson.getmatcher(args)
+    expected = [p for p in paths if filterjson.evaluate(p, match)]
+    src = [p + '\n' for p in paths] + [path.contentdir(MISSING)]
+    filterjson.catmatch(src, args, match, cat)
+    assert out == expected
+    assert err == [path.contentdir(MISSING)]
@@ -176,3 +176,52 @@ def test_bmatch():
     assert mod.bmatch(True, True)
     assert mod.bmatch(1, 1)
     assert not mod.bmatch(True, False)
+
+
+def test_coerce():
+    """
+    Given a value from data and a type marker, when coerce() is called, then
+    it returns the value converted to appropriate type, or None if conversion
+    is not possible.
+    """
+    assert mod.coerce('2015-04-25', 'd') == datetime.datetime(2015, 4, 25)
+    assert mod.coerce('2015-04-25 15:00:21 UTC', 't') == datetime.datetime(
+        2015, 4, 25, 15, 0, 21)
+    assert mod.coerce(12, 'n') == 12
+    assert mod.coerce('12', 'n') == 12.0
+    assert mod.coerce(1, 'b') is True
+    assert mod.coerce('foo', 'n') is None
+    assert mod.coerce(None, 'd') is None
+    assert mod.coerce('foo') == 'foo'
+
+
+def test_matcher_numeric():
+    """
+    Given a key, keyword and numeric type, when matcher() is called, then it
+    returns a function that performs a numeric match against data.
+    """
+    match = mod.matcher('bar', '10', 'n', gt=True)
+    assert match(DATA)
+    assert not match({'bar': 2})
+    assert not match({})
+
+
+def test_matcher_invert():
+    """
+    Given invert flag, when matcher() is called, then it returns a function
+    that returns True for data that does not match.
+    """
+    match = mod.matcher('foo', 'fox', icase=True, invert=True)
+    assert not match(DATA)
+    assert match({'foo': 'cat'})
+
+
+def test_parse_size():
+    """
+    Given a size string with optional unit, when parse_size() is called, then
+    it returns the number of bytes.
+    """
+    assert mod.parse_size('2') == 2
+    assert mod.parse_size('2k') == 2048
+    assert mod.parse_size('1Mb') == 1024 * 1024
+    assert mod.parse_size('10k') == 10 * 1024
@@ -0,0 +1,258 @@
+"""
+Tests for broadman.db module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import json
+import sqlite3
+import datetime
+
+import pytest
+
+import broadman.db as mod
+
+MOD = mod.__name__
+
+
+@pytest.fixture
+def dbpath(tmpdir):
+    p = str(tmpdir.join('broadcast.sqlite'))
+    now = datetime.datetime.utcnow()
+    d = mod.DB(p)
+    for srv in ('s1', 's2'):
+        d.add_content(id='a', server=srv, commit='c1', title='foo',
+                      url='http://example.com/', size=10, collected=now,
+                      packed=now, aired=now)
+    d.close()
+    return p
+
+
+def test_is_aired(dbpath):
+    """
+    Given content aired on a server
+    When checking whether a commit is aired
+    Then only the aired commit on that server matches
+    """
+    d = mod.DB(dbpath)
+    assert d.is_aired('a', 's1', 'c1')
+    assert not d.is_aired('a', 's1', 'c2')
+    assert not d.is_aired('a', 's3', 'c1')
+    assert not d.is_aired('b', 's1', 'c1')
+    d.close()
+
+
+def test_remove_content(dbpath):
+    """
+    Given content aired on two servers
+    When it is removed from one server
+    Then it is still aired on the other
+    """
+    d = mod.DB(dbpath)
+    d.remove_content('a', 's1')
+    d.close()
+    d = mod.DB(dbpath)
+    assert not d.is_aired('a', 's1', 'c1')
+    assert d.is_aired('a', 's2', 'c1')
+    d.close()
+
+
+def test_commit(dbpath):
+    """
+    Given uncommitted changes
+    When they are committed
+    Then other connections can see them
+    """
+    d = mod.DB(dbpath)
+    d.remove_content('a', 's1')
+    other = mod.DB(dbpath)
+    assert other.is_aired('a', 's1', 'c1')
+    d.commit()
+    assert not other.is_aired('a', 's1', 'c1')
+    d.close()
+    other.close()
+
+
+def test_migrate(tmpdir):
+    """
+    Given a database created before schema versions were introduced
+    When it is opened
+    Then it is migrated to the latest version
+    """
+    p = str(tmpdir.join('broadcast.sqlite'))
+    con = sqlite3.connect(p)
+    con.executescript(mod.DB.SCHEMA)
+    con.execute("insert into broadcasts (content_id, url) values "
+                "('a', 'http://www.example.com/foo')")
+    con.commit()
+    con.close()
+    d = mod.DB(p)
+    assert d.version == len(mod.DB.MIGRATIONS)
+    indexes = [r['name'] for r in d.con.execute(
+        "select name from sqlite_master where type = 'index'")]
+    assert 'broadcasts_daily' in indexes
+    row = d.con.execute('select publisher from broadcasts').fetchone()
+    assert row['publisher'] == 'example.com'
+    d.close()
+
+
+def test_readonly(dbpath):
+    """
+    Given a database that does not use write-ahead logging
+    When it is opened read-only
+    Then its journal mode is left alone
+    """
+    con = sqlite3.connect(dbpath)
+    con.execute('pragma journal_mode = delete')
+    con.close()
+    d = mod.DB(dbpath, readonly=True)
+    assert not d.migrated
+    assert d.is_aired('a', 's1', 'c1')
+    d.close()
+    con = sqlite3.connect(dbpath)
+    assert con.execute('pragma journal_mode').fetchone()[0] == 'delete'
+    con.close()
+
+
+def test_readonly_upgrade(tmpdir):
+    """
+    Given a database created before schema versions were introduced
+    When it is opened read-only
+    Then it is upgraded in memory, and the database file is left unchanged
+    """
+    p = str(tmpdir.join('bc.sqlite'))
+    con = sqlite3.connect(p)
+    con.executescript(mod.DB.SCHEMA)
+    con.execute("insert into broadcasts (content_id, server_id, commit_hash) "
+                "values ('a', 's1', 'c1')")
+    con.commit()
+    con.close()
+    with open(p, 'rb') as f:
+        before = f.read()
+    d = mod.DB(p, readonly=True)
+    assert d.migrated
+    assert d.version == len(mod.DB.MIGRATIONS)
+    assert d.is_aired('a', 's1', 'c1')
+    d.close()
+    with open(p, 'rb') as f:
+        assert f.read() == before
+
+
+def test_readonly_missing(tmpdir):
+    """
+    Given a database that does not exist
+    When it is opened read-only
+    Then an empty database is used, and no file is created
+    """
+    p = str(tmpdir.join('bc.sqlite'))
+    d = mod.DB(p, readonly=True)
+    assert d.con.execute('select * from broadcasts').fetchall() == []
+    d.close()
+    assert not os.path.exists(p)
+
+
+def test_log(tmpdir):
+    """
+    Given a database with a broadcast log
+    When changes are committed
+    Then they are appended to the log, and the database can be rebuilt
+    """
+    p = str(tmpdir.join('bc.sqlite'))
+    log = str(tmpdir.join('broadcast.log'))
+    now = datetime.datetime.utcnow()
+    d = mod.DB(p, log=log)
+    d.add_content(id='a', server='s1', commit='c1', title='foo',
+                  url='http://example.com/', size=10, collected=now,
+                  packed=now, aired=now)
+    d.commit()
+    d.remove_content('a', 's1')
+    d.close()
+    with open(log) as f:
+        assert [r['action'] for r in map(json.loads, f)] == ['ADD', 'DEL']
+    os.unlink(p)
+    d = mod.DB(p, log=log)
+    row = d.con.execute('select * from broadcasts').fetchone()
+    assert row['aired'] == now.isoformat(' ')
+    assert row['removed'] is not None
+    d.close()
+
+
+def test_log_reverted(dbpath, tmpdir):
+    """
+    Given a database built from a log
+    When the log is truncated
+    Then the database is rebuilt from the log
+    """
+    log = str(tmpdir.join('broadcast.log'))
+    with open(log, 'w') as f:
+        mod.export(mod.DB(dbpath), f)
+    p = str(tmpdir.join('bc.sqlite'))
+    mod.load(p, log)
+    with open(log) as f:
+        first = f.readline()
+    with open(log, 'w') as f:
+        f.write(first)
+    d = mod.DB(p, log=log)
+    assert [r['server_id'] for r in d.con.execute(
+        'select server_id from broadcasts')] == ['s1']
+    d.close()
+
+
+def test_expired(tmpdir):
+    """
+    Given content with and without expiry times
+    When looking for expired content
+    Then only content whose latest broadcast on the server expired is found
+    """
+    p = str(tmpdir.join('broadcast.sqlite'))
+    now = datetime.datetime(2015, 4, 1, 12)
+    day = datetime.timedelta(days=1)
+    d = mod.DB(p)
+    for cid, srv, expires in [('a', 's1', now - day),
+                              ('b', 's1', now - 2 * day),
+                              ('c', 's1', now + day),
+                              ('d', 's1', None),
+                              ('e', 's1', now - day),
+                              ('e', 's1', None),
+                              ('f', 's1', now - day)]:
+        d.add_content(id=cid, server=srv, commit='c1', title='foo',
+                      url='http://example.com/', size=10, collected=now,
+                      packed=now, aired=now, expires=expires)
+    d.remove_content('f', 's1')
+    assert d.expired(now) == [('b', 's1'), ('a', 's1')]
+    assert d.next_expiry(now) == now + day
+    assert d.next_expiry(now + day) is None
+    d.close()
+
+
+def test_set_expiry(tmpdir):
+    """
+    Given content that was aired on two servers and removed from one
+    When expiry is set on both servers
+    Then only the content that is still on the server gets it, also when the
+    database is rebuilt from the log
+    """
+    p = str(tmpdir.join('bc.sqlite'))
+    log = str(tmpdir.join('broadcast.log'))
+    now = datetime.datetime(2015, 4, 1, 12)
+    day = datetime.timedelta(days=1)
+    d = mod.DB(p, log=log)
+    for srv in ('s1', 's2'):
+        d.add_content(id='a', server=srv, commit='c1', title='foo',
+                      url='http://example.com/', size=10, collected=now,
+                      packed=now, aired=now, expires=now)
+    d.remove_content('a', 's2')
+    d.set_expiry('a', 's1', now + day)
+    d.set_expiry('a', 's2', now + day)
+    d.close()
+    os.unlink(p)
+    d = mod.DB(p, log=log)
+    assert d.expired(now) == []
+    assert d.next_expiry(now) == now + day
+    assert d.expired(now + day) == [('a', 's1')]
+    d.close()
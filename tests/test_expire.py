@@ -0,0 +1,67 @@
+"""
+Tests for broadman.expire module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import datetime
+
+import pytest
+
+import broadman.db as db
+import broadman.path as path
+import broadman.expire as mod
+
+MOD = mod.__name__
+
+NOW = datetime.datetime(2015, 4, 1, 12)
+
+
+@pytest.fixture
+def broadcasts(tmpdir, monkeypatch):
+    """
+    Broadcast database with content that expires at different times, where
+    content is on servers if there is a symlink named after it in tmpdir
+    """
+    monkeypatch.setattr(path, 'BROADCAST', str(tmpdir.join('bc.sqlite')))
+    monkeypatch.setattr(db, '_db', None)
+    monkeypatch.setattr(path, 'contentdir', lambda cid, server: str(
+        tmpdir.join('{}-{}'.format(cid, server))))
+    d = db.connect()
+    for cid, srv, hours in [('a', 's1', -2), ('a', 's2', -1), ('b', 's1', -1),
+                            ('c', 's1', 0.5)]:
+        d.add_content(id=cid, server=srv, commit='c', title='t',
+                      url='http://example.com/', size=10, collected=NOW,
+                      packed=NOW, aired=NOW,
+                      expires=NOW + datetime.timedelta(hours=hours))
+        if cid != 'b':
+            os.symlink(str(tmpdir), path.contentdir(cid, srv))
+    d.commit()
+    yield d
+    db.close()
+
+
+def test_expired(broadcasts):
+    """
+    Given expired content, some of which was already removed from servers
+    When looking for expired content
+    Then only content that is still on the servers is returned
+    """
+    assert mod.expired(now=NOW) == [('a', 's1'), ('a', 's2')]
+    assert mod.expired(['s2'], now=NOW) == [('a', 's2')]
+
+
+def test_delay(broadcasts):
+    """
+    Given content that expires in the future
+    When calculating the time until the next check
+    Then it is the time until the content expires, up to the maximum
+    """
+    assert mod.delay(now=NOW) == 1800
+    assert mod.delay(60, now=NOW) == 60
+    assert mod.delay(now=NOW + datetime.timedelta(hours=1)) == mod.MAX_SLEEP
@@ -0,0 +1,132 @@
+"""
+Tests for broadman.filterjson module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import json
+import argparse
+
+import pytest
+
+import broadman.git as git
+import broadman.path as path
+import broadman.filterjson as mod
+
+MOD = mod.__name__
+
+parametrize = pytest.mark.parametrize
+
+
+@pytest.fixture
+def paths(tmpdir):
+    """
+    Content directories with metadata whose titles are numbered
+    """
+    ret = []
+    for i in range(50):
+        cdir = tmpdir.join('{:032x}'.format(i))
+        cdir.mkdir()
+        cdir.join('info.json').write(json.dumps({
+            'title': 'Item {}'.format(i),
+            'is_partner': i % 3 == 0,
+        }))
+        ret.append(str(cdir))
+    return ret
+
+
+def run(monkeypatch, src, **kwargs):
+    opts = dict(query=None, key=None, keyword=None, x=False, i=False,
+                gt=False, lt=False, exclude=False, t=None, jobs=1,
+                unordered=False)
+    opts.update(kwargs)
+    args = argparse.Namespace(**opts)
+    out = []
+    monkeypatch.setattr(mod.cn, 'pstd', out.append)
+    if args.jobs > 1:
+        mod.parmatch(src, args)
+    else:
+        match = mod.getmatcher(args)
+        for p in src:
+            mod.domatch(p.strip(), match)
+    return out
+
+
+@parametrize('opts', [
+    {'query': 'title~1 AND NOT is_partner:b=yes'},
+    {'key': 'title', 'keyword': 'item 2', 'i': True},
+])
+def test_parallel(paths, monkeypatch, opts):
+    """
+    Given content directories
+    When filtering them with more than one job
+    Then results are the same as with a single job, in input order
+    """
+    monkeypatch.setattr(mod, 'CHUNK', 7)
+    src = [p + '\n' for p in paths]
+    expected = run(monkeypatch, src, **opts)
+    assert expected
+    assert run(monkeypatch, src, jobs=2, **opts) == expected
+    unordered = run(monkeypatch, src, jobs=2, unordered=True, **opts)
+    assert sorted(unordered) == sorted(expected)
+
+
+def test_parallel_size(tmpdir, monkeypatch):
+    """
+    Given committed content of different sizes
+    When filtering it by size with more than one job
+    Then results are the same as with a single job, and committed trees are
+    only listed by the parent process
+    """
+    pooldir = str(tmpdir.join('pool'))
+    os.makedirs(pooldir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pooldir, '.version'))
+    monkeypatch.setattr(path, 'CATALOG', str(tmpdir.join('catalog.sqlite')))
+    monkeypatch.setattr(path, '_layout', None)
+    monkeypatch.setattr(git, '_session', None)
+    monkeypatch.setattr(mod, '_sizes', None)
+    git.init()
+    src = []
+    for i in range(10):
+        cdir = path.contentdir('{:032x}'.format(i))
+        os.makedirs(cdir)
+        with open(os.path.join(cdir, 'info.json'), 'w') as f:
+            f.write('{}')
+        with open(os.path.join(cdir, 'index.html'), 'w') as f:
+            f.write('x' * 100 * i)
+        git.commit(cdir, 'ADD')
+        src.append(cdir + '\n')
+    parent = os.getpid()
+    list_trees = git.list_trees
+
+    def guarded(p):
+        assert os.getpid() == parent
+        return list_trees(p)
+
+    monkeypatch.setattr(git, 'list_trees', guarded)
+    opts = {'query': 'size>=500 AND size<800'}
+    out = run(monkeypatch, src, jobs=2, **opts)
+    assert len(out) == 3
+    assert run(monkeypatch, src, **opts) == out
+
+
+def test_size_outside_pool(paths, tmpdir, monkeypatch):
+    """
+    Given content directories that are not in a repository
+    When filtering them by size
+    Then sizes are measured directly, and no cache is created
+    """
+    monkeypatch.setattr(path, 'POOLDIR', str(tmpdir))
+    monkeypatch.setattr(git, '_session', None)
+    monkeypatch.setattr(mod, '_sizes', None)
+    monkeypatch.chdir(str(tmpdir))
+    src = [p + '\n' for p in paths]
+    out = run(monkeypatch, src, key='size', keyword='0')
+    assert len(out) == len(paths)
+    assert not os.path.exists(tmpdir.join('.cache'))
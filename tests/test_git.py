@@ -0,0 +1,234 @@
+"""
+Tests for broadman.git module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import pytest
+
+import broadman.path as path
+import broadman.git as mod
+
+MOD = mod.__name__
+
+CID = 'accbcb49659267846e5590b4694ee769'
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    """
+    Initialized content pool with a single content directory that is not yet
+    committed.
+    """
+    pooldir = str(tmpdir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pooldir, '.version'))
+    monkeypatch.setattr(path, '_layout', None)
+    monkeypatch.setattr(mod, '_session', None)
+    mod.init()
+    cdir = os.path.join(pooldir, 'master', CID)
+    os.makedirs(cdir)
+    with open(os.path.join(cdir, 'info.json'), 'w') as f:
+        f.write('{}')
+    return pooldir
+
+
+def test_session_reused(pool):
+    """
+    Given an initialized pool
+    When session is requested more than once
+    Then the same repository handle is returned
+    """
+    assert mod.session() is mod.session()
+
+
+def test_session_pool_changed(pool, monkeypatch, tmpdir):
+    """
+    Given an open session
+    When pool directory changes
+    Then a new repository handle is opened
+    """
+    g = mod.session()
+    other = str(tmpdir.join('other'))
+    os.makedirs(other)
+    with open(os.path.join(other, '.gitignore'), 'w') as f:
+        f.write('\n'.join(mod.ignored()))
+    monkeypatch.setattr(path, 'POOLDIR', other)
+    monkeypatch.setattr(mod, 'Repo', lambda p: None)
+    assert mod.session() is not g
+
+
+def test_add_is_not_written(pool):
+    """
+    Given an open session
+    When content is added
+    Then index file is not written until it is flushed
+    """
+    g = mod.session()
+    ipath = os.path.join(pool, '.git', 'index')
+    before = os.stat(ipath).st_mtime
+    g.add([os.path.join(pool, 'master', CID)])
+    assert g.dirty
+    assert os.stat(ipath).st_mtime == before
+    g.flush()
+    assert not g.dirty
+
+
+def test_commit_update(pool):
+    """
+    Given content that was not committed
+    When content is committed
+    Then git commands see the committed state
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    mod.commit_update(cdir)
+    assert not mod.has_changes(cdir)
+    assert mod.latest_hash(cdir) == mod.head()
+
+
+def test_batch(pool):
+    """
+    Given content that was not committed
+    When it is committed within a batch
+    Then a single batch commit lists the commit subject
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    with mod.batch(10):
+        mod.commit_import(cdir)
+        assert mod.session().batch == [(cdir, '[OBM] IMP {}'.format(CID))]
+    assert mod.session().batch is None
+    msg = mod.session().repo.head.commit.message
+    assert msg == '[OBM] BAT BATCH 1\n\n[OBM] IMP {}'.format(CID)
+    assert not mod.has_changes(cdir)
+
+
+def test_batch_size(pool):
+    """
+    Given a batch of given size
+    When the number of commits reaches the size
+    Then changes are committed without waiting for the batch to end
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    with mod.batch(1):
+        mod.commit_import(cdir)
+        assert mod.session().batch == []
+        assert not mod.has_changes(cdir)
+
+
+def test_remove(pool):
+    """
+    Given committed content
+    When content is removed from the index
+    Then only its entries are removed
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    mod.commit_import(cdir)
+    g = mod.session()
+    g.remove([os.path.join(pool, 'master')], r=True)
+    assert [p for p, _ in g.index.entries] == ['.gitignore', '.version']
+
+
+def test_remove_after_add(pool):
+    """
+    Given content removed from the index, and content added afterwards
+    When content is removed from the index
+    Then entries of the added content are removed too, and entries of other
+    content that starts with the same name are kept
+    """
+    master = os.path.join(pool, 'master')
+    cdir = os.path.join(master, CID)
+    other = cdir + 'x'
+    os.makedirs(other)
+    with open(os.path.join(other, 'info.json'), 'w') as f:
+        f.write('{}')
+    g = mod.session()
+    g.add([cdir, other])
+    g.remove([other], r=True)
+    added = os.path.join(master, 'new')
+    os.makedirs(added)
+    with open(os.path.join(added, 'index.html'), 'w') as f:
+        f.write('new')
+    g.add([added, other])
+    g.remove([added, cdir], r=True)
+    assert sorted(p for p, _ in g.index.entries) == [
+        '.gitignore', '.version', 'master/' + CID + 'x/info.json']
+
+
+def test_get_history(pool):
+    """
+    Given committed content
+    When history of a path is requested
+    Then only commits that touched the path are returned
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    assert mod.get_history(cdir) == []
+    mod.commit_import(cdir)
+    assert mod.get_history(cdir) == [mod.head()]
+    assert len(mod.get_history(pool)) == 3
+    assert len(mod.get_history(pool, 2)) == 2
+
+
+def test_latest_hash_tracks_commits(pool):
+    """
+    Given content whose latest hash was looked up
+    When content is committed again
+    Then latest hash is updated without querying git
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    mod.commit_import(cdir)
+    first = mod.latest_hash(cdir)
+    assert mod.previous_hash(cdir) is None
+    with open(os.path.join(cdir, 'info.json'), 'w') as f:
+        f.write('{"title": "foo"}')
+    mod.commit_update(cdir)
+    assert mod.session().latest[cdir] == mod.head()
+    assert mod.latest_hash(cdir) == mod.head()
+    assert mod.previous_hash(cdir) == first
+
+
+
+def test_commit_times(pool):
+    """
+    Given two commits
+    When their commit times are looked up
+    Then times of both are returned
+    """
+    cdir = os.path.join(pool, 'master', CID)
+    mod.commit_import(cdir)
+    first = mod.head()
+    with open(os.path.join(cdir, 'info.json'), 'w') as f:
+        f.write('{"title": "foo"}')
+    mod.commit_update(cdir)
+    times = mod.commit_times([first, mod.head(), first])
+    assert sorted(times) == sorted([first, mod.head()])
+    assert times[first] == int(mod.session().git.show(first, s=True,
+                                                      format='%ct'))
+
+
+def test_ignore_derived(pool, monkeypatch):
+    """
+    Given a pool created before derived data was ignored
+    When session is opened, and then derived data is ignored
+    Then nothing is committed on open, missing .gitignore entries are
+    committed afterwards, and other staged changes are left staged
+    """
+    ifile = os.path.join(pool, '.gitignore')
+    g = mod.session()
+    with open(ifile, 'w') as f:
+        f.write('/.cache/')
+    g.git.commit(ifile, m='old ignores')
+    staged = g.git.status(s=True)
+    monkeypatch.setattr(mod, '_session', None)
+    g = mod.session()
+    assert g.repo.head.commit.message.strip() == 'old ignores'
+    mod.ignore_derived()
+    with open(ifile) as f:
+        assert f.read().splitlines() == mod.ignored()
+    assert g.git.status(s=True) == staged
+    assert 'IGN' in g.repo.head.commit.message
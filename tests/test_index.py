@@ -0,0 +1,192 @@
+"""
+Tests for broadman.index module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import pytest
+
+import broadman.git as git
+import broadman.path as path
+import broadman.index as mod
+
+MOD = mod.__name__
+
+CIDS = [
+    'accbcb49659267846e5590b4694ee769',
+    'acd6bc4b1e2d4e2a9c1e6b0e8a0f4f11',
+    '0f1e2d3c4b5a69788796a5b4c3d2e1f0',
+]
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    """
+    Content pool with a master directory containing a few content
+    directories.
+    """
+    pooldir = str(tmpdir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'INDEXDIR', os.path.join(pooldir, '.index'))
+    monkeypatch.setattr(mod, '_indexes', {})
+    monkeypatch.setattr(git, '_session', None)
+    for cid in CIDS:
+        os.makedirs(os.path.join(pooldir, 'master', cid))
+    return pooldir
+
+
+def test_find_all(pool):
+    """
+    Given a pool with no index, when find() is called without a prefix, then
+    the index is built and all content IDs are returned in sorted order.
+    """
+    idx = mod.Index()
+    assert list(idx.find()) == sorted(CIDS)
+    assert os.path.exists(idx.path)
+
+
+def test_find_prefix(pool):
+    """
+    Given a partial content ID, when find() is called, then only content IDs
+    that start with the given prefix are returned.
+    """
+    idx = mod.Index()
+    assert list(idx.find('acc')) == [CIDS[0]]
+    assert list(idx.find('ac')) == [CIDS[0], CIDS[1]]
+    assert list(idx.find('ff')) == []
+
+
+def test_add_remove(pool):
+    """
+    Given a loaded index, when add() and remove() are called and index is
+    saved, then the index file reflects the changes without a rebuild.
+    """
+    idx = mod.Index()
+    idx.load()
+    cid = 'bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb'
+    idx.add(cid)
+    idx.remove(CIDS[2])
+    idx.save()
+    with open(idx.path) as f:
+        assert f.readline().strip() == idx.header()
+        assert f.read().split() == [CIDS[0], CIDS[1], cid]
+
+
+def test_stale_index_rebuilt(pool):
+    """
+    Given an index that is older than the server directory, when find() is
+    called, then the index is rebuilt from the server directory.
+    """
+    idx = mod.Index()
+    idx.load()
+    cid = 'cccccccccccccccccccccccccccccccc'
+    os.mkdir(os.path.join(pool, 'master', cid))
+    mtime = os.stat(idx.path).st_mtime
+    os.utime(os.path.join(pool, 'master'), (mtime + 10, mtime + 10))
+    assert cid in list(mod.Index().find())
+
+
+def test_find_contentdirs(pool):
+    """
+    Given a list of partial content IDs, when find_contentdirs() is called,
+    then it returns content directory paths for all matching content.
+    """
+    assert list(mod.find_contentdirs(['0f1', 'accb\n'])) == [
+        os.path.join(pool, 'master', CIDS[2]),
+        os.path.join(pool, 'master', CIDS[0]),
+    ]
+
+
+def test_old_format_rebuilt(pool):
+    """
+    Given an index file without header that is newer than the server
+    directory, when it is loaded without the staleness check, then it is
+    rebuilt.
+    """
+    idx = mod.Index()
+    idx.load()
+    with open(idx.path, 'w') as f:
+        f.write(CIDS[0] + '\n')
+    idx = mod.Index()
+    idx.add('bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb')
+    assert sorted(idx.find()) == sorted(
+        CIDS + ['bbbbbbbbbbbbbbbbbbbbbbbbbbbbbbbb'])
+
+
+def commit_pool(pool, monkeypatch):
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pool, '.version'))
+    monkeypatch.setattr(path, '_layout', None)
+    for cid in CIDS:
+        with open(os.path.join(pool, 'master', cid, 'info.json'), 'w') as f:
+            f.write('{}')
+    g = git.Repo.init(pool)
+    g.git.add(A=True)
+    g.git.commit(m='content')
+    mod.Index().load()
+    return g
+
+
+def add_content(pool, cid):
+    cdir = os.path.join(pool, 'master', cid)
+    os.mkdir(cdir)
+    with open(os.path.join(cdir, 'info.json'), 'w') as f:
+        f.write('{}')
+
+
+def norebuild(self):
+    raise AssertionError('index rebuilt')
+
+
+def test_committed_change_updated(pool, monkeypatch):
+    """
+    Given an index of a repository, when content is committed by other means
+    and the index is loaded without the staleness check, then the changed
+    content IDs are updated without rebuilding the index.
+    """
+    g = commit_pool(pool, monkeypatch)
+    cid = 'cccccccccccccccccccccccccccccccc'
+    add_content(pool, cid)
+    g.git.add(A=True)
+    g.git.commit(m='more content')
+    monkeypatch.setattr(mod.Index, 'rebuild', norebuild)
+    idx = mod.Index()
+    idx.remove(CIDS[0])
+    assert list(idx.find()) == sorted([CIDS[1], CIDS[2], cid])
+
+
+def test_add_after_commit(pool, monkeypatch):
+    """
+    Given an index of a repository, when content is committed and then added
+    to the index, then the index is not rebuilt, and its header matches the
+    new commit.
+    """
+    commit_pool(pool, monkeypatch)
+    cid = 'cccccccccccccccccccccccccccccccc'
+    add_content(pool, cid)
+    git.commit(os.path.join(pool, 'master', cid), 'ADD')
+    monkeypatch.setattr(mod.Index, 'rebuild', norebuild)
+    idx = mod.Index()
+    idx.add(cid)
+    idx.save()
+    assert cid in idx.find()
+    with open(idx.path) as f:
+        assert f.readline().strip() == idx.header()
+
+
+def test_layout_change_rebuilt(pool, monkeypatch):
+    """
+    Given an index of a repository, when pool layout changes, then the index
+    is rebuilt.
+    """
+    commit_pool(pool, monkeypatch)
+    rebuilt = []
+    monkeypatch.setattr(mod.Index, 'rebuild', lambda self: rebuilt.append(1))
+    monkeypatch.setattr(path, 'poollayout', lambda: path.SHARDED)
+    mod.Index().load(check=False)
+    assert rebuilt
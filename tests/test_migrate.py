@@ -0,0 +1,146 @@
+"""
+Tests for broadman.migrate module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import pytest
+
+import broadman.git as git
+import broadman.path as path
+import broadman.index as index
+import broadman.migrate as mod
+
+MOD = mod.__name__
+
+CIDS = [
+    'accbcb49659267846e5590b4694ee769',
+    'acd6bc4b1e2d4e2a9c1e6b0e8a0f4f11',
+    '0f1e2d3c4b5a69788796a5b4c3d2e1f0',
+]
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    """
+    Flat pool with committed content, some of which is on a server
+    """
+    pooldir = str(tmpdir.join('pool'))
+    os.makedirs(pooldir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pooldir, '.version'))
+    monkeypatch.setattr(path, 'INDEXDIR', str(tmpdir.join('index')))
+    monkeypatch.setattr(path, '_layout', None)
+    monkeypatch.setattr(path, '_mode', None)
+    monkeypatch.setattr(git, '_session', None)
+    monkeypatch.setattr(index, '_indexes', {})
+    git.init()
+    for cid in CIDS:
+        cdir = path.contentdir(cid)
+        os.makedirs(cdir)
+        with open(os.path.join(cdir, 'info.json'), 'w') as f:
+            f.write(cid)
+        git.commit(cdir, 'IMP')
+    os.makedirs(path.serverdir('s1'))
+    for cid in CIDS[:2]:
+        link = path.contentdir(cid, 's1')
+        os.symlink(path.contentdir(cid), link)
+        git.commit(link, 'ADD')
+    return pooldir
+
+
+def relpaths(pooldir):
+    ret = []
+    for root, dirs, files in os.walk(pooldir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in dirs + files:
+            p = os.path.join(root, name)
+            if os.path.islink(p) or name == 'info.json':
+                ret.append(os.path.relpath(p, pooldir))
+    return sorted(ret)
+
+
+def migrations():
+    log = git.session().git.log(format='%s')
+    return [l for l in log.split('\n') if ' MIG ' in l]
+
+
+def check_pool(pooldir, layout):
+    for cid in CIDS:
+        with open(path.infopath(path.contentdir(cid, layout=layout))) as f:
+            assert f.read() == cid
+    for cid in CIDS[:2]:
+        link = path.contentdir(cid, 's1', layout=layout)
+        assert os.readlink(link) == path.contentdir(cid, layout=layout)
+    assert path.poollayout() == layout
+    assert not git.session().git.status(s=True, untracked_files='no')
+    assert list(index.find_contentdirs([CIDS[0][:3]], 's1')) == [
+        path.contentdir(CIDS[0], 's1', layout=layout)]
+
+
+def test_migrate_roundtrip(pool):
+    """
+    Given a flat pool
+    When it is migrated to sharded layout and back
+    Then content and server links are moved to the layout's paths, each
+    migration is a single commit, and the original paths are restored
+    """
+    flat = relpaths(pool)
+    mod.migrate(path.SHARDED)
+    check_pool(pool, path.SHARDED)
+    sharded = [os.path.join('master', *(path.shards(cid) + [cid, 'info.json']))
+               for cid in CIDS]
+    sharded += [os.path.join('s1', *(path.shards(cid) + [cid]))
+                for cid in CIDS[:2]]
+    assert relpaths(pool) == sorted(sharded)
+    assert len(migrations()) == 1
+    mod.migrate(path.FLAT)
+    check_pool(pool, path.FLAT)
+    assert relpaths(pool) == flat
+    assert sorted(os.listdir(path.serverdir('master'))) == sorted(CIDS)
+    assert len(migrations()) == 2
+
+
+def test_migrate_same_layout(pool):
+    """
+    Given a flat pool
+    When it is migrated to flat layout
+    Then ValueError is raised
+    """
+    with pytest.raises(ValueError):
+        mod.migrate(path.FLAT)
+
+
+def test_migrate_rollback(pool, monkeypatch):
+    """
+    Given a flat pool
+    When migration to sharded layout fails while relinking server content
+    Then content and server links are moved back, the pool keeps its layout
+    with no pending changes, and migration can be retried
+    """
+    flat = relpaths(pool)
+    relink = mod.relink
+    calls = []
+
+    def failing(cid, src, dest, layout):
+        calls.append(cid)
+        if len(calls) == 2:
+            raise OSError('disk full')
+        relink(cid, src, dest, layout)
+
+    monkeypatch.setattr(mod, 'relink', failing)
+    with pytest.raises(Exception):
+        mod.migrate(path.SHARDED)
+    monkeypatch.setattr(mod, 'relink', relink)
+    assert relpaths(pool) == flat
+    assert sorted(os.listdir(path.serverdir('s1'))) == sorted(CIDS[:2])
+    check_pool(pool, path.FLAT)
+    assert not migrations()
+    mod.migrate(path.SHARDED)
+    check_pool(pool, path.SHARDED)
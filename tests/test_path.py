@@ -197,3 +197,51 @@ def test_contentdir(monkeypatch):
     server = 'bar'
     expected = 'foo/bar/accbcb49659267846e5590b4694ee769'
     assert mod.contentdir(cid, server) == expected
+
+
+def test_contentdir_sharded(monkeypatch):
+    """
+    Given content ID and sharded layout, when contentdir() is called, then it
+    returns a path to the content directory nested in shard directories named
+    after the first characters of the content ID.
+    """
+    monkeypatch.setattr(mod, 'POOLDIR', 'foo')
+    cid = 'accbcb49659267846e5590b4694ee769'
+    expected = 'foo/bar/ac/cb/accbcb49659267846e5590b4694ee769'
+    assert mod.contentdir(cid, 'bar', layout=mod.SHARDED) == expected
+
+
+def test_read_options(tmpdir, monkeypatch):
+    """
+    Given a version file with options, when read_options() is called, then it
+    returns a dict of options that excludes the version line.
+    """
+    vfile = tmpdir.join('.version')
+    vfile.write('0.4\nlayout sharded\n')
+    monkeypatch.setattr(mod, 'VERSION', str(vfile))
+    assert mod.read_options() == {'layout': 'sharded'}
+
+
+def test_write_options(tmpdir, monkeypatch):
+    """
+    Given a dict of options, when write_options() is called, then the layout
+    recorded in the options is used by poollayout().
+    """
+    monkeypatch.setattr(mod, 'VERSION', str(tmpdir.join('.version')))
+    mod.write_options({'layout': mod.SHARDED})
+    assert mod.poollayout() == mod.SHARDED
+    mod.write_options({})
+    assert mod.poollayout() == mod.FLAT
+
+
+def test_dirsize(tmpdir):
+    """
+    Given a directory tree, when dirsize() is called, then it returns the
+    apparent size of all files in bytes, and disk usage that is at least as
+    large as the apparent size.
+    """
+    tmpdir.join('index.html').write('x' * 100)
+    tmpdir.mkdir('static').join('style.css').write('y' * 50)
+    size, usage = mod.dirsize(str(tmpdir))
+    assert size == 150
+    assert usage >= size
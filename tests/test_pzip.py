@@ -0,0 +1,133 @@
+"""
+Tests for broadman.pzip module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import zlib
+import zipfile
+
+import pytest
+
+import broadman.pzip as mod
+
+MOD = mod.__name__
+
+
+@pytest.fixture
+def files(tmpdir):
+    """
+    Files with compressible, random and no data
+    """
+    data = {
+        'text.txt': b'lorem ipsum dolor sit amet ' * 5000,
+        'noise.bin': os.urandom(50000),
+        'empty.txt': b'',
+    }
+    for name, content in data.items():
+        tmpdir.join(name).write(content, mode='wb')
+    return str(tmpdir), data
+
+
+def members(fdir, data):
+    ret = []
+    for name in sorted(data):
+        ctype = mod.ZIP_STORED if name == 'noise.bin' else mod.ZIP_DEFLATED
+        ret.append(('foo/' + name, os.path.join(fdir, name), None, ctype))
+    ret.append((u'foo/š.json', None, b'{"a": 1}', mod.ZIP_DEFLATED))
+    return ret
+
+
+def check_zip(zpath, data):
+    z = zipfile.ZipFile(zpath)
+    assert z.testzip() is None
+    for name, content in data.items():
+        assert z.read('foo/' + name) == content
+    assert z.read(u'foo/š.json') == b'{"a": 1}'
+    assert len(z.namelist()) == len(data) + 1
+
+
+def test_crc32_combine():
+    a = os.urandom(1000)
+    b = os.urandom(3333)
+    crc = mod.crc32_combine(zlib.crc32(a), zlib.crc32(b), len(b))
+    assert crc == zlib.crc32(a + b) & 0xFFFFFFFF
+
+
+def test_write(files, tmpdir):
+    """
+    Given files with different compression types
+    When zip file is written
+    Then it can be read using zipfile module
+    """
+    fdir, data = files
+    zpath = mod.write(str(tmpdir.join('out.zip')), members(fdir, data),
+                      jobs=2)
+    check_zip(zpath, data)
+
+
+def zipfile_crcs(zpath, fdir, data):
+    """ Return CRCs of members of a zip file written by zipfile module """
+    z = zipfile.ZipFile(zpath, 'w', zipfile.ZIP_DEFLATED)
+    for name in data:
+        z.write(os.path.join(fdir, name), 'foo/' + name)
+    z.close()
+    z = zipfile.ZipFile(zpath)
+    return dict((i.filename, i.CRC) for i in z.infolist())
+
+
+def test_write_chunks(files, tmpdir, monkeypatch):
+    """
+    Given files larger than chunk size
+    When zip file is written
+    Then chunks are combined into valid members with correct CRCs
+    """
+    monkeypatch.setattr(mod, 'CHUNK', 1000)
+    fdir, data = files
+    assert len(data['text.txt']) > 10 * mod.CHUNK
+    zpath = mod.write(str(tmpdir.join('out.zip')), members(fdir, data),
+                      level=9, jobs=4)
+    check_zip(zpath, data)
+    expected = zipfile_crcs(str(tmpdir.join('ref.zip')), fdir, data)
+    z = zipfile.ZipFile(zpath)
+    for name, crc in expected.items():
+        assert z.getinfo(name).CRC == crc
+
+
+def test_write_no_zdict(files, tmpdir, monkeypatch):
+    """
+    Given zlib without support for preset dictionaries
+    When zip file with files larger than chunk size is written
+    Then each member is compressed as a single stream
+    """
+    monkeypatch.setattr(mod, 'CHUNK', 1000)
+    monkeypatch.setattr(mod, 'ZDICT', False)
+    fdir, data = files
+    zpath = mod.write(str(tmpdir.join('out.zip')), members(fdir, data),
+                      jobs=4)
+    check_zip(zpath, data)
+    expected = zipfile_crcs(str(tmpdir.join('ref.zip')), fdir, data)
+    z = zipfile.ZipFile(zpath)
+    for name, crc in expected.items():
+        assert z.getinfo(name).CRC == crc
+
+
+def test_write_zip64(files, tmpdir, monkeypatch):
+    """
+    Given files above ZIP64 limit
+    When zip file is written
+    Then ZIP64 extensions are used
+    """
+    monkeypatch.setattr(mod, 'ZIP64_LIMIT', 100)
+    monkeypatch.setattr(mod, 'ZIP_FILECOUNT_LIMIT', 2)
+    fdir, data = files
+    zpath = mod.write(str(tmpdir.join('out.zip')), members(fdir, data),
+                      jobs=2)
+    with open(zpath, 'rb') as f:
+        assert mod.END_ARCHIVE64_SIG in f.read()
+    check_zip(zpath, data)
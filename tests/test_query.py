@@ -0,0 +1,175 @@
+"""
+Tests for broadman.query module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import pytest
+
+import broadman.query as mod
+
+MOD = mod.__name__
+
+parametrize = pytest.mark.parametrize
+
+
+DATA = {
+    'title': 'Quick brown Fox jumps over Lazy old Dog',
+    'broadcast': '2015-04-25',
+    'timestamp': '2015-04-20 12:15:00 UTC',
+    'images': 3,
+    'is_partner': False,
+}
+
+
+def nosize():
+    raise AssertionError('size should not be calculated')
+
+
+def test_tokenize():
+    """
+    Given a query string, when tokenize() is called, then it returns a list of
+    tokens with parentheses separated and keywords upper-cased.
+    """
+    assert mod.tokenize('(title~"brown fox" or images:n>2) and not x=y') == [
+        '(', 'title~"brown fox"', 'OR', 'images:n>2', ')', 'AND', 'NOT',
+        'x=y']
+
+
+@parametrize('q', [
+    'title~fox',
+    'title="Quick brown Fox jumps over Lazy old Dog"',
+    'title!=fox',
+    'images:n=3',
+    'images:n>=3',
+    'images:n=1..5',
+    'broadcast:d=2015-04-01..2015-04-30',
+    'timestamp:t<"2015-04-21 00:00:00"',
+    'is_partner:b=no',
+    'missing!=foo',
+    'title~cat OR images:n>2',
+    'title~fox AND images:n<5 AND NOT is_partner:b=yes',
+    '(title~cat OR title~dog) AND broadcast:d>2015-01-01',
+])
+def test_compile_match(q):
+    """
+    Given a query that matches the data, when compiled predicate is called,
+    then it returns True.
+    """
+    assert mod.compile(q, icase=True)(DATA, nosize)
+
+
+@parametrize('q', [
+    'title~cat',
+    'title=fox',
+    'images:n>3',
+    'images:n=4..5',
+    'broadcast:d<2015-04-25',
+    'is_partner:b=yes',
+    'missing:n>1',
+    'title~fox AND images:n>5',
+    'NOT (title~fox OR title~cat)',
+])
+def test_compile_nomatch(q):
+    """
+    Given a query that does not match the data, when compiled predicate is
+    called, then it returns False.
+    """
+    assert not mod.compile(q, icase=True)(DATA, nosize)
+
+
+def test_compile_icase():
+    """
+    Given a query with string term, when it is compiled without icase flag,
+    then string matches are case-sensitive.
+    """
+    assert not mod.compile('title~fox')(DATA, nosize)
+    assert mod.compile('title~Fox')(DATA, nosize)
+
+
+def test_compile_size():
+    """
+    Given a query with size term, when compiled predicate is called, then size
+    function is used to obtain the content size.
+    """
+    pred = mod.compile('size>1k AND size<=2k')
+    assert pred(DATA, lambda: 2048)
+    assert not pred(DATA, lambda: 512)
+
+
+@parametrize('q, size, expected', [
+    ('size>=10k', 10240, True),
+    ('size>=10k', 10239, False),
+    ('size>10Kb', 10241, True),
+    ('size=1.5M', 1572864, True),
+    ('size<1.5m', 1572864, False),
+    ('size=1k..1.5k', 1536, True),
+])
+def test_compile_size_units(q, size, expected):
+    """
+    Given a size term with multi-digit or decimal value and a unit, when
+    compiled predicate is called, then size is compared in bytes.
+    """
+    assert mod.compile(q)(DATA, lambda: size) is expected
+
+
+@parametrize('q', [
+    '',
+    'title',
+    'title~fox AND',
+    '(title~fox',
+    'title~fox)',
+    'title>fox',
+    'images:n~3',
+    'images:x=3',
+    'images:n=foo',
+    'size>1.5.5k',
+    'size>10g',
+])
+def test_compile_invalid(q):
+    """
+    Given a malformed query, when compile() is called, then QueryError is
+    raised.
+    """
+    with pytest.raises(mod.QueryError):
+        mod.compile(q)
+
+
+def test_tosql():
+    """
+    Given a query with string and size terms, when tosql() is called, then it
+    returns an equivalent SQL condition and its parameters.
+    """
+    cond, params = mod.tosql('title~fox AND NOT (url=x OR size>=1k)',
+                             ['title', 'url'], icase=True)
+    assert cond == (
+        '(coalesce(instr(py_lower(coalesce("title", \'None\')), ?) > 0, 0) '
+        'AND (NOT (coalesce(py_lower(coalesce("url", \'None\')) = ?, 0) '
+        'OR (size is not null and size >= ?))))')
+    assert params == ['fox', 'x', 1024]
+
+
+@parametrize('q', [
+    'images:n>2',
+    'missing~x',
+    'title~fox OR broadcast:d=2015-04-25',
+])
+def test_tosql_untranslatable(q):
+    """
+    Given a query with typed terms or keys without columns, when tosql() is
+    called, then QueryError is raised.
+    """
+    with pytest.raises(mod.QueryError):
+        mod.tosql(q, ['title'])
+
+
+def test_keys():
+    """
+    Given a query, when keys() is called, then it returns the keys used in it.
+    """
+    assert mod.keys('(title~"a b" OR images:n>2) AND NOT size<1k') == set([
+        'title', 'images', 'size'])
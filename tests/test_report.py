@@ -0,0 +1,93 @@
+"""
+Tests for broadman.report module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import io
+import json
+import datetime
+
+import pytest
+
+import broadman.db as db
+import broadman.path as path
+import broadman.report as mod
+
+MOD = mod.__name__
+
+DAY = datetime.datetime(2015, 4, 1, 12)
+
+
+@pytest.fixture
+def broadcasts(tmpdir, monkeypatch):
+    """
+    Broadcast database with content aired on two servers over two days
+    """
+    monkeypatch.setattr(path, 'BROADCAST', str(tmpdir.join('bc.sqlite')))
+    monkeypatch.setattr(db, '_db', None)
+    d = db.connect()
+    for i, (srv, days, lag) in enumerate([('s1', 0, 1), ('s1', 1, 40),
+                                          ('s2', 1, 2)]):
+        aired = DAY + datetime.timedelta(days)
+        d.add_content(id=str(i), server=srv, commit='c', title='t',
+                      url='http://www.example.com/{}'.format(i), size=10,
+                      collected=aired - datetime.timedelta(lag), packed=aired,
+                      aired=aired)
+    d.remove_content('0', 's1')
+    d.commit()
+    yield d
+    db.close()
+
+
+def rows(view, **kwargs):
+    return [tuple(r) for r in mod.query(view, **kwargs)]
+
+
+def test_live(broadcasts):
+    """
+    Given content that was removed from a server
+    When live content is reported
+    Then removed content is not listed
+    """
+    assert [r[:2] for r in rows('live')] == [('s1', '1'), ('s2', '2')]
+    assert [r[:2] for r in rows('live', server='s2')] == [('s2', '2')]
+
+
+def test_daily(broadcasts):
+    """
+    Given content aired on different days
+    When daily totals are reported
+    Then items and bytes are summed per day and server
+    """
+    assert rows('daily') == [('2015-04-01', 's1', 1, 10),
+                             ('2015-04-02', 's1', 1, 10),
+                             ('2015-04-02', 's2', 1, 10)]
+    since = until = datetime.date(2015, 4, 1)
+    assert rows('daily', since=since, until=until) == [
+        ('2015-04-01', 's1', 1, 10)]
+
+
+def test_publishers(broadcasts):
+    assert rows('publishers') == [('example.com', 3, 30)]
+
+
+def test_lag(broadcasts):
+    """
+    Given content aired long after it was collected
+    When lag is reported
+    Then only that content is listed
+    """
+    assert [r[1] for r in rows('lag')] == ['1']
+    assert [r[1] for r in rows('lag', min_lag=1)] == ['1', '2', '0']
+
+
+def test_write_jsonl(broadcasts):
+    out = io.StringIO()
+    mod.write_jsonl(mod.query('publishers'), out)
+    assert json.loads(out.getvalue()) == {
+        'publisher': 'example.com', 'items': 3, 'bytes': 30}
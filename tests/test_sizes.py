@@ -0,0 +1,132 @@
+"""
+Tests for broadman.sizes module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import pytest
+
+import broadman.git as git
+import broadman.path as path
+import broadman.sizes as mod
+
+MOD = mod.__name__
+
+CID = 'accbcb49659267846e5590b4694ee769'
+
+
+@pytest.fixture
+def sizes(tmpdir, monkeypatch):
+    """
+    Size cache of a pool with a single committed content directory
+    """
+    pooldir = str(tmpdir.join('pool'))
+    os.makedirs(pooldir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pooldir, '.version'))
+    monkeypatch.setattr(path, '_layout', None)
+    monkeypatch.setattr(git, '_session', None)
+    git.init()
+    cdir = path.contentdir(CID)
+    os.makedirs(cdir)
+    with open(os.path.join(cdir, 'index.html'), 'w') as f:
+        f.write('x' * 100)
+    git.commit(cdir, 'ADD')
+    s = mod.Sizes(str(tmpdir.join('catalog.sqlite')))
+    yield s
+    s.close()
+
+
+def cached(s):
+    return s.con.execute('select size from sizes').fetchall()
+
+
+def test_get_miss(sizes):
+    """
+    Given committed content that was not measured yet
+    When its size is requested
+    Then it is measured and stored in the cache
+    """
+    assert sizes.size(CID) == 100
+    assert cached(sizes) == [(100,)]
+
+
+def test_get_hit(sizes):
+    """
+    Given committed content that was measured before
+    When its size is requested
+    Then the cached size is returned
+    """
+    sizes.size(CID)
+    sizes.con.execute('update sizes set size = 42')
+    assert sizes.size(CID) == 42
+
+
+def test_get_changed(sizes):
+    """
+    Given content with uncommitted changes
+    When its size is requested
+    Then it is measured directly, without using or updating the cache
+    """
+    sizes.size(CID)
+    sizes.con.execute('update sizes set size = 42')
+    with open(os.path.join(path.contentdir(CID), 'index.html'), 'a') as f:
+        f.write('x' * 10)
+    s = mod.Sizes(con=sizes.con)
+    assert s.size(CID) == 110
+    assert cached(s) == [(42,)]
+
+
+def test_state(sizes, monkeypatch):
+    """
+    Given state of another size cache
+    When sizes are requested from a cache created with that state
+    Then git is not invoked
+    """
+    sizes.load([CID])
+    state = sizes.state([CID])
+    monkeypatch.setattr(git, 'list_trees', None)
+    monkeypatch.setattr(git, 'has_changes', None)
+    assert mod.Sizes(con=sizes.con, state=state).size(CID) == 100
+
+
+def test_shared_connection(sizes, tmpdir):
+    """
+    Given a connection owned by someone else
+    When a size is stored using it
+    Then the transaction is left to the owner to commit
+    """
+    s = mod.Sizes(con=sizes.con)
+    s.size(CID)
+    s.close()
+    con = mod.sqlite3.connect(str(tmpdir.join('catalog.sqlite')))
+    assert con.execute('select size from sizes').fetchall() == []
+    sizes.con.commit()
+    assert con.execute('select size from sizes').fetchall() == [(100,)]
+    con.close()
+
+
+def test_no_repository(tmpdir, monkeypatch):
+    """
+    Given a pool that is not a repository
+    When a size is requested
+    Then content is measured directly and the database is not opened
+    """
+    pooldir = str(tmpdir.join('other'))
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(git, '_session', None)
+    cdir = path.contentdir(CID)
+    os.makedirs(cdir)
+    with open(os.path.join(cdir, 'index.html'), 'w') as f:
+        f.write('x' * 10)
+    db = str(tmpdir.join('other.sqlite'))
+    s = mod.Sizes(db)
+    assert s.size(CID) == 10
+    s.close()
+    assert not os.path.exists(db)
@@ -0,0 +1,139 @@
+"""
+Tests for broadman.sync module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import datetime
+import argparse
+import threading
+
+import pytest
+
+import broadman.db as db
+import broadman.path as path
+import broadman.sync as mod
+
+MOD = mod.__name__
+
+OPS = [
+    ['ADD', 'a', 's1'],
+    ['ADD', 'b', 's1'],
+    ['ADD', 'a', 's2'],
+    ['DEL', 'c', 's1'],
+]
+
+
+def test_scheduler_server_order():
+    """
+    Given operations for multiple servers
+    When server has an operation running
+    Then its remaining operations are held back in order
+    """
+    sched = mod.Scheduler(OPS)
+    assert sched.next() == (0, OPS[0])
+    assert sched.next() == (2, OPS[2])
+    sched.done(OPS[0])
+    assert sched.next() == (1, OPS[1])
+    sched.done(OPS[1])
+    sched.done(OPS[2])
+    assert sched.next() == (3, OPS[3])
+    sched.done(OPS[3])
+    assert sched.next() is None
+
+
+def test_scheduler_limit():
+    """
+    Given a per-server limit greater than one
+    When operations are requested
+    Then up to limit operations per server are started in order
+    """
+    sched = mod.Scheduler(OPS, limit=2)
+    assert [sched.next()[0] for _ in range(3)] == [0, 1, 2]
+
+
+def test_packs_shared(monkeypatch):
+    """
+    Given content added to several servers
+    When it is packed for each of them
+    Then it is only packed once and removed after last use
+    """
+    removed = []
+    packed = []
+    monkeypatch.setattr(mod, 'remove_pack', removed.append)
+    monkeypatch.setattr(mod.tempfile, 'mkdtemp', lambda: 'tmp')
+    packs = mod.Packs(OPS, pack=lambda cid, zpath, mtime:
+                      packed.append(zpath))
+    zpath = packs.get('a')[0]
+    assert zpath == 'tmp/a.zip'
+    packs.release('a')
+    assert removed == []
+    assert packs.get('a')[0] == zpath
+    packs.release('a')
+    assert removed == [zpath]
+    assert packed == [zpath]
+
+
+def test_packs_mtime(monkeypatch):
+    """
+    Given commit times looked up in advance
+    When content is packed in a worker thread
+    Then commit time is passed to the packer without using git
+    """
+    packed = []
+    monkeypatch.setattr(mod, 'git', None)
+    monkeypatch.setattr(mod.tempfile, 'mkdtemp', lambda: 'tmp')
+    packs = mod.Packs(OPS, pack=lambda cid, zpath, mtime:
+                      packed.append((cid, mtime)), commits={'a': 'abc'},
+                      mtimes={'a': 1428000000})
+    t = threading.Thread(target=packs.get, args=('a',))
+    t.start()
+    t.join()
+    assert packed == [('a', 1428000000)]
+
+
+def test_resume():
+    """
+    Given operations completed by an interrupted sync
+    When sync is resumed
+    Then only remaining operations are performed
+    """
+    ops = [op + ['foo@bar.com', 'ts'] for op in OPS]
+    done, ops = mod.resume(ops, ['ADD b s1 foo@bar.com ts',
+                                 'DEL c s1 foo@bar.com ts'])
+    assert done == ['+ b', '- c']
+    assert [op[:3] for op in ops] == [OPS[0], OPS[2]]
+
+
+def test_sizearg():
+    """
+    Given a zip cache size argument
+    When it is not a valid size
+    Then argparse reports it as an invalid argument
+    """
+    assert mod.sizearg('2k') == 2048
+    with pytest.raises(argparse.ArgumentTypeError):
+        mod.sizearg('lots')
+
+
+def test_renew(tmpdir, monkeypatch):
+    """
+    Given aired content that expired
+    When it is renewed with a TTL
+    Then it expires TTL days from now
+    """
+    monkeypatch.setattr(path, 'BROADCAST', str(tmpdir.join('bc.sqlite')))
+    monkeypatch.setattr(db, '_db', None)
+    now = datetime.datetime.utcnow()
+    d = db.connect()
+    d.add_content(id='a', server='s1', commit='c', title='t',
+                  url='http://example.com/', size=10, collected=now,
+                  packed=now, aired=now, expires=now)
+    mod.renew([('a', 's1')], 2)
+    assert d.expired(now + datetime.timedelta(days=1)) == []
+    assert d.next_expiry(now) > now + datetime.timedelta(days=1.9)
+    db.close()
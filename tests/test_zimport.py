@@ -0,0 +1,107 @@
+"""
+Tests for broadman.zimport module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import json
+import errno
+import zipfile
+
+import pytest
+
+import broadman.git as git
+import broadman.path as path
+import broadman.index as index
+import broadman.zimport as mod
+
+MOD = mod.__name__
+
+CID = 'accbcb49659267846e5590b4694ee769'
+
+META = {
+    'title': 'Quick brown Fox',
+    'url': 'http://example.com/',
+    'timestamp': '2015-04-01 12:00:00 UTC',
+    'license': 'GFDL',
+}
+
+
+@pytest.fixture
+def pool(tmpdir, monkeypatch):
+    """
+    Initialized content pool and a zipball named after its content ID
+    """
+    pooldir = str(tmpdir.join('pool'))
+    os.makedirs(pooldir)
+    monkeypatch.setattr(path, 'POOLDIR', pooldir)
+    monkeypatch.setattr(path, 'VERSION', os.path.join(pooldir, '.version'))
+    monkeypatch.setattr(path, 'INDEXDIR', str(tmpdir.join('index')))
+    monkeypatch.setattr(path, 'STAGINGDIR', str(tmpdir.join('staging')))
+    monkeypatch.setattr(path, '_layout', None)
+    monkeypatch.setattr(git, '_session', None)
+    monkeypatch.setattr(index, '_indexes', {})
+    monkeypatch.setattr(mod.cn, 'verbose', False)
+    git.init()
+    zpath = str(tmpdir.join(CID + '.zip'))
+    with zipfile.ZipFile(zpath, 'w') as z:
+        z.writestr(CID + '/info.json', json.dumps(META))
+        z.writestr(CID + '/index.html', 'fox')
+    out = []
+    monkeypatch.setattr(mod.cn, 'pstd', out.append)
+    return zpath, out
+
+
+def test_import(pool):
+    """
+    Given a zipball
+    When it is imported
+    Then its content is moved into the pool and committed, and the staging
+    directory is cleaned up
+    """
+    zpath, out = pool
+    mod.doimport(zpath)
+    assert 'ERR' not in out[0]
+    cdir = path.contentdir(CID)
+    with open(os.path.join(cdir, 'index.html')) as f:
+        assert f.read() == 'fox'
+    assert git.latest_hash(cdir)
+    assert list(index.find_contentdirs([CID])) == [cdir]
+    assert os.listdir(path.STAGINGDIR) == []
+
+
+def test_import_existing(pool):
+    """
+    Given a zipball of content that is already in the pool
+    When it is imported
+    Then import fails and the staging directory is cleaned up
+    """
+    zpath, out = pool
+    os.makedirs(path.contentdir(CID))
+    mod.doimport(zpath)
+    assert 'ERR' in out[0]
+    assert os.listdir(path.STAGINGDIR) == []
+
+
+def test_import_other_filesystem(pool, monkeypatch):
+    """
+    Given a staging directory on a different filesystem than the pool
+    When a zipball is imported
+    Then import fails without copying files, and the staging directory is
+    cleaned up
+    """
+    zpath, out = pool
+
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(mod.os, 'rename', rename)
+    mod.doimport(zpath)
+    assert 'ERR' in out[0]
+    assert not os.path.exists(path.contentdir(CID))
+    assert os.listdir(path.STAGINGDIR) == []
@@ -0,0 +1,109 @@
+"""
+Tests for broadman.zipcache module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+
+import pytest
+
+import broadman.zipcache as mod
+
+MOD = mod.__name__
+
+CID = 'accbcb49659267846e5590b4694ee769'
+
+
+def packer(size):
+    calls = []
+
+    def pack(zpath):
+        calls.append(zpath)
+        with open(zpath, 'wb') as f:
+            f.write(b'x' * size)
+
+    pack.calls = calls
+    return pack
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return mod.ZipCache(budget=100, cdir=str(tmpdir))
+
+
+def test_get_packs_once(cache):
+    """
+    Given an empty cache
+    When the same zip file is requested twice
+    Then it is only packed once and named after the content ID
+    """
+    pack = packer(10)
+    zpath = cache.get(CID, 'abc', '2015-04-01', pack)
+    assert os.path.basename(zpath) == CID + '.zip'
+    assert cache.get(CID, 'abc', '2015-04-01', pack) == zpath
+    assert len(pack.calls) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_get_new_commit(cache):
+    """
+    Given a cached zip file
+    When zip file for different commit is requested
+    Then it is packed again
+    """
+    pack = packer(10)
+    z1 = cache.get(CID, 'abc', '2015-04-01', pack)
+    z2 = cache.get(CID, 'def', '2015-04-01', pack)
+    assert z1 != z2
+    assert len(pack.calls) == 2
+
+
+def test_evict_lru(cache):
+    """
+    Given cached zip files that exceed the budget
+    When they are not in use
+    Then least recently used ones are removed
+    """
+    pack = packer(60)
+    z1 = cache.get(CID, 'abc', '2015-04-01', pack)
+    os.utime(z1, (1, 1))
+    cache.release(z1)
+    z2 = cache.get(CID, 'def', '2015-04-01', pack)
+    assert not os.path.exists(z1)
+    assert os.path.exists(z2)
+
+
+def test_evict_in_use(cache):
+    """
+    Given cached zip files that exceed the budget
+    When they are in use
+    Then they are not removed
+    """
+    pack = packer(60)
+    z1 = cache.get(CID, 'abc', '2015-04-01', pack)
+    os.utime(z1, (1, 1))
+    z2 = cache.get(CID, 'def', '2015-04-01', pack)
+    assert os.path.exists(z1)
+    assert os.path.exists(z2)
+
+
+def test_get_options(tmpdir):
+    """
+    Given a zip file cached with some pack options
+    When it is requested with different options
+    Then it is packed again, and cached separately
+    """
+    pack = packer(10)
+    c1 = mod.ZipCache(budget=100, cdir=str(tmpdir), options={'level': 1})
+    c9 = mod.ZipCache(budget=100, cdir=str(tmpdir), options={'level': 9})
+    z1 = c1.get(CID, 'abc', '2015-04-01', pack)
+    z9 = c9.get(CID, 'abc', '2015-04-01', pack)
+    assert z1 != z9
+    assert len(pack.calls) == 2
+    assert c1.get(CID, 'abc', '2015-04-01', pack) == z1
+    assert len(pack.calls) == 2
@@ -0,0 +1,166 @@
+"""
+Tests for broadman.zips module
+
+Copyright 2015, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import zipfile
+
+import pytest
+
+import broadman.zips as mod
+
+MOD = mod.__name__
+
+CID = 'accbcb49659267846e5590b4694ee769'
+
+
+@pytest.fixture
+def content(tmpdir):
+    """
+    Content directory with a metadata file and a page in a subdirectory
+    """
+    cdir = tmpdir.mkdir(CID)
+    cdir.join('info.json').write('{"title": "foo"}')
+    cdir.mkdir('static').join('index.html').write('<html></html>')
+    return str(cdir)
+
+
+def test_pack(content, tmpdir):
+    """
+    Given a content directory
+    When it is packed
+    Then all files are stored in a directory named after the zip file
+    """
+    zpath = mod.pack(str(tmpdir.join(CID + '.zip')), content)
+    z = zipfile.ZipFile(zpath)
+    assert sorted(z.namelist()) == [
+        CID + '/info.json',
+        CID + '/static/index.html',
+    ]
+    assert z.read(CID + '/info.json') == b'{"title": "foo"}'
+
+
+def test_pack_overrides(content, tmpdir):
+    """
+    Given a content directory
+    When it is packed with overrides
+    Then overridden files are stored with given data and source is unchanged
+    """
+    zpath = str(tmpdir.join('foo.zip'))
+    mod.pack(zpath, content, root=CID, overrides={
+        'info.json': b'{"title": "bar"}',
+        'extra.txt': b'extra',
+    })
+    z = zipfile.ZipFile(zpath)
+    assert len(z.namelist()) == 3
+    assert z.read(CID + '/info.json') == b'{"title": "bar"}'
+    assert z.read(CID + '/extra.txt') == b'extra'
+    with open(os.path.join(content, 'info.json')) as f:
+        assert f.read() == '{"title": "foo"}'
+
+
+@pytest.mark.parametrize('name,expected', [
+    ('photo.JPG', zipfile.ZIP_STORED),
+    ('video.mp4', zipfile.ZIP_STORED),
+    ('index.html', zipfile.ZIP_DEFLATED),
+])
+def test_compress_type_extension(name, expected):
+    assert mod.compress_type(name) == expected
+
+
+def test_compress_type_sample(tmpdir):
+    """
+    Given files with random and repetitive data
+    When compression type is determined by sampling
+    Then only the repetitive file is compressed
+    """
+    noise = tmpdir.join('noise.bin')
+    noise.write(os.urandom(4096), mode='wb')
+    text = tmpdir.join('text.bin')
+    text.write(b'a' * 4096, mode='wb')
+    assert mod.compress_type(str(noise)) == zipfile.ZIP_DEFLATED
+    assert mod.compress_type(str(noise), sample=True) == zipfile.ZIP_STORED
+    assert mod.compress_type(str(text), sample=True) == zipfile.ZIP_DEFLATED
+
+
+def test_pack_stores_media(content, tmpdir):
+    """
+    Given content with media files
+    When it is packed
+    Then media files are stored without compression
+    """
+    with open(os.path.join(content, 'static', 'logo.png'), 'wb') as f:
+        f.write(os.urandom(1024))
+    zpath = mod.pack(str(tmpdir.join(CID + '.zip')), content, level=9)
+    z = zipfile.ZipFile(zpath)
+    types = dict((i.filename, i.compress_type) for i in z.infolist())
+    assert types[CID + '/static/logo.png'] == zipfile.ZIP_STORED
+    assert types[CID + '/static/index.html'] == zipfile.ZIP_DEFLATED
+    assert z.testzip() is None
+
+
+def test_pack_level(content, tmpdir, monkeypatch):
+    """
+    Given a compression level
+    When content is packed
+    Then zip file is written by pzip, which supports levels on all versions
+    """
+    calls = []
+    write = mod.pzip.write
+    monkeypatch.setattr(mod.pzip, 'write', lambda *args: calls.append(args)
+                        or write(*args))
+    zpath = mod.pack(str(tmpdir.join(CID + '.zip')), content, level=1)
+    assert len(calls) == 1
+    assert calls[0][2] == 1
+    assert zipfile.ZipFile(zpath).testzip() is None
+
+
+def test_pack_jobs(content, tmpdir):
+    """
+    Given content with media files
+    When it is packed using multiple threads
+    Then the zip file has the same members as one packed by zipfile
+    """
+    with open(os.path.join(content, 'static', 'logo.png'), 'wb') as f:
+        f.write(os.urandom(1024))
+    single = zipfile.ZipFile(mod.pack(str(tmpdir.join('single.zip')), content,
+                                      root=CID,
+                                      overrides={'info.json': b'{}'}))
+    zpath = mod.pack(str(tmpdir.join(CID + '.zip')), content,
+                     overrides={'info.json': b'{}'}, jobs=4)
+    z = zipfile.ZipFile(zpath)
+    assert z.testzip() is None
+    assert z.namelist() == single.namelist()
+    for i in z.infolist():
+        assert i.compress_type == single.getinfo(i.filename).compress_type
+        assert z.read(i) == single.read(i.filename)
+
+
+def test_pack_reproducible(content, tmpdir):
+    """
+    Given content packed with a fixed modification time
+    When it is packed again after its files were touched and chmodded
+    Then zip files are identical, even if packed using multiple threads
+    """
+    mtime = 1430000000
+    first = mod.pack(str(tmpdir.join('first.zip')), content, root=CID,
+                     mtime=mtime)
+    for f in os.listdir(content):
+        p = os.path.join(content, f)
+        os.utime(p, (mtime + 100, mtime + 100))
+        if os.path.isfile(p):
+            os.chmod(p, 0o600)
+    second = mod.pack(str(tmpdir.join('second.zip')), content, root=CID,
+                      mtime=mtime, jobs=4)
+    with open(first, 'rb') as f1, open(second, 'rb') as f2:
+        assert f1.read() == f2.read()
+    z = zipfile.ZipFile(second)
+    assert z.namelist() == sorted(z.namelist())
+    for i in z.infolist():
+        assert i.external_attr >> 16 == 0o100644